@@ -1,14 +1,26 @@
 
 import logging
+import os
+import re
 import sys
 import time
+import threading
+import cProfile
+import pstats
 import psutil
 import argparse
+import codecs
 import json
-from copy import deepcopy
+import io
 import multiprocessing as mp
-from flask import Flask, request, Response
+import zipfile
+import numpy as np
+from flask import Flask, request, Response, stream_with_context, has_request_context
 import srtm_elevation_and_slope as srtm_methods
+import metrics
+from job_queue import JobQueue
+from tile_pack import TilePack
+from prefork_server import PreforkServer
 
 logger = logging.getLogger()
 
@@ -17,44 +29,122 @@ logger = logging.getLogger()
 flask_app = Flask(__name__)
 VERSION = "0.3"
 DEFAULT_STRIDE = 250.0
+flask_app.config["pool"] = None  # multiprocessing pool used to shard big batches (set in __main__)
+flask_app.config["POOL_MIN_POINTS"] = 50000  # batches smaller than this run in the request process
+flask_app.config["POOL_CHUNK_SIZE"] = 20000  # points per chunk handed to a pool worker
+flask_app.config["NDJSON_WINDOW_SIZE"] = 5000  # points processed at a time when streaming NDJSON
+flask_app.config["job_queue"] = None  # disk-backed queue for /groundhog/jobs (set in __main__)
+JOB_RUNNER_NICENESS = 10  # job runners yield the CPU to interactive requests
+JOB_READ_BYTES = 2 ** 20  # a JSON list job is parsed this much of the upload at a time
+JOB_MAX_RECORD_CHARS = 2 ** 16  # points are far smaller, a record this long that doesn't decode is malformed
+WHITESPACE = re.compile(r"\s*")
+flask_app.config["DECIMATE_METERS"] = 0.0  # default decimation of dense tracks (see from_arrays), 0 for none
+flask_app.config["DECIMATE_SECONDS"] = 0.0
+flask_app.config["RASTER_MAX_CELLS"] = 25000000  # biggest grid /groundhog/raster hands out
+flask_app.config["ROUTE_MAX_SAMPLES"] = 5000000  # most samples /groundhog/route takes along one route
+DEFAULT_ROUTE_INTERVAL = 100.0  # meters between /groundhog/route samples
+flask_app.config["ALLOW_PROFILING"] = False  # whether requests may ask for a trace (see requested_profile)
+PROFILE_TOP_FUNCTIONS = 15  # functions listed in a cProfile trace
+TRACE_HEADER = "X-Groundhog-Trace"
+profiler_lock = threading.Lock()  # cProfile can only run one profiler at a time
+NDJSON_MIMETYPE = "application/x-ndjson"
+NPZ_MIMETYPE = "application/x-npz"
+NPZ_COLUMNS = ("latitude", "longitude", "bearing", "stride", "unique_key", "track", "time")
+JOB_MIMETYPES = ("application/json", NDJSON_MIMETYPE)  # what process_job_input can read
+RASTER_LAYERS = ("elevation", "slope", "aspect")
+ROUTE_COLUMNS = ("distance", "latitude", "longitude", "elevation", "grade", "climb", "descent")
 
 
-class Heading:
+class HeadingBatch:
     """
-    A simple class to bundle space-time coordinates
-    NOTE: latitudes MUST be -180 to 180
+    A batch of space-time coordinates stored as columns (struct of arrays)
+    NOTE: longitudes over 180 are wrapped to -180 to 180
+    Missing bearings, times, elevations and slopes are NaN, unique keys and tracks stay plain lists
+    (track is None when no point names one)
     """
-    latitude = None
-    longitude = None
-    bearing = None
-    stride = None
-    unique_key = None
-
-    def __init__(self, latitude, longitude, bearing=None, stride=DEFAULT_STRIDE, unique_key=None):
-        if longitude > 180.0:
-            longitude = longitude - 360.0
-        self.latitude = latitude
-        self.longitude = longitude
-        self.bearing = bearing
-        self.stride = stride
-        self.unique_key = unique_key
-
-    def info(self):
-        logger.info("lat|lon at bearing:stride (key) = " +
-                    str(self.latitude) + "|" +
-                    str(self.longitude) + " at " +
-                    str(self.bearing) + ":" +
-                    str(self.stride) + " (" +
-                    str(self.unique_key) + ")")
-
-    def to_dict(self):
-        return {
-                "latitude": self.latitude,
-                "longitude": self.longitude,
-                "bearing": self.bearing,
-                "stride": self.stride,
-                "unique_key": self.unique_key
-               }
+    __slots__ = ["latitude", "longitude", "bearing", "stride", "unique_key", "track", "time", "elevation", "slope"]
+
+    def __init__(self, latitude, longitude, bearing=None, stride=None, unique_key=None, track=None, time=None):
+        self.latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        self.longitude = np.where(longitude > 180.0, longitude - 360.0, longitude)
+        size = self.latitude.size
+        self.bearing = np.full(size, np.nan) if bearing is None else np.asarray(bearing, dtype=float)
+        self.stride = np.full(size, DEFAULT_STRIDE) if stride is None else np.asarray(stride, dtype=float)
+        self.unique_key = [None] * size if unique_key is None else list(unique_key)
+        self.track = None if track is None else list(track)
+        self.time = np.full(size, np.nan) if time is None else np.asarray(time, dtype=float)
+        self.elevation = np.full(size, np.nan)
+        self.slope = np.full(size, np.nan)
+
+    def __len__(self):
+        return self.latitude.size
+
+    def select(self, index):
+        """
+        A new batch holding the rows picked by a slice (or index array)
+        """
+        if isinstance(index, slice):
+            unique_key = self.unique_key[index]
+            track = None if self.track is None else self.track[index]
+        else:
+            unique_key = [self.unique_key[i] for i in index]
+            track = None if self.track is None else [self.track[i] for i in index]
+        batch = HeadingBatch(self.latitude[index], self.longitude[index], bearing=self.bearing[index],
+                             stride=self.stride[index], unique_key=unique_key, track=track, time=self.time[index])
+        batch.elevation = self.elevation[index]
+        batch.slope = self.slope[index]
+        return batch
+
+    @staticmethod
+    def concatenate(batches):
+        """
+        Stacks batches end to end
+        """
+        batch = HeadingBatch(np.concatenate([b.latitude for b in batches]),
+                             np.concatenate([b.longitude for b in batches]),
+                             bearing=np.concatenate([b.bearing for b in batches]),
+                             stride=np.concatenate([b.stride for b in batches]),
+                             unique_key=[key for b in batches for key in b.unique_key],
+                             track=HeadingBatch.concatenate_tracks(batches),
+                             time=np.concatenate([b.time for b in batches]))
+        batch.elevation = np.concatenate([b.elevation for b in batches])
+        batch.slope = np.concatenate([b.slope for b in batches])
+        return batch
+
+    @staticmethod
+    def concatenate_tracks(batches):
+        if all(b.track is None for b in batches):
+            return None
+        return [track for b in batches for track in (b.track if b.track is not None else [None] * len(b))]
+
+    def track_codes(self):
+        """
+        Integer codes for the track keys, None if no point names a track
+        """
+        if self.track is None:
+            return None
+        codes = {}
+        return np.array([codes.setdefault(track, len(codes)) for track in self.track], dtype=np.intp)
+
+    def to_dicts(self):
+        """
+        Response dictionaries, one per row, built straight from the columns
+        """
+        results = [{"bearing": bearing,
+                    "stride": stride,
+                    "unique_key": unique_key,
+                    "elevation": elevation,
+                    "slope": slope,
+                    "geo_point": {"lat": latitude, "lon": longitude}}
+                   for latitude, longitude, bearing, stride, unique_key, elevation, slope
+                   in zip(self.latitude.tolist(), self.longitude.tolist(), array_to_list(self.bearing),
+                          self.stride.tolist(), self.unique_key, array_to_list(self.elevation, as_int=True),
+                          array_to_list(self.slope))]
+        if self.track is not None:
+            for result, track in zip(results, self.track):
+                result["track"] = track
+        return results
 
 
 def report_sys_info():
@@ -78,6 +168,53 @@ def get_command_line():
     ap.set_defaults(debug=False)
     ap.add_argument("-p", '--port', type=int, default=5005,
                     help='Port you wan to run this on.', required=False)
+    ap.add_argument("-t", "--tile-dir", dest="tile_dir", type=str, default=None,
+                    help="Directory of raw SRTM .hgt tiles to memory-map (defaults to the srtm.py cache).",
+                    required=False)
+    ap.add_argument("--tile-pack", dest="tile_pack", type=str, default=None,
+                    help="Serve tiles from a pack built with tile_pack.py, tiles outside it are never downloaded. "
+                         "With --prefork the pack is decompressed into memory before forking, up to "
+                         "--tile-cache-mb.",
+                    required=False)
+    ap.add_argument("-w", "--workers", type=int, default=None,
+                    help="Number of pool processes used to shard big batches (default: one per CPU, 1 to disable).",
+                    required=False)
+    ap.add_argument("--pool-min-points", dest="pool_min_points", type=int, default=50000,
+                    help="Batches with at least this many points are sharded across the pool.", required=False)
+    ap.add_argument("--chunk-size", dest="chunk_size", type=int, default=20000,
+                    help="Points per chunk handed to a pool worker.", required=False)
+    ap.add_argument("--prefork", type=int, default=0,
+                    help="Serve with this many pre-forked worker processes instead of the Flask dev server.",
+                    required=False)
+    ap.add_argument("--max-requests", dest="max_requests", type=int, default=0,
+                    help="Recycle a pre-forked worker after this many requests (0 for never).", required=False)
+    ap.add_argument("--graceful-timeout", dest="graceful_timeout", type=float, default=30.0,
+                    help="Seconds pre-forked workers get to finish their request when stopping.", required=False)
+    ap.add_argument("--job-dir", dest="job_dir", type=str, default=None,
+                    help="Enables /groundhog/jobs, spilling their uploads and results to this directory "
+                         "(no jobs without it).", required=False)
+    ap.add_argument("--job-runners", dest="job_runners", type=int, default=1,
+                    help="Number of processes working through queued jobs when --job-dir is set "
+                         "(0 to only accept them).", required=False)
+    ap.add_argument("--slope-cache-entries", dest="slope_cache_entries", type=int, default=0,
+                    help="Reuse slopes of points seen before, keeping up to this many results per process "
+                         "(0 to compute every point exactly).", required=False)
+    ap.add_argument("--slope-cache-bearing-step", dest="slope_cache_bearing_step", type=float, default=1.0,
+                    help="Degrees bearings are rounded to when looking up cached slopes.", required=False)
+    ap.add_argument("--gradient-strides", dest="gradient_strides", type=str, default=None,
+                    help="Comma separated strides (meters), e.g. 100,250,500,1000, whose slopes are read off "
+                         "precomputed gradient rasters instead of being computed point by point.", required=False)
+    ap.add_argument("--decimate-meters", dest="decimate_meters", type=float, default=0.0,
+                    help="Default for ?decimate_meters: only look up a track point every this many meters "
+                         "(0 to look up every point).", required=False)
+    ap.add_argument("--decimate-seconds", dest="decimate_seconds", type=float, default=0.0,
+                    help="Default for ?decimate_seconds: only look up a track point every this many seconds "
+                         "(0 to look up every point).", required=False)
+    ap.add_argument("--allow-profiling", dest="allow_profiling", action="store_true",
+                    help="Let requests ask for a timing trace with ?profile=1 (or ?profile=cprofile).")
+    ap.add_argument("--tile-cache-mb", dest="tile_cache_mb", type=float, default=None,
+                    help="Budget for mapped SRTM tiles (and their gradient rasters) in MB, least recently "
+                         "used tiles are evicted (no limit if not set).", required=False)
     command_line_args = ap.parse_args()
     return command_line_args
 
@@ -87,7 +224,11 @@ def make_health_check():
     Makes a check that the network is responding for
     monitoring purposes in operations
     """
-    return Response(json.dumps({"status": "OK"}), mimetype='application/json')
+    slope_cache = srtm_methods.slope_cache
+    return Response(json.dumps({"status": "OK",
+                                "tile_cache": srtm_methods.tile_store.cache.stats(),
+                                "slope_cache": None if slope_cache is None else slope_cache.stats()}),
+                    mimetype='application/json')
 
 
 def help_response():
@@ -106,7 +247,11 @@ def help_response():
         ENDPOINTS:
         /help - to request a help doc
         /health - make health check
+        /metrics - Prometheus metrics (stage latencies, points, tiles, voids)
         /groundhog - to request terrain/slope data
+        /groundhog/raster - grids of elevation, slope and aspect for an area
+        /groundhog/route - elevation profile along a route
+        /groundhog/jobs - to submit a very large batch as a background job
 
         GROUNDHOG VARIABLES:
         lat - latitude of interest (-90.0 to 90.0 degrees North)
@@ -119,10 +264,17 @@ def help_response():
         optional:
         stride (optional, default=250.0) - resolution to calculate slope on in meters (larger is smoother)
 
+        track (optional) - groups points into tracks, e.g. one per asset
+
+        Points without a bearing get one inferred from the next point of
+        their track (the last point of a track only gets an elevation).
+        A call for a single point without a bearing gets the raw SRTM
+        elevation (null on a void) and no slope.
+
         SAMPLE REST CALL:
         http://localhost:5005/groundhog?lat=45.2&lon=-101.3
 
-        SAMPLE JSON PAYLOAD (OPTIONAL - bearing, stride, unique_key):
+        SAMPLE JSON PAYLOAD (OPTIONAL - bearing, stride, unique_key, track):
         [{
             'latitude': 45.0,
             'longitude': -110.0,
@@ -136,38 +288,93 @@ def help_response():
             'stride': 500.0,
             'unique_key': 'bar'
         }, ...]
+
+        STREAMING (Content-Type: application/x-ndjson):
+        POST one JSON object per line (same fields as above) and results
+        stream back one JSON object per line, in the same order
+        (keep each track's points together in the stream). The response
+        status is sent before the work is done: a call that fails partway
+        (e.g. a malformed line or a split up track) still answers 200 but
+        ends with an {"error": ..., "points_done": ...} line, after the
+        results of the points_done points before it
+
+        PROFILING (if the server runs with --allow-profiling):
+        add profile=1 (or profile=cprofile) to the query string, or send an
+        X-Groundhog-Profile header, to get a timing breakdown of the call as
+        JSON in the X-Groundhog-Trace response header (not for streaming calls)
+
+        COLUMNAR (Content-Type: application/x-npz):
+        POST a numpy .npz with latitude and longitude arrays (optional:
+        bearing, stride, unique_key, track, time) and get back an .npz with
+        elevation, slope and bearing arrays (NaN where unknown), plus the
+        unique_key and track arrays if they were sent
+
+        DECIMATION (for dense tracks, e.g. 1 Hz GPS):
+        add decimate_meters=30 and/or decimate_seconds=10 to the query string
+        to only look up the first point of every 30 meters (along the track)
+        and/or 10 seconds of each track. The other points get elevations
+        interpolated between those points and their slopes copied. Seconds
+        are taken from each point's optional time field (a number of seconds)
+
+        RASTERS (terrain of a whole area):
+        GET /groundhog/raster?bbox=42.1,-89.9,42.3,-89.6 - an .npz with a
+            little-endian int16 elevation grid (-32768 where unknown, rows north to south) and
+            the latitude/longitude of its rows/columns, sliced straight out of
+            the SRTM tiles. Optional: resolution=30 (arc-seconds, default the
+            SRTM cells), layers=elevation,slope,aspect (float32 grids, slope in
+            meters/meter, aspect the compass direction a slope faces downhill),
+            fill_voids=0 to leave voids unfilled
+
+        ROUTES (elevation profile along a polyline):
+        POST /groundhog/route?interval=50 - the polyline's vertices as JSON
+            records with latitude and longitude (as for /groundhog) or as an
+            .npz of latitude and longitude arrays. The route is sampled every
+            interval meters (default 100) along the great circles between its
+            vertices, and distance (meters along the route), latitude,
+            longitude, elevation, grade (rise over run from the previous
+            sample) and climb/descent (meters gained/lost since the start)
+            come back as JSON arrays (or an .npz if an .npz was posted).
+            Optional: fill_voids=0 to leave voids unfilled
+
+        JOBS (for batches too big for one request, if the server runs with --job-dir):
+        POST /groundhog/jobs - JSON or NDJSON payload as above (keep each
+            track's points together), returns a job_id
+        GET /groundhog/jobs/<job_id> - status (queued, running, done, failed)
+            and points_done so far
+        GET /groundhog/jobs/<job_id>/result?offset=0&limit=100000 - NDJSON
+            results of a done job, offset and limit (optional) fetch them in chunks
+        DELETE /groundhog/jobs/<job_id> - drop the job and its results
         </xmp>
     """
     return help_message
 
 
-def make_json_response(data_list):
+def make_json_response(batch):
     """
-    Takes a dictionary response and converts it to a JSON object for web return
+    Takes a batch of results and converts it to a JSON object for web return
     """
-    results = []
-    # Parse the list of data returns
-    if data_list is not None:
-        for data_dict in data_list:
-            result = deepcopy(data_dict)
-            lat = float(result['latitude'])
-            lon = float(result['longitude'])
-            result.pop('latitude', None)
-            result.pop('longitude', None)
-            result['geo_point'] = {'lat': lat, 'lon': lon}
-            results.append(result)
+    with metrics.SERIALIZE_SECONDS.time():
+        results = []
+        if batch is not None:
+            results = batch.to_dicts()
 
-    # Some versions of flask don't like jsonify
-    # https://stackoverflow.com/questions/12435297/how-do-i-jsonify-a-list-in-flask
-    return Response(json.dumps(results), mimetype='application/json')
+        # Some versions of flask don't like jsonify
+        # https://stackoverflow.com/questions/12435297/how-do-i-jsonify-a-list-in-flask
+        return Response(json.dumps(results), mimetype='application/json')
 
 
 def json_to_headings(json_coords):
     """
-    Converts an uploaded csv file to a list of coordinate objects
+    Converts an uploaded JSON list of coordinates into a HeadingBatch
     """
     assert isinstance(json_coords, list)
-    coords = []
+    latitudes = []
+    longitudes = []
+    bearings = []
+    strides = []
+    unique_keys = []
+    tracks = []
+    times = []
     for coord in json_coords:
         # lat and lon are required (get method is safe so no need for trys)
         latitude = coord.get("latitude")
@@ -183,23 +390,24 @@ def json_to_headings(json_coords):
                 logger.error("Problem in latitude/longitude info in JSON.")
                 raise KeyError
         try:
-            latitude = float(latitude)
-            longitude = float(longitude)
+            latitudes.append(float(latitude))
+            longitudes.append(float(longitude))
         except ValueError:
             logger.error("Problem in parsing latitude/longitude given as float.")
             raise ValueError
-        if coord.get("bearing") is not None:
-            bearing = float(coord.get("bearing"))
-        else:
-            bearing = None
-        if coord.get("stride") is not None:
-            stride = float(coord.get("stride"))
-        else:
-            stride = DEFAULT_STRIDE
-        unique_key = coord.get("unique_key")
         # Bearing and unique_key aren't required
-        coords.append(Heading(latitude, longitude, bearing=bearing, stride=stride, unique_key=unique_key))
-    return coords
+        bearing = coord.get("bearing")
+        bearings.append(np.nan if bearing is None else float(bearing))
+        stride = coord.get("stride")
+        strides.append(DEFAULT_STRIDE if stride is None else float(stride))
+        unique_keys.append(coord.get("unique_key"))
+        tracks.append(coord.get("track"))
+        point_time = coord.get("time")
+        times.append(np.nan if point_time is None else float(point_time))
+    if all(track is None for track in tracks):
+        tracks = None
+    return HeadingBatch(latitudes, longitudes, bearing=bearings, stride=strides, unique_key=unique_keys,
+                        track=tracks, time=times)
 
 
 def rest_to_heading(params):
@@ -223,39 +431,188 @@ def rest_to_heading(params):
     if (latitude is None) or (longitude is None):
         logger.error("Required latitude, longitude not given.")
         return None
-    return [Heading(latitude, longitude, bearing=bearing, stride=stride)]
+    return HeadingBatch([latitude], [longitude], bearing=[np.nan if bearing is None else bearing], stride=[stride])
 
 
-def from_heading(heading):
-    elevation, slope = srtm_methods.slope_from_coord_bearing(heading.longitude,
-                                                             heading.latitude,
-                                                             heading.bearing,
-                                                             stride_length=heading.stride)
-    return elevation, slope
+def array_to_list(values, as_int=False):
+    """
+    Converts a numpy array from the batch engine into a JSON friendly list (NaN becomes None)
+    """
+    cast = int if as_int else float
+    return [None if value != value else cast(value) for value in values.tolist()]
 
 
-def from_heading_list(heading_list):
-    # TODO: this is really hamfisted
-    if heading_list[0].stride is not None:
-        stride_length = heading_list[0].stride
-    else:
-        stride_length = DEFAULT_STRIDE
-    bearing_list = None  # In case we don't need it
-    coord_list = []
-    # If bearings are given:
-    if heading_list[0].bearing is not None:
-        elevation_list = []
-        slope_list = []
-        for heading in heading_list:
-            this_elevation, this_slope = from_heading(heading)
-            elevation_list.append(this_elevation)
-            slope_list.append(this_slope)
+def slope_chunk(chunk):
+    """
+    Pool worker: runs one chunk of points through the batch engine
+    """
+    longitudes, latitudes, bearings, strides = chunk
+    return srtm_methods.slope_from_coord_bearing_batch(longitudes, latitudes, bearings, stride_length=strides)
+
+
+def split_by_tile(longitudes, latitudes, chunk_size):
+    """
+    Orders points by SRTM tile and cuts them into chunks so each worker touches few tiles
+    :return: (list[np.ndarray]) indices of the points in each chunk
+    """
+    order = np.lexsort((np.floor(longitudes), np.floor(latitudes)))
+    return [order[i:i + chunk_size] for i in range(0, order.size, chunk_size)]
+
+
+def pooled_slope_from_coord_bearing(longitudes, latitudes, bearings, strides):
+    """
+    Same as srtm_methods.slope_from_coord_bearing_batch, but big batches are sharded
+    across the multiprocessing pool and reassembled in the original order
+    """
+    pool = flask_app.config["pool"]
+    if (pool is None) or (longitudes.size < flask_app.config["POOL_MIN_POINTS"]):
+        return srtm_methods.slope_from_coord_bearing_batch(longitudes, latitudes, bearings, stride_length=strides)
+
+    strides = np.broadcast_to(np.asarray(strides, dtype=float), longitudes.shape)
+    chunks = split_by_tile(longitudes, latitudes, flask_app.config["POOL_CHUNK_SIZE"])
+    logger.info("Sharding " + str(longitudes.size) + " points into " + str(len(chunks)) + " chunks.")
+    results = pool.map(slope_chunk, [(longitudes[chunk], latitudes[chunk], bearings[chunk], strides[chunk])
+                                     for chunk in chunks])
+    elevations = np.empty(longitudes.shape)
+    slopes = np.empty(longitudes.shape)
+    for chunk, (chunk_elevations, chunk_slopes) in zip(chunks, results):
+        elevations[chunk] = chunk_elevations
+        slopes[chunk] = chunk_slopes
+    return elevations, slopes
+
+
+def get_decimation():
+    """
+    Decimation thresholds for the current call: the decimate_meters and decimate_seconds
+    request parameters, or the server's defaults (e.g. in job runners)
+    returns (float, float) meters and seconds, 0 where points aren't grouped that way
+    raises ValueError for parameters that aren't a number of meters/seconds
+    """
+    meters = flask_app.config["DECIMATE_METERS"]
+    seconds = flask_app.config["DECIMATE_SECONDS"]
+    if has_request_context():
+        try:
+            meters = float(request.args.get("decimate_meters", meters))
+            seconds = float(request.args.get("decimate_seconds", seconds))
+        except ValueError:
+            raise ValueError("decimate_meters and decimate_seconds are numbers of meters and seconds")
+        if not (np.isfinite(meters) and np.isfinite(seconds) and (meters >= 0) and (seconds >= 0)):
+            raise ValueError("decimate_meters and decimate_seconds must be finite and not negative (0 for none)")
+    return meters, seconds
+
+
+def from_arrays(longitudes, latitudes, bearings, strides, tracks=None, times=None):
+    """
+    Runs columns of coordinates through the batch planner and the vectorized batch engine
+    longitudes, latitudes (np.ndarray) - coordinates
+    bearings (np.ndarray) - compass bearings (NaN where unknown, those are inferred from the next point)
+                            or None to infer them all
+    strides (np.ndarray or float) - stride lengths in meters
+    tracks (np.ndarray) - integer track codes, bearings are only inferred within a track (None for one track)
+    times (np.ndarray) - timestamps in seconds (NaN where unknown) for decimation by time, or None
+    returns (np.ndarray) elevations, slopes and bearings (given or inferred)
+    """
+    if bearings is None:
+        bearings = np.full(longitudes.shape, np.nan)
+    if (times is not None) and np.isnan(times).all():
+        times = None
+    meters, seconds = get_decimation()
+    metrics.POINTS.inc(longitudes.size)
+    with metrics.ENGINE_SECONDS.time():
+        if (meters > 0) or ((seconds > 0) and (times is not None)):
+            # Dense tracks: only look up a point every so many meters/seconds and fill in the rest
+            return srtm_methods.decimated_slope_batch(longitudes, latitudes, bearings, strides, tracks=tracks,
+                                                      times=times, min_distance=meters, min_seconds=seconds,
+                                                      kernel=pooled_slope_from_coord_bearing)
+        return srtm_methods.slope_from_mixed_batch(longitudes, latitudes, bearings, strides, tracks=tracks,
+                                                   kernel=pooled_slope_from_coord_bearing)
+
+
+def from_heading_batch(batch):
+    """
+    Runs a batch through the vectorized batch engine and fills in its elevation and slope columns.
+    Points without a bearing get one inferred from the next point of their track, which is filled in too.
+    """
+    batch.elevation, batch.slope, batch.bearing = from_arrays(batch.longitude, batch.latitude, batch.bearing,
+                                                              batch.stride, tracks=batch.track_codes(),
+                                                              times=batch.time)
+    return batch
+
+
+def from_single_heading(batch):
+    """
+    Looks up a lone point the way the original scalar API did, with a single kernel call: without
+    a bearing it only gets the raw SRTM elevation (None on a void, nothing is filled in)
+    """
+    metrics.POINTS.inc(1)
+    with metrics.ENGINE_SECONDS.time():
+        batch.elevation, batch.slope = srtm_methods.slope_from_coord_bearing_batch(batch.longitude, batch.latitude,
+                                                                                   batch.bearing,
+                                                                                   stride_length=batch.stride)
+    return batch
+
+
+def npz_to_arrays(npz_bytes):
+    """
+    Reads an uploaded .npz of columns (latitude, longitude and optionally bearing, stride, unique_key, track, time)
+    raises ValueError when the upload isn't an .npz of equally long columns with a latitude and a longitude
+    """
+    try:
+        columns = np.load(io.BytesIO(npz_bytes), allow_pickle=False)
+        if not isinstance(columns, np.lib.npyio.NpzFile):
+            raise ValueError("not an .npz")
+        columns = {name: columns[name] for name in columns.files}
+    except (ValueError, OSError, EOFError, zipfile.BadZipFile) as e:
+        raise ValueError("Post a numpy .npz of columns (" + str(e) + ")")
+    if ("latitude" not in columns) or ("longitude" not in columns):
+        logger.error("Problem in latitude/longitude columns in npz.")
+        raise ValueError("The .npz needs latitude and longitude columns")
+    size = columns["latitude"].size
+    for name in NPZ_COLUMNS:
+        if (name in columns) and ((columns[name].ndim != 1) or (columns[name].size != size)):
+            raise ValueError("Every column of the .npz needs one value per point (" + name + " has " +
+                             str(columns[name].shape) + " for " + str(size) + " points)")
+    try:
+        latitudes = np.asarray(columns["latitude"], dtype=float)
+        longitudes = np.asarray(columns["longitude"], dtype=float)
+        bearings = np.asarray(columns["bearing"], dtype=float) if "bearing" in columns else None
+        strides = np.asarray(columns["stride"], dtype=float) if "stride" in columns else DEFAULT_STRIDE
+        times = np.asarray(columns["time"], dtype=float) if "time" in columns else None
+    except (ValueError, TypeError):
+        raise ValueError("latitude, longitude, bearing, stride and time columns have to be numbers")
+    longitudes = np.where(longitudes > 180.0, longitudes - 360.0, longitudes)
+    unique_keys = columns.get("unique_key")
+    tracks = columns.get("track")
+    return latitudes, longitudes, bearings, strides, unique_keys, tracks, times
+
+
+def groundhog_npz_request(request):
+    """
+    Supports a columnar groundhog call: columns go straight to the batch engine and the
+    results come back as an .npz of elevation, slope and bearing (NaN where unknown),
+    along with the unique_key and track columns if they were sent
+    """
+    logger.info("Groundhog has been summoned (npz).")
+    with metrics.PARSE_SECONDS.time():
+        latitudes, longitudes, bearings, strides, unique_keys, tracks, times = npz_to_arrays(request.get_data())
+    track_codes = None if tracks is None else np.unique(tracks, return_inverse=True)[1].reshape(-1)
+    logger.info("Received " + str(latitudes.size) + " coordinates to fetch.")
+    metrics.REQUEST_POINTS.observe(latitudes.size)
+    results = {}
+    if latitudes.size > 0:
+        results["elevation"], results["slope"], results["bearing"] = from_arrays(longitudes, latitudes,
+                                                                                bearings, strides,
+                                                                                tracks=track_codes, times=times)
     else:
-        for heading in heading_list:
-            coord_list.append((heading.longitude, heading.latitude))
-        elevation_list, slope_list, bearing_list = srtm_methods.slope_from_coords_only(coord_list,
-                                                                                       stride_length=stride_length)
-    return elevation_list, slope_list, bearing_list
+        results["elevation"] = results["slope"] = results["bearing"] = np.empty(0)
+    if unique_keys is not None:
+        results["unique_key"] = unique_keys
+    if tracks is not None:
+        results["track"] = tracks
+    with metrics.SERIALIZE_SECONDS.time():
+        npz_buffer = io.BytesIO()
+        np.savez(npz_buffer, **results)
+        return npz_buffer.getvalue()
 
 
 def groundhog_request(request):
@@ -268,39 +625,396 @@ def groundhog_request(request):
     # Get a list of coordinates from the REST call
     if request.method == 'POST':
         try:
-            json_payload = request.get_json()
+            with metrics.PARSE_SECONDS.time():
+                json_payload = request.get_json()
         except TypeError:
             logger.error("Problem in POST request.")
             return None
         logger.info("Coordinates posted as JSON...")
-        headings = json_to_headings(json_payload)
+        with metrics.HEADINGS_SECONDS.time():
+            headings = json_to_headings(json_payload)
     else:
         headings = rest_to_heading(params)
+        if headings is None:
+            return None
 
     # Curate coordinates from the REST call
     logger.info("Received " + str(len(headings)) + " coordinates to fetch.")
-
-    # If it's a single heading assume you got a bearing, throw an error if not
-    response_list = []
-    response_part = headings[0].to_dict()
+    metrics.REQUEST_POINTS.observe(len(headings))
+    if len(headings) == 0:
+        return headings
     if len(headings) == 1:
-        elevation, slope = from_heading(headings[0])
-        response_part["elevation"] = elevation
-        response_part["slope"] = slope
-        response_list.append(response_part)
-        # logger.info("elevation: {}".format(elevation))
-        # logger.info("slope {}".format(slope))
-    # If it's a list can use one of two methods, prefer given bearings
+        return from_single_heading(headings)
+    return from_heading_batch(headings)
+
+
+def iter_ndjson_records(stream):
+    """
+    Incrementally parses newline delimited JSON
+    :return: generator of decoded records
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        yield json.loads(line)
+
+
+def iter_json_list_records(stream, read_size=JOB_READ_BYTES):
+    """
+    Incrementally parses a JSON list, only holding read_size bytes of it and the record being decoded
+    :return: generator of decoded records
+    raises ValueError when the upload isn't a (complete) JSON list
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    text, position, end_of_stream = "", 0, False
+    expected = "["  # then a record (or "]"), then "," or "]" after each record
+    while True:
+        # Skip whitespace, reading on when the text runs out (or a record might go on past it)
+        position = WHITESPACE.match(text, position).end()
+        if (position == len(text)) and not end_of_stream:
+            chunk = stream.read(read_size)
+            end_of_stream = not chunk
+            text, position = text[position:] + decode(chunk, final=end_of_stream), 0
+            continue
+        if position == len(text):
+            if expected is None:
+                return
+            raise ValueError("The JSON list ends early")
+        if expected is None:
+            raise ValueError("Unexpected data after the JSON list")
+        character = text[position]
+        if expected == "[":
+            if character != "[":
+                raise ValueError("Jobs take a JSON list of records")
+            position, expected = position + 1, "record or ]"
+        elif (character == "]") and (expected != "record"):
+            position, expected = position + 1, None
+        elif expected == ", or ]":
+            if character != ",":
+                raise ValueError("Expecting , or ] between the records of the JSON list")
+            position, expected = position + 1, "record"
+        else:
+            try:
+                record, end = decoder.raw_decode(text, position)
+            except ValueError:
+                if end_of_stream or (len(text) - position > max(read_size, JOB_MAX_RECORD_CHARS)):
+                    raise
+                end = None
+            if (end is None) or ((end == len(text)) and not end_of_stream):
+                chunk = stream.read(read_size)  # the record goes on in the next read
+                end_of_stream = not chunk
+                text, position = text[position:] + decode(chunk, final=end_of_stream), 0
+                continue
+            yield record
+            position, expected = end, ", or ]"
+
+
+def iter_windows(records, window_size):
+    """
+    :return: generator of lists of at most window_size records
+    """
+    window = []
+    start = time.perf_counter()  # pulling records is where uploads get decoded
+    for record in records:
+        window.append(record)
+        if len(window) >= window_size:
+            metrics.PARSE_SECONDS.observe(time.perf_counter() - start)
+            yield window
+            window = []
+            start = time.perf_counter()
+    if window:
+        metrics.PARSE_SECONDS.observe(time.perf_counter() - start)
+        yield window
+
+
+def ndjson_lines(batch):
+    """
+    Serializes a batch of results as NDJSON
+    """
+    with metrics.SERIALIZE_SECONDS.time():
+        return "".join(json.dumps(response_part) + "\n" for response_part in batch.to_dicts())
+
+
+def check_track_order(batch, last_track, finished_tracks):
+    """
+    Windows only hold back their last point for the next window, so each track's points have to come
+    together: a track that comes back after another one started would get results that depend on the windows
+    last_track - track of the previous window's last point
+    finished_tracks (set) - tracks followed by another one so far, updated in place
+    returns the track of the batch's last point
+    raises ValueError when a finished track comes back
+    """
+    tracks = batch.track if batch.track is not None else [None] * len(batch)
+    for track in tracks:
+        if track == last_track:
+            continue
+        if track in finished_tracks:
+            raise ValueError("Points of track " + str(track) + " are split up, keep each track's points together")
+        finished_tracks.add(last_track)
+        last_track = track
+    return last_track
+
+
+def iter_result_batches(windows):
+    """
+    Processes windows of JSON records one after the other (each track's points have to come together)
+    :return: generator of result batches, together in the same order as the records
+    """
+    carry = None  # a window's last point waits for its successor if it needs a bearing inferred
+    last_track = object()  # no track yet (None is the track of points that don't name one)
+    finished_tracks = set()
+    for records in windows:
+        with metrics.HEADINGS_SECONDS.time():
+            headings = json_to_headings(records)
+        last_track = check_track_order(headings, last_track, finished_tracks)
+        if carry is not None:
+            headings = HeadingBatch.concatenate([carry, headings])
+        hold_back = bool(np.isnan(headings.bearing[-1]))
+        carry = headings.select(slice(-1, None)) if hold_back else None
+        headings = from_heading_batch(headings)
+        if hold_back:
+            headings = headings.select(slice(None, -1))
+        yield headings
+    if carry is not None:
+        yield from_heading_batch(carry)
+
+
+def groundhog_ndjson_request(request):
+    """
+    Supports a streaming groundhog call: the NDJSON upload is processed in bounded
+    windows and result lines are yielded as soon as each window is done.
+    The status (200) is gone with the first lines, so a call that fails partway ends
+    with an {"error": ..., "points_done": ...} line instead of a result
+    """
+    logger.info("Groundhog has been summoned (streaming).")
+    window_size = flask_app.config["NDJSON_WINDOW_SIZE"]
+    start = time.perf_counter()
+    num_points = 0
+    try:
+        for headings in iter_result_batches(iter_windows(iter_ndjson_records(request.stream), window_size)):
+            num_points += len(headings)
+            yield ndjson_lines(headings)
+    except Exception as e:
+        logger.exception("Streaming call failed after " + str(num_points) + " coordinates.")
+        message = (isinstance(e, ValueError) and str(e)) or "Could not process the points after the first " + \
+            str(num_points)
+        yield json.dumps({"error": message, "points_done": num_points}) + "\n"
+        return
+    logger.info("Streamed " + str(num_points) + " coordinates.")
+    metrics.REQUEST_POINTS.observe(num_points)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start)
+
+
+def process_job_input(input_file, mimetype):
+    """
+    Works through a job's spilled upload (a JSON list or NDJSON) window by window
+    :return: generator of (NDJSON result text, number of points) pieces
+    """
+    if mimetype == NDJSON_MIMETYPE:
+        records = iter_ndjson_records(input_file)
     else:
-        elevation_list, slope_list, bearing_list = from_heading_list(headings)
-        for i in range(len(headings)):
-            response_part = headings[i].to_dict()
-            response_part["elevation"] = elevation_list[i]
-            response_part["slope"] = slope_list[i]
-            if response_part.get("bearing") is None:
-                response_part["bearing"] = bearing_list[i]
-            response_list.append(response_part)
-    return response_list
+        records = iter_json_list_records(input_file)
+    for headings in iter_result_batches(iter_windows(records, flask_app.config["NDJSON_WINDOW_SIZE"])):
+        yield ndjson_lines(headings), len(headings)
+
+
+def raster_request(params):
+    """
+    Supports a raster call: the terrain of a bounding box as grids sliced out of the tiles
+    params (obj) - bbox (south,west,north,east), resolution (arc-seconds, optional),
+                   layers (comma separated, elevation is always included), fill_voids (0 or 1)
+    returns (bytes) an .npz of the grids and the latitude/longitude of their rows/columns
+    raises ValueError for bad parameters
+    """
+    try:
+        south, west, north, east = [float(value) for value in params.get("bbox", "").split(",")]
+        resolution = params.get("resolution")
+        resolution = None if resolution is None else float(resolution) / 3600.0
+    except ValueError:
+        raise ValueError("bbox is south,west,north,east in degrees and resolution is in arc-seconds")
+    if not ((-90 <= south < north <= 90) and (-180 <= west < east <= 180)):
+        raise ValueError("bbox is south,west,north,east in degrees, south of north and west of east")
+    if (resolution is not None) and (resolution <= 0):
+        raise ValueError("resolution must be positive")
+    layers = params.get("layers", "elevation").split(",")
+    unknown = [layer for layer in layers if layer not in RASTER_LAYERS]
+    if unknown:
+        raise ValueError("Unknown layers " + ",".join(unknown) + " (choose from " + ",".join(RASTER_LAYERS) + ")")
+    if resolution is None:
+        resolution = srtm_methods.get_native_resolution(north - 1e-9, west)
+    num_cells = ((north - south) / resolution + 1) * ((east - west) / resolution + 1)
+    if num_cells > flask_app.config["RASTER_MAX_CELLS"]:
+        raise ValueError("Grid of ~" + str(int(num_cells)) + " cells is over the limit of " +
+                         str(flask_app.config["RASTER_MAX_CELLS"]) + ", use a smaller bbox or a coarser resolution")
+    fill_radius = srtm_methods.void_fill_radius() if params.get("fill_voids", "1") != "0" else None
+
+    logger.info("Raster of " + str(int(num_cells)) + " cells for " + params.get("bbox"))
+    with metrics.ENGINE_SECONDS.time():
+        grid = srtm_methods.get_terrain_grid(south, west, north, east, resolution=resolution,
+                                             slope="slope" in layers, aspect="aspect" in layers,
+                                             fill_radius=fill_radius)
+    with metrics.SERIALIZE_SECONDS.time():
+        # Views of a tile keep its big-endian byte order, clients always get little-endian int16
+        grid["elevation"] = grid["elevation"].astype("<i2", copy=False)
+        npz_buffer = io.BytesIO()
+        np.savez(npz_buffer, **grid)
+        return npz_buffer.getvalue()
+
+
+def route_request(request):
+    """
+    Supports a route call: an elevation profile sampled along a polyline
+    params (obj) - interval (meters between samples, optional), fill_voids (0 or 1)
+    returns (dict) the profile's columns (see srtm_methods.route_profile)
+    raises ValueError for bad parameters
+    """
+    with metrics.PARSE_SECONDS.time():
+        if request.mimetype == NPZ_MIMETYPE:
+            latitudes, longitudes = npz_to_arrays(request.get_data())[:2]
+        else:
+            records = request.get_json(silent=True)
+            if not isinstance(records, list):
+                raise ValueError("Post the route as a JSON list of records with latitude and longitude")
+            try:
+                latitudes = np.array([record["latitude"] for record in records], dtype=float)
+                longitudes = np.array([record["longitude"] for record in records], dtype=float)
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("Every point of the route needs a numeric latitude and longitude")
+            longitudes = np.where(longitudes > 180.0, longitudes - 360.0, longitudes)
+    try:
+        interval = float(request.args.get("interval", DEFAULT_ROUTE_INTERVAL))
+    except ValueError:
+        raise ValueError("interval is in meters")
+    if not interval > 0:
+        raise ValueError("interval must be positive")
+    if latitudes.size == 0:
+        raise ValueError("A route needs at least one point")
+    if not (np.isfinite(latitudes).all() and np.isfinite(longitudes).all()):
+        raise ValueError("Every point of the route needs a latitude and longitude")
+    length = srtm_methods.haversine_batch(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]).sum()
+    num_samples = length / interval + 2
+    if num_samples > flask_app.config["ROUTE_MAX_SAMPLES"]:
+        raise ValueError("Route of " + str(int(length)) + " meters needs ~" + str(int(num_samples)) +
+                         " samples, over the limit of " + str(flask_app.config["ROUTE_MAX_SAMPLES"]) +
+                         ", use a longer interval")
+    fill_radius = srtm_methods.void_fill_radius() if request.args.get("fill_voids", "1") != "0" else None
+
+    logger.info("Route of " + str(latitudes.size) + " points and " + str(int(length)) + " meters, sampled every " +
+                str(interval) + " meters")
+    metrics.REQUEST_POINTS.observe(int(num_samples))
+    with metrics.ENGINE_SECONDS.time():
+        return srtm_methods.route_profile(longitudes, latitudes, interval, fill_radius=fill_radius)
+
+
+def make_route_response(profile, as_npz=False):
+    """
+    Encodes a route profile as an .npz or as a JSON object of columns (NaN becomes null)
+    """
+    with metrics.SERIALIZE_SECONDS.time():
+        if as_npz:
+            npz_buffer = io.BytesIO()
+            np.savez(npz_buffer, **profile)
+            return Response(npz_buffer.getvalue(), mimetype=NPZ_MIMETYPE)
+        columns = {column: array_to_list(profile[column], as_int=column == "elevation") for column in ROUTE_COLUMNS}
+        return Response(json.dumps(columns), mimetype='application/json')
+
+
+def run_job_queue(poll_interval):
+    """
+    Job runner process: works through queued jobs at a lower CPU priority than the server
+    """
+    flask_app.config["pool"] = None  # a pool doesn't survive the fork, the runners are the parallelism here
+    flask_app.config["job_queue"].run_forever(poll_interval=poll_interval, niceness=JOB_RUNNER_NICENESS)
+
+
+def job_status_response(status, code=200):
+    return Response(json.dumps({key: value for key, value in status.items() if key != "windows"}),
+                    status=code, mimetype='application/json')
+
+
+def not_found_response():
+    return Response(json.dumps({"error": "no such job"}), status=404, mimetype='application/json')
+
+
+def bad_request_response(message):
+    return Response(json.dumps({"error": message}), status=400, mimetype='application/json')
+
+
+def no_job_queue_response():
+    return Response(json.dumps({"error": "jobs are not enabled on this server (no job queue configured)"}),
+                    status=503, mimetype='application/json')
+
+
+def groundhog_response(request):
+    """
+    Answers a JSON, REST or npz groundhog call
+    """
+    with metrics.REQUEST_SECONDS.time():
+        if (request.method == 'POST') and (request.mimetype == NPZ_MIMETYPE):
+            try:
+                return Response(groundhog_npz_request(request), mimetype=NPZ_MIMETYPE)
+            except ValueError as e:
+                return bad_request_response(str(e))
+        batch = groundhog_request(request)
+        return make_json_response(batch)
+
+
+def requested_profile(request):
+    """
+    What a request asked to be traced with (?profile= or the X-Groundhog-Profile header)
+    returns (str) "trace", "cprofile" or None when it didn't ask or the server doesn't allow it
+    """
+    profile = request.args.get("profile") or request.headers.get("X-Groundhog-Profile")
+    if (not profile) or (profile.lower() in ("0", "false", "no")):
+        return None
+    if not flask_app.config["ALLOW_PROFILING"]:
+        logger.warning("Ignoring profiling request, start the server with --allow-profiling to allow it.")
+        return None
+    return "cprofile" if profile.lower() == "cprofile" else "trace"
+
+
+def profile_stats(profiler, limit=PROFILE_TOP_FUNCTIONS):
+    """
+    The functions a profile spent the most (cumulative) time in
+    returns (list) [function, calls, own ms, cumulative ms] rows
+    """
+    rows = sorted(pstats.Stats(profiler).stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [[os.path.basename(file_name) + ":" + str(line) + "(" + function + ")", calls,
+             round(own_time * 1000.0, 3), round(cumulative_time * 1000.0, 3)]
+            for (file_name, line, function), (_, calls, own_time, cumulative_time, _) in rows]
+
+
+def profiled_response(request, profile):
+    """
+    Answers a groundhog call while tracing it: phase timings, tiles loaded and touched, void lookups
+    (and with cProfile, the slowest functions) go back as JSON in the X-Groundhog-Trace header.
+    Only the thread serving this request is traced, other requests are unaffected.
+    NOTE: work sharded out to the multiprocessing pool only shows up as engine time
+    """
+    trace = metrics.start_trace()
+    profiler = None
+    if (profile == "cprofile") and profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        response = groundhog_response(request)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler_lock.release()
+        metrics.stop_trace()
+    trace_info = trace.to_dict()
+    if profiler is not None:
+        trace_info["profile"] = profile_stats(profiler)
+    elif profile == "cprofile":
+        trace_info["profile"] = "busy"  # another request is being profiled
+    response.headers[TRACE_HEADER] = json.dumps(trace_info, separators=(",", ":"))
+    return response
 
 
 # Define Flask options
@@ -311,6 +1025,12 @@ def health_check():
     return make_health_check()
 
 
+# Prometheus metrics for the whole server
+@flask_app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 # Give help
 @flask_app.route("/")
 def do_none_help():
@@ -328,8 +1048,92 @@ def do_help_message():
 @flask_app.route("/groundhog", methods=['GET', 'POST'])
 def groundhog():
     logger.info("Received /groundhog request from: " + request.remote_addr)
-    data_list = groundhog_request(request)
-    return make_json_response(data_list)
+    metrics.REQUESTS.inc()
+    try:
+        get_decimation()  # checked up front, a streamed response can't turn into a 400 later on
+    except ValueError as e:
+        return bad_request_response(str(e))
+    if (request.method == 'POST') and (request.mimetype == NDJSON_MIMETYPE):
+        # Timed as it streams (headers are gone before the work starts, so it can't be traced)
+        return Response(stream_with_context(groundhog_ndjson_request(request)), mimetype=NDJSON_MIMETYPE)
+    profile = requested_profile(request)
+    if profile is not None:
+        return profiled_response(request, profile)
+    return groundhog_response(request)
+
+
+# Grids of a whole area
+@flask_app.route("/groundhog/raster")
+def groundhog_raster():
+    logger.info("Received /groundhog/raster request from: " + request.remote_addr)
+    metrics.REQUESTS.inc()
+    with metrics.REQUEST_SECONDS.time():
+        try:
+            return Response(raster_request(request.args), mimetype=NPZ_MIMETYPE)
+        except ValueError as e:
+            return bad_request_response(str(e))
+
+
+# Elevation profile along a route
+@flask_app.route("/groundhog/route", methods=['POST'])
+def groundhog_route():
+    logger.info("Received /groundhog/route request from: " + request.remote_addr)
+    metrics.REQUESTS.inc()
+    with metrics.REQUEST_SECONDS.time():
+        try:
+            profile = route_request(request)
+        except (ValueError, KeyError) as e:
+            return bad_request_response(str(e) or "Post the route's latitude and longitude")
+        return make_route_response(profile, as_npz=request.mimetype == NPZ_MIMETYPE)
+
+
+# Asynchronous jobs for very large batches
+@flask_app.route("/groundhog/jobs", methods=['POST'])
+def submit_job():
+    logger.info("Received /groundhog/jobs request from: " + request.remote_addr)
+    if flask_app.config["job_queue"] is None:
+        return no_job_queue_response()
+    if request.mimetype not in JOB_MIMETYPES:
+        return bad_request_response("Jobs take " + " or ".join(JOB_MIMETYPES) + " payloads, not " +
+                                    (request.mimetype or "no Content-Type"))
+    status = flask_app.config["job_queue"].submit(request.stream, request.mimetype)
+    return job_status_response(status, code=202)
+
+
+@flask_app.route("/groundhog/jobs/<job_id>", methods=['GET', 'DELETE'])
+def job_status(job_id):
+    job_queue = flask_app.config["job_queue"]
+    if job_queue is None:
+        return no_job_queue_response()
+    if request.method == 'DELETE':
+        if not job_queue.delete(job_id):
+            return not_found_response()
+        return Response(json.dumps({"job_id": job_id, "status": "deleted"}), mimetype='application/json')
+    status = job_queue.read_status(job_id)
+    if status is None:
+        return not_found_response()
+    return job_status_response(status)
+
+
+@flask_app.route("/groundhog/jobs/<job_id>/result")
+def job_result(job_id):
+    job_queue = flask_app.config["job_queue"]
+    if job_queue is None:
+        return no_job_queue_response()
+    status = job_queue.read_status(job_id)
+    if status is None:
+        return not_found_response()
+    if status["status"] != "done":
+        return job_status_response(status, code=409)
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = request.args.get("limit")
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        return bad_request_response("offset and limit are numbers of results")
+    if (offset < 0) or ((limit is not None) and (limit < 0)):
+        return bad_request_response("offset and limit can't be negative")
+    return Response(job_queue.iter_results(job_id, offset=offset, limit=limit), mimetype=NDJSON_MIMETYPE)
 
 
 if __name__ == "__main__":
@@ -342,10 +1146,45 @@ if __name__ == "__main__":
     else:
         logger.setLevel("INFO")  # Set the logging level to normal
 
-    pool = mp.Pool()  # Instantiate a pool object
-    flask_app.config["pool"] = mp.pool.Pool()
+    if (args.tile_dir is not None) or (args.tile_cache_mb is not None) or (args.tile_pack is not None):
+        cache_bytes = None if args.tile_cache_mb is None else int(args.tile_cache_mb * 2 ** 20)
+        pack = None if args.tile_pack is None else TilePack(args.tile_pack)
+        srtm_methods.tile_store = srtm_methods.HgtTileStore(tile_dir=args.tile_dir, cache_bytes=cache_bytes,
+                                                            pack=pack, fetch_missing=pack is None)
+    logger.info("Serving SRTM tiles from " + (args.tile_pack or srtm_methods.tile_store.tile_dir))
+    if args.gradient_strides:
+        srtm_methods.gradient_strides = tuple(float(stride) for stride in args.gradient_strides.split(","))
+        logger.info("Taking slopes from gradient rasters for strides " + args.gradient_strides)
+    if args.slope_cache_entries > 0:
+        srtm_methods.slope_cache = srtm_methods.SlopeCache(max_entries=args.slope_cache_entries,
+                                                           bearing_step=args.slope_cache_bearing_step)
+        logger.info("Caching up to " + str(args.slope_cache_entries) + " slopes per process")
+
     flask_app.config['MAX_CONTENT_LENGTH'] = 1000 * 1024 * 1024  # 1GB limit (this is really big)
-    flask_app.run(host="0.0.0.0", port=args.port, debug=args.debug, use_reloader=False)
+    flask_app.config["ALLOW_PROFILING"] = args.allow_profiling
+    flask_app.config["DECIMATE_METERS"] = args.decimate_meters
+    flask_app.config["DECIMATE_SECONDS"] = args.decimate_seconds
+
+    if args.job_dir is not None:
+        # Job runners fork before any pool or server so they start out clean
+        flask_app.config["job_queue"] = JobQueue(job_dir=args.job_dir, process=process_job_input)
+        for _ in range(args.job_runners):
+            mp.Process(target=run_job_queue, args=(1.0,), daemon=True).start()
+        logger.info("Spilling jobs to " + args.job_dir + " with " + str(args.job_runners) + " runners")
+
+    if args.prefork > 0:
+        # The pre-forked workers are the parallelism here, a pool wouldn't survive the fork anyway
+        server = PreforkServer(flask_app, host="0.0.0.0", port=args.port, workers=args.prefork,
+                               max_requests=args.max_requests, graceful_timeout=args.graceful_timeout,
+                               preload=srtm_methods.tile_store.preload)
+        server.serve_forever()
+    else:
+        # Workers fork from here so they inherit the tile store set up above
+        if args.workers != 1:
+            flask_app.config["pool"] = mp.Pool(processes=args.workers)
+        flask_app.config["POOL_MIN_POINTS"] = args.pool_min_points
+        flask_app.config["POOL_CHUNK_SIZE"] = args.chunk_size
+        flask_app.run(host="0.0.0.0", port=args.port, debug=args.debug, use_reloader=False)
 
     # Shut down and clean up
     logger.info("Execution time: " + str(round((time.clock() - start) * 1000, 1)) + " ms")
@@ -0,0 +1,273 @@
+"""
+A disk-backed queue for long running groundhog jobs.
+
+Every job gets its own directory under the job root holding the spilled upload, a
+status file and the NDJSON results. Everything lives on disk, so any server process
+can take a submission or answer a poll, and runner processes (see run_forever) claim
+queued jobs by atomically renaming their marker file.
+
+Job layout:
+    <job_dir>/<job_id>/input       - the upload as it was sent
+    <job_dir>/<job_id>/status.json - status, progress and a byte index into the results
+    <job_dir>/<job_id>/result      - one JSON result per line, in input order
+    <job_dir>/<job_id>/queued      - present until a runner claims the job
+    <job_dir>/<job_id>/claimed     - the pid of the runner working on the job
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger()
+
+JOB_ID_PATTERN = re.compile("^[0-9a-f]{32}$")
+COPY_BUFFER_SIZE = 2 ** 20
+
+
+class JobQueue:
+    """
+    Submits, tracks and runs jobs kept in a directory
+    """
+
+    def __init__(self, job_dir=None, process=None):
+        """
+        :param job_dir: (str) root directory for the jobs (defaults to groundhog_jobs in the temp dir)
+        :param process: (function) process(input_file, mimetype) generating (result text, number of points)
+            pieces, only needed by runners
+        """
+        self.job_dir = job_dir if job_dir is not None else os.path.join(tempfile.gettempdir(), "groundhog_jobs")
+        self.process = process
+        os.makedirs(self.job_dir, exist_ok=True)
+
+    def get_path(self, job_id, name=None):
+        """
+        Path of a job's directory (or of a file in it), None for an invalid id
+        """
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        path = os.path.join(self.job_dir, job_id)
+        return path if name is None else os.path.join(path, name)
+
+    def read_status(self, job_id):
+        """
+        :return: the job's status dictionary, None if there is no such job
+        """
+        path = self.get_path(job_id, "status.json")
+        if (path is None) or not os.path.exists(path):
+            return None
+        with open(path) as status_file:
+            return json.load(status_file)
+
+    def write_status(self, status):
+        """
+        Replaces the status file in one step, so readers never see half of it
+        """
+        path = self.get_path(status["job_id"], "status.json")
+        temp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "w") as status_file:
+            json.dump(status, status_file)
+        os.replace(temp_path, path)
+
+    def submit(self, stream, mimetype):
+        """
+        Spills an upload to disk and queues it
+        :param stream: file-like upload
+        :param mimetype: (str) how the upload is encoded
+        :return: the new job's status dictionary
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.get_path(job_id))
+        with open(self.get_path(job_id, "input"), "wb") as input_file:
+            shutil.copyfileobj(stream, input_file, COPY_BUFFER_SIZE)
+        status = {"job_id": job_id,
+                  "status": "queued",
+                  "mimetype": mimetype,
+                  "submitted": time.time(),
+                  "started": None,
+                  "finished": None,
+                  "points_done": 0,
+                  "error": None,
+                  "windows": []}  # [first point, byte offset] of every piece of the results
+        self.write_status(status)
+        open(self.get_path(job_id, "queued"), "w").close()  # last, so runners only see complete jobs
+        logger.info("Queued job " + job_id)
+        return status
+
+    def delete(self, job_id):
+        """
+        Removes a job and its results
+        :return: False if there is no such job
+        """
+        path = self.get_path(job_id)
+        if (path is None) or not os.path.isdir(path):
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def iter_results(self, job_id, offset=0, limit=None):
+        """
+        Reads a range of result lines, jumping straight to the piece holding the first one
+        :return: generator of NDJSON result lines (bytes)
+        """
+        status = self.read_status(job_id)
+        start_point, start_byte = 0, 0
+        for first_point, byte_offset in status["windows"]:
+            if first_point > offset:
+                break
+            start_point, start_byte = first_point, byte_offset
+        remaining = limit
+        with open(self.get_path(job_id, "result"), "rb") as result_file:
+            result_file.seek(start_byte)
+            for point, line in enumerate(result_file, start_point):
+                if point < offset:
+                    continue
+                if remaining is not None:
+                    if remaining <= 0:
+                        break
+                    remaining -= 1
+                yield line
+
+    def claim_next(self):
+        """
+        Claims the oldest queued job
+        :return: the job id, None if nothing is queued
+        """
+        queued = []
+        for job_id in os.listdir(self.job_dir):
+            marker = self.get_path(job_id, "queued")
+            if (marker is not None) and os.path.exists(marker):
+                try:
+                    queued.append((os.path.getmtime(marker), job_id))
+                except OSError:
+                    pass  # claimed by someone else meanwhile
+        for _, job_id in sorted(queued):
+            try:
+                # Only one runner can win the rename
+                os.rename(self.get_path(job_id, "queued"), self.get_path(job_id, "claimed"))
+            except OSError:
+                continue
+            try:
+                with open(self.get_path(job_id, "claimed"), "w") as claim_file:
+                    claim_file.write(str(os.getpid()))
+            except FileNotFoundError:
+                continue  # deleted right after it was claimed
+            return job_id
+        return None
+
+    def requeue_abandoned(self):
+        """
+        Puts jobs back in the queue when the runner that claimed them is gone (it died, or the server restarted).
+        Several runners may scan at once and jobs may be deleted meanwhile, a job that changes under a scan
+        is left to whoever got to it first.
+        """
+        for job_id in os.listdir(self.job_dir):
+            path = self.get_path(job_id, "claimed")
+            if (path is None) or not os.path.exists(path):
+                continue
+            try:
+                status = self.read_status(job_id)
+                if (status is None) or (status["status"] in ("done", "failed")):
+                    continue
+                with open(path) as claim_file:
+                    pid = claim_file.read()
+            except OSError:
+                continue  # deleted meanwhile
+            if not pid:
+                continue  # just claimed, the runner hasn't written its pid yet
+            try:
+                os.kill(int(pid), 0)
+                continue  # still being worked on
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+            # The status is reset before the job can be claimed again, so its next runner starts afresh
+            status.update({"status": "queued", "started": None, "points_done": 0, "windows": []})
+            try:
+                self.write_status(status)
+                # Only one runner can win the rename
+                os.rename(path, self.get_path(job_id, "queued"))
+            except OSError:
+                continue  # requeued by another runner or deleted meanwhile
+            logger.warning("Requeued abandoned job " + job_id)
+
+    def is_deleted(self, job_id):
+        return not os.path.isdir(self.get_path(job_id))
+
+    def run_job(self, job_id):
+        """
+        Processes a claimed job, spilling result pieces to disk and recording progress as it goes.
+        A job deleted while it runs is dropped as soon as it is noticed.
+        """
+        try:
+            status = self.read_status(job_id)
+        except FileNotFoundError:
+            status = None
+        if status is None:
+            logger.info("Job " + job_id + " was deleted before it ran")
+            return
+        try:
+            status.update({"status": "running", "started": time.time()})
+            self.write_status(status)
+            logger.info("Running job " + job_id)
+            with open(self.get_path(job_id, "input"), "rb") as input_file, \
+                    open(self.get_path(job_id, "result"), "wb") as result_file:
+                for text, num_points in self.process(input_file, status["mimetype"]):
+                    status["windows"].append([status["points_done"], result_file.tell()])
+                    result_file.write(text.encode("utf-8"))
+                    result_file.flush()
+                    status["points_done"] += num_points
+                    self.write_status(status)
+            status["status"] = "done"
+        except Exception as e:
+            if self.is_deleted(job_id):
+                logger.info("Job " + job_id + " was deleted while running")
+                return
+            logger.exception("Job " + job_id + " failed")
+            status.update({"status": "failed", "error": str(e)})
+        status["finished"] = time.time()
+        try:
+            self.write_status(status)
+        except FileNotFoundError:
+            logger.info("Job " + job_id + " was deleted while running")
+            return
+        logger.info("Job " + job_id + " " + status["status"] + " after " + str(status["points_done"]) + " points")
+
+    def run_pending(self):
+        """
+        Runs one queued job if there is one
+        :return: True if a job was run
+        """
+        job_id = self.claim_next()
+        if job_id is None:
+            return False
+        self.run_job(job_id)
+        return True
+
+    def run_forever(self, poll_interval=1.0, niceness=0, requeue_interval=30.0):
+        """
+        Runner loop, meant for a process of its own
+        :param niceness: (int) lowers the runner's CPU priority so interactive requests come first
+        :param requeue_interval: (float) seconds between looks for jobs whose runner died (see requeue_abandoned)
+        """
+        if niceness:
+            os.nice(niceness)
+        logger.info("Job runner " + str(os.getpid()) + " watching " + self.job_dir)
+        last_requeue = None
+        while True:
+            try:
+                if (last_requeue is None) or (time.time() - last_requeue >= requeue_interval):
+                    last_requeue = time.time()
+                    self.requeue_abandoned()
+                ran = self.run_pending()
+            except Exception:
+                # One bad job must not take the runner (and so the whole queue) down with it
+                logger.exception("Job runner " + str(os.getpid()) + " hit an error, carrying on")
+                ran = False
+            if not ran:
+                time.sleep(poll_interval)
@@ -0,0 +1,277 @@
+"""
+Minimal Prometheus metrics for groundhog.
+
+Metric values live in anonymous shared memory allocated when the metric is defined
+(at import), so every process forked afterwards - pre-forked workers, pool workers and
+job runners - adds to the same numbers and /metrics shows the whole server no matter
+which process answers the scrape. Each process adds to a row of its own and a scrape
+sums the rows, so updates never wait on another process (one killed mid-update can't
+hold anything up). Updates are a few additions, cheap enough to leave on in production;
+batches are counted per batch, not per point.
+"""
+
+import bisect
+import mmap
+import multiprocessing as mp
+import os
+import threading
+import time
+import numpy as np
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+ITERATION_BUCKETS = (1, 10, 100, 1000, 3000, 6000)
+MAX_PROCESSES = 256  # processes that get a row of metric values to themselves, any more share rows
+CLAIM_TIMEOUT = 1.0  # seconds a process waits to claim a row before sharing one
+traces = threading.local()  # the trace of the request a thread is working on, if it asked for one
+
+
+class RequestTrace:
+    """
+    Per-request breakdown: the metrics a request touches also add to its trace (by trace key)
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = {}
+        self.tiles_loaded = []
+        self.tiles_touched = set()
+
+    def add(self, key, value):
+        self.totals[key] = self.totals.get(key, 0) + value
+
+    def to_dict(self):
+        trace = {"total_ms": round((time.perf_counter() - self.start) * 1000.0, 3)}
+        trace.update((key, round(value, 3)) for key, value in self.totals.items())
+        trace["tiles_loaded"] = self.tiles_loaded
+        trace["tiles_touched"] = sorted(self.tiles_touched)
+        return trace
+
+
+def start_trace():
+    """
+    Starts tracing what the calling thread does
+    :return: (RequestTrace) the new trace
+    """
+    traces.current = RequestTrace()
+    return traces.current
+
+
+def stop_trace():
+    traces.current = None
+
+
+def current_trace():
+    """
+    :return: (RequestTrace) the calling thread's trace, None if it isn't tracing
+    """
+    return getattr(traces, "current", None)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """
+    Keeps metrics in the order they were defined and renders them in the Prometheus text format
+    """
+
+    def __init__(self, max_processes=MAX_PROCESSES):
+        self.metrics = []
+        self.max_processes = max_processes
+        # Process writing to each row of the values, shared with forked processes like the values
+        self.owners = np.frombuffer(mmap.mmap(-1, max_processes * 8), dtype=np.int64)
+        self.claim_lock = mp.Lock()  # only held while a process claims its row
+        self.pid = None  # process the row and lock below belong to
+        self.row = None
+        self.lock = None
+
+    def allocate(self, size):
+        """
+        :return: (np.ndarray) a row of size float64 values per process, in memory shared with forked processes
+        """
+        values = np.frombuffer(mmap.mmap(-1, self.max_processes * size * 8), dtype=np.float64)
+        return values.reshape(self.max_processes, size)
+
+    def get_row(self):
+        """
+        :return: (int, threading.Lock) the calling process's row of the values and the lock its threads update
+                 it under (both are set up again after a fork)
+        """
+        pid = os.getpid()
+        if pid != self.pid:
+            self.lock = threading.Lock()
+            self.row = self.claim_row(pid)
+            self.pid = pid
+        return self.row, self.lock
+
+    def claim_row(self, pid):
+        """
+        Takes a row no running process writes to, rows of processes that exited are taken over (their
+        counts stay in the sums). If every row is taken, or the claim lock doesn't come free (its holder
+        was killed), rows are shared by pid and concurrent updates of a shared row may get lost.
+        :return: (int) the row
+        """
+        if self.claim_lock.acquire(timeout=CLAIM_TIMEOUT):
+            try:
+                for row, owner in enumerate(self.owners.tolist()):
+                    if (owner in (0, pid)) or not process_exists(owner):  # pid: reused after its owner exited
+                        self.owners[row] = pid
+                        return row
+            finally:
+                self.claim_lock.release()
+        return pid % self.max_processes
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: (str) every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """
+    A count that only goes up
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, trace_key=None, registry=REGISTRY):
+        self.name = name
+        self.help = documentation
+        self.trace_key = trace_key
+        self.registry = registry
+        self.values = registry.allocate(1)
+        registry.register(self)
+
+    def inc(self, amount=1):
+        row, lock = self.registry.get_row()
+        with lock:
+            self.values[row, 0] += amount
+        trace = current_trace()
+        if (trace is not None) and (self.trace_key is not None):
+            trace.add(self.trace_key, amount)
+
+    def get(self):
+        return float(self.values[:, 0].sum())
+
+    def render(self):
+        return [self.name + " " + repr(self.get())]
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets (plus their sum)
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, trace_key=None, trace_scale=1.0,
+                 registry=REGISTRY):
+        """
+        :param trace_key: (str) name the observations are summed under in request traces
+        :param trace_scale: (float) observations are multiplied by this in request traces (e.g. 1000 for ms)
+        """
+        self.name = name
+        self.help = documentation
+        self.trace_key = trace_key
+        self.trace_scale = trace_scale
+        self.registry = registry
+        self.buckets = tuple(buckets)
+        # One count per bucket, one for +Inf, then the sum (per process)
+        self.values = registry.allocate(len(self.buckets) + 2)
+        registry.register(self)
+
+    def observe(self, value, count=1):
+        """
+        :param count: (int) number of times value was observed
+        """
+        bucket = bisect.bisect_left(self.buckets, value)
+        row, lock = self.registry.get_row()
+        with lock:
+            self.values[row, bucket] += count
+            self.values[row, -1] += value * count
+        trace = current_trace()
+        if (trace is not None) and (self.trace_key is not None):
+            trace.add(self.trace_key, value * count * self.trace_scale)
+
+    def time(self):
+        """
+        Context manager observing how long its block takes
+        """
+        return Timer(self)
+
+    def render(self):
+        lines = []
+        cumulative = 0.0
+        values = self.values.sum(axis=0)
+        for bound, count in zip(self.buckets + ("+Inf",), values[:-1].tolist()):
+            cumulative += count
+            lines.append(self.name + '_bucket{le="' + str(bound) + '"} ' + repr(cumulative))
+        lines.append(self.name + "_sum " + repr(float(values[-1])))
+        lines.append(self.name + "_count " + repr(cumulative))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+# Request stages
+REQUEST_SECONDS = Histogram("groundhog_request_seconds", "Time spent on a /groundhog request.")
+PARSE_SECONDS = Histogram("groundhog_parse_seconds", "Time spent decoding request payloads.",
+                          trace_key="parse_ms", trace_scale=1000.0)
+HEADINGS_SECONDS = Histogram("groundhog_headings_seconds", "Time spent building heading batches from records.",
+                             trace_key="headings_ms", trace_scale=1000.0)
+ENGINE_SECONDS = Histogram("groundhog_engine_seconds", "Time spent computing elevations and slopes for a batch.",
+                           trace_key="engine_ms", trace_scale=1000.0)
+SERIALIZE_SECONDS = Histogram("groundhog_serialize_seconds", "Time spent encoding responses.",
+                              trace_key="serialize_ms", trace_scale=1000.0)
+REQUEST_POINTS = Histogram("groundhog_request_points", "Points per request (or streamed window).",
+                           buckets=SIZE_BUCKETS)
+POINTS = Counter("groundhog_points_total", "Points processed.", trace_key="points")
+REQUESTS = Counter("groundhog_requests_total", "Requests to /groundhog.")
+
+# Engine
+ELEVATION_GATHER_SECONDS = Histogram("groundhog_elevation_gather_seconds",
+                                     "Time spent gathering a batch of elevations from the tiles.",
+                                     trace_key="elevation_gather_ms", trace_scale=1000.0)
+VOID_SEARCH_ITERATIONS = Histogram("groundhog_void_search_iterations",
+                                   "Points tried by a spiral search for a void without a nearby fill.",
+                                   buckets=ITERATION_BUCKETS, trace_key="spiral_iterations")
+VOID_SEARCHES = Counter("groundhog_void_searches_total", "Spiral searches for voids without a nearby fill.",
+                        trace_key="spiral_searches")
+TILES_LOADED = Counter("groundhog_tiles_loaded_total", "SRTM tiles mapped (or opened from a pack).")
+VOID_HITS = Counter("groundhog_void_hits_total", "Lookups that landed on a void cell.", trace_key="void_hits")
+VOID_FILLS = Counter("groundhog_void_fills_total", "Void cells looked up in a tile's void index.",
+                     trace_key="void_fill_lookups")
+DECIMATED_POINTS = Counter("groundhog_decimated_points_total",
+                           "Points filled in from a nearby track point instead of being looked up.",
+                           trace_key="decimated_points")
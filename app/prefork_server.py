@@ -0,0 +1,180 @@
+"""
+A small pre-fork WSGI server for running groundhog in production.
+
+The master process binds the listening socket and runs a preload hook (e.g. mapping
+SRTM tiles) before forking, so every worker shares those pages copy-on-write. Each
+worker serves one request at a time off the shared socket.
+
+Signals (sent to the master):
+    SIGTERM / SIGINT - stop, workers finish the request they are on first
+    SIGHUP - graceful restart, re-runs the preload hook and replaces every worker
+"""
+
+import logging
+import os
+import signal
+import socket
+import time
+from werkzeug.serving import make_server
+
+logger = logging.getLogger()
+
+
+class PreforkServer:
+    """
+    Pre-forks a fixed number of workers and keeps them running
+    """
+
+    def __init__(self, app, host="0.0.0.0", port=5005, workers=4, max_requests=0, graceful_timeout=30.0,
+                 preload=None):
+        """
+        :param app: WSGI application (e.g. the flask app)
+        :param workers: (int) number of worker processes
+        :param max_requests: (int) restart a worker after it served this many requests (0 for never)
+        :param graceful_timeout: (float) seconds workers get to finish up before they are killed
+        :param preload: (function) called in the master before (re)forking workers
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.preload = preload
+        self.socket = None
+        self.workers = set()  # pids
+        self.running = False
+        self.restart_requested = False
+        self.requests_handled = 0  # only used inside workers
+
+    def serve_forever(self):
+        """
+        Binds, preloads, forks and then supervises the workers until told to stop
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        # Idle workers race for each connection, the losers must not block in accept()
+        self.socket.setblocking(False)
+        self.socket.set_inheritable(True)
+
+        if self.preload is not None:
+            self.preload()
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        logger.info("Master " + str(os.getpid()) + " listening on " + self.host + ":" + str(self.port) +
+                    " with " + str(self.num_workers) + " workers")
+        for _ in range(self.num_workers):
+            self.spawn_worker()
+
+        while self.running:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.restart_workers()
+            self.reap_workers()
+            while self.running and (len(self.workers) < self.num_workers):
+                self.spawn_worker()
+            time.sleep(0.5)
+
+        self.stop_workers(self.workers)
+        self.socket.close()
+        logger.info("Master " + str(os.getpid()) + " stopped")
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run_worker()
+            finally:
+                os._exit(0)
+        self.workers.add(pid)
+        return pid
+
+    def reap_workers(self):
+        """
+        Forgets workers that have exited (after their request limit or a crash)
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                logger.info("Worker " + str(pid) + " exited with status " + str(status))
+
+    def restart_workers(self):
+        """
+        Starts a fresh set of workers, then lets the old ones finish up and exit
+        """
+        logger.info("Graceful restart of " + str(len(self.workers)) + " workers")
+        old_workers = set(self.workers)
+        self.workers = set()
+        if self.preload is not None:
+            self.preload()
+        for _ in range(self.num_workers):
+            self.spawn_worker()
+        self.stop_workers(old_workers)
+
+    def stop_workers(self, pids):
+        """
+        Asks workers to stop, kills whatever is left after the graceful timeout
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.graceful_timeout
+        remaining = set(pids)
+        while remaining and (time.time() < deadline):
+            for pid in list(remaining):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                        remaining.discard(pid)
+                except ChildProcessError:
+                    remaining.discard(pid)
+            time.sleep(0.1)
+        for pid in remaining:
+            logger.warning("Killing worker " + str(pid) + " after graceful timeout")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+    def counting_app(self, environ, start_response):
+        self.requests_handled += 1
+        return self.app(environ, start_response)
+
+    def run_worker(self):
+        """
+        Worker loop: serve requests one by one until stopped or out of requests
+        """
+        self.running = True
+        self.workers = set()
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C goes to the master
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server = make_server(self.host, self.port, self.counting_app, fd=self.socket.fileno())
+        server.timeout = 1.0  # wake up now and then to notice a stop request
+        logger.info("Worker " + str(os.getpid()) + " started")
+        while self.running:
+            server.handle_request()
+            if self.max_requests and (self.requests_handled >= self.max_requests):
+                logger.info("Worker " + str(os.getpid()) + " served " + str(self.requests_handled) +
+                            " requests, recycling")
+                break
+        server.server_close()
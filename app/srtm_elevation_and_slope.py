@@ -7,16 +7,725 @@ Modified: 20171120 (Brad Beechler)
 """
 
 import logging
+import os
 import time
 import argparse
-from math import asin, sin, cos, pi, sqrt, atan2, degrees, radians
+import threading
+from collections import OrderedDict
+from math import asin, floor, sin, cos, pi, sqrt, atan2, degrees, radians
+import numpy as np
 from numpy import power
+from scipy.ndimage import distance_transform_edt
 import srtm  # weird pip install: `pip install srtm.py`
+import metrics
 
-srtm_client = srtm.get_data()  # if OOM issues, set to True
+srtm_client = srtm.get_data()  # only used to download tiles the tile store doesn't have yet
 
 logger = logging.getLogger()  # make the logs global
 
+SRTM_VOID_MIN = -1000  # srtm.py treats anything outside these bounds as a void
+SRTM_VOID_MAX = 10000
+SRTM_VOID = -32768  # what .hgt files hold for voids, grids use it for cells without data too
+SPIRAL_SEARCH_FACTORS = [1, 10, 50, 100, 200, 500]  # scales tried by the spiral search in get_elevation_safe
+SPIRAL_SEARCH_CANDIDATES = 2 ** 20  # most spiral points spiral_search_batch looks up at once
+GRADIENT_SCALE = 10000.0  # gradient rasters are stored as int16 in 1/GRADIENT_SCALE meters/meter
+GRADIENT_VOID = -32768  # marks gradient cells that can't be used (voids nearby, near the tile edge or too steep)
+
+
+def void_fill_radius(null_search_size=0.00028, null_search_giveup=1000):
+    """
+    How far (in degrees) the spiral search in get_elevation_safe reaches with the given settings.
+    Used as the default radius for void filling so both give comparable results.
+    """
+    return null_search_size * max(SPIRAL_SEARCH_FACTORS) * sqrt(null_search_giveup) / 2.0
+
+
+def load_or_build_void_index(path, data):
+    """
+    Finds the nearest valid cell for every void cell of a tile with a distance transform
+    over the void mask. The index is cached beside the tile as <tile>.void.npy.
+    :param path: (str) path of the .hgt file
+    :param data: (np.ndarray) the tile
+    :return: (np.ndarray) (2, n) int32 array of [void cell flat index (sorted), nearest valid cell flat index]
+    """
+    index_path = path + ".void.npy"
+    if os.path.exists(index_path) and (os.path.getmtime(index_path) >= os.path.getmtime(path)):
+        return np.load(index_path, mmap_mode="r")
+
+    start = time.time()
+    void_mask = (data > SRTM_VOID_MAX) | (data < SRTM_VOID_MIN)
+    void_cells = np.flatnonzero(void_mask)
+    if (void_cells.size == 0) or (void_cells.size == void_mask.size):
+        # Nothing to fill, or nothing to fill it with
+        void_index = np.zeros((2, 0), dtype=np.int32)
+    else:
+        nearest = np.empty((2,) + void_mask.shape, dtype=np.int32)
+        distance_transform_edt(void_mask, return_distances=False, return_indices=True, indices=nearest)
+        nearest_cells = np.ravel_multi_index((nearest[0].ravel()[void_cells], nearest[1].ravel()[void_cells]),
+                                             void_mask.shape)
+        void_index = np.stack([void_cells, nearest_cells]).astype(np.int32)
+    logger.debug("Built void index for " + path + " (" + str(void_cells.size) + " voids) in " +
+                 str(round((time.time() - start) * 1000, 1)) + " ms")
+
+    try:
+        temp_path = index_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "wb") as index_file:
+            np.save(index_file, void_index)
+        os.replace(temp_path, index_path)
+    except OSError:
+        logger.warning("Could not cache void index at " + index_path + ", keeping it in memory")
+    return void_index
+
+
+def build_gradients(data, latitude, stride_length):
+    """
+    East and north gradients of a tile, taken the same way slope_from_coord_bearing takes a
+    slope: the elevation change from stride_length behind to stride_length ahead, per stride_length.
+    The slope along a bearing is then east * sin(bearing) + north * cos(bearing).
+    Like the lookups of slope_from_coord_bearing from a cell's center, the cells ahead and behind
+    are a stride rounded to whole cells away (rows get narrower towards the poles, so columns vary
+    by row). Gradients too steep for int16 are marked unusable, as are strides under half a cell.
+    :param data: (np.ndarray) the tile
+    :param latitude: (int) latitude of the tile's south edge
+    :param stride_length: (float) stride in meters
+    :return: (np.ndarray) (2, side, side) int16 array of [east, north] gradients (see GRADIENT_SCALE)
+    """
+    side = data.shape[0]
+    elevations = np.array(data, dtype=np.float32)
+    elevations[(elevations > SRTM_VOID_MAX) | (elevations < SRTM_VOID_MIN)] = np.nan
+    cell_angle = radians(1.0 / (side - 1))
+    # Same (radian) argument the destination point calculation passes for the radius
+    radius = calc_earth_radius(radians(latitude + 0.5))
+    gradients = np.full((2, side, side), np.nan, dtype=np.float32)
+
+    row_length = radius * cell_angle
+    shift = int(round(stride_length / row_length))
+    if 0 < shift < side / 2.0:
+        # Rows run north to south
+        gradients[1, shift:-shift] = (elevations[:-2 * shift] - elevations[2 * shift:]) / stride_length
+
+    row_latitudes = latitude + 1 - np.arange(side) / float(side - 1)
+    column_lengths = radius * np.cos(np.radians(row_latitudes)) * cell_angle
+    shifts = np.round(stride_length / column_lengths).astype(int)
+    for shift in np.unique(shifts):
+        if not 0 < shift < side / 2.0:
+            continue
+        rows = np.flatnonzero(shifts == shift)
+        gradients[0, rows, shift:-shift] = ((elevations[rows, 2 * shift:] - elevations[rows, :-2 * shift]) /
+                                            stride_length)
+
+    gradients = np.round(gradients * GRADIENT_SCALE)
+    # Too steep for int16 (clipping would pass it off as a gentler slope)
+    unusable = np.isnan(gradients) | (np.abs(np.nan_to_num(gradients)) > -GRADIENT_VOID - 1)
+    gradients[unusable] = GRADIENT_VOID
+    return gradients.astype(np.int16)
+
+
+def load_or_build_gradients(data, latitude, stride_length, path=None):
+    """
+    Gradient rasters of a tile (see build_gradients), cached beside the tile as <tile>.grad<stride>.npy
+    and memory-mapped from there
+    :param path: (str) path of the .hgt file, None to keep the rasters in memory only
+    """
+    # Keyed on the exact stride, rasters of nearby strides are different rasters
+    gradient_path = None if path is None else path + ".grad" + repr(float(stride_length)) + ".npy"
+    if (gradient_path is not None) and os.path.exists(gradient_path) and \
+            (os.path.getmtime(gradient_path) >= os.path.getmtime(path)):
+        return np.load(gradient_path, mmap_mode="r")
+
+    start = time.time()
+    gradients = build_gradients(data, latitude, stride_length)
+    logger.debug("Built " + str(stride_length) + " m gradients for " + str(path) + " in " +
+                 str(round((time.time() - start) * 1000, 1)) + " ms")
+    if gradient_path is not None:
+        try:
+            temp_path = gradient_path + "." + str(os.getpid()) + ".tmp"
+            with open(temp_path, "wb") as gradient_file:
+                np.save(gradient_file, gradients)
+            os.replace(temp_path, gradient_path)
+            gradients = np.load(gradient_path, mmap_mode="r")  # page cache rather than the heap, shared
+        except OSError:
+            logger.warning("Could not cache gradients at " + gradient_path + ", keeping them in memory")
+    return gradients
+
+
+class HgtTile:
+    """
+    A single SRTM tile memory-mapped as a square int16 array
+    NOTE: rows run north to south, columns west to east (the raw .hgt layout)
+    """
+    __slots__ = ["file_name", "latitude", "longitude", "side", "path", "data", "void_index", "gradients"]
+    index_lock = threading.Lock()  # serializes void index and gradient builds
+
+    def __init__(self, file_name, latitude, longitude, path):
+        side = int(round(sqrt(os.path.getsize(path) / 2)))
+        assert side * side * 2 == os.path.getsize(path), "Invalid file size for " + file_name
+        self.file_name = file_name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.side = side
+        self.path = path
+        self.data = np.memmap(path, dtype=">i2", mode="r", shape=(side, side))
+        self.void_index = None  # built on the first void hit
+        self.gradients = {}  # stride -> gradient rasters, built on first use
+
+    def get_rows_and_columns(self, latitude, longitude):
+        """
+        Same row/column arithmetic as srtm.py, works on scalars and arrays
+        """
+        rows = np.floor((self.latitude + 1 - latitude) * float(self.side - 1)).astype(np.intp)
+        columns = np.floor((longitude - self.longitude) * float(self.side - 1)).astype(np.intp)
+        return rows, columns
+
+    def gather(self, latitudes, longitudes, fill_radius=None):
+        """
+        Reads many points in one fancy-indexing call
+        :param fill_radius: (float) if given, fill voids from the nearest valid cell within this many degrees
+        :return: (np.ndarray) elevations, NaN for (unfilled) voids
+        """
+        rows, columns = self.get_rows_and_columns(latitudes, longitudes)
+        values = self.data[rows, columns].astype(float)
+        voids = (values > SRTM_VOID_MAX) | (values < SRTM_VOID_MIN)
+        values[voids] = np.nan
+        num_voids = int(np.count_nonzero(voids))
+        if num_voids:
+            metrics.VOID_HITS.inc(num_voids)
+        if fill_radius and num_voids:
+            values[voids] = self.fill_voids(rows[voids], columns[voids], fill_radius * (self.side - 1))
+        return values
+
+    def get_void_index(self):
+        """
+        :return: (np.ndarray) the tile's void index (see load_or_build_void_index)
+        """
+        if self.void_index is None:
+            with self.index_lock:
+                if self.void_index is None:
+                    self.void_index = load_or_build_void_index(self.path, self.data)
+        return self.void_index
+
+    def fill_voids(self, rows, columns, max_distance):
+        """
+        Looks up the nearest valid cell of void cells in the void index
+        :param rows: (np.ndarray) rows of void cells
+        :param columns: (np.ndarray) columns of void cells
+        :param max_distance: (float) furthest away (in cells) a fill may come from
+        :return: (np.ndarray) elevations, NaN where no valid cell is close enough
+        """
+        rows = np.atleast_1d(rows)
+        columns = np.atleast_1d(columns)
+        metrics.VOID_FILLS.inc(rows.size)
+        filled = np.full(rows.shape, np.nan)
+        void_cells, nearest_cells = self.get_void_index()
+        if void_cells.size == 0:
+            return filled
+        cells = rows * self.side + columns
+        position = np.minimum(np.searchsorted(void_cells, cells), void_cells.size - 1)
+        found = np.flatnonzero(void_cells[position] == cells)
+        nearest_rows, nearest_columns = np.divmod(nearest_cells[position[found]], self.side)
+        distance = np.hypot(nearest_rows - rows[found], nearest_columns - columns[found])
+        close = distance <= max_distance
+        filled[found[close]] = self.data[nearest_rows[close], nearest_columns[close]]
+        return filled
+
+    def get_gradients(self, stride_length):
+        """
+        :return: (np.ndarray) the tile's gradient rasters for a stride (see build_gradients)
+        """
+        gradients = self.gradients.get(stride_length)
+        if gradients is None:
+            with self.index_lock:
+                gradients = self.gradients.get(stride_length)
+                if gradients is None:
+                    gradients = load_or_build_gradients(self.data, self.latitude, stride_length,
+                                                        path=self.get_gradient_cache_path())
+                    self.gradients[stride_length] = gradients
+        return gradients
+
+    def get_gradient_cache_path(self):
+        return self.path
+
+    def load(self):
+        """
+        Reads the whole tile in ahead of time (see HgtTileStore.preload), a mapped .hgt needs nothing
+        """
+
+    def gather_gradients(self, latitudes, longitudes, stride_length):
+        """
+        :return: (np.ndarray, np.ndarray) east and north gradients of many points, NaN where unusable
+        """
+        rows, columns = self.get_rows_and_columns(latitudes, longitudes)
+        gradients = self.get_gradients(stride_length)
+        east = gradients[0][rows, columns].astype(float)
+        north = gradients[1][rows, columns].astype(float)
+        unusable = (east == GRADIENT_VOID) | (north == GRADIENT_VOID)
+        east[unusable] = np.nan
+        north[unusable] = np.nan
+        return east / GRADIENT_SCALE, north / GRADIENT_SCALE
+
+    def read_grid(self, rows, columns, fill_radius=None):
+        """
+        The cells where some rows and columns cross. When both are evenly spaced the tile is
+        sliced with steps, so the result is a view of the tile rather than a copy
+        :param rows: (np.ndarray) tile rows, ascending
+        :param columns: (np.ndarray) tile columns, ascending
+        :param fill_radius: (float) if given, fill voids from the nearest valid cell within this many degrees
+        :return: (np.ndarray) int16 elevations, voids are SRTM_VOID
+        """
+        row_index = as_slice(rows)
+        column_index = as_slice(columns)
+        if isinstance(row_index, slice) or isinstance(column_index, slice):
+            grid = self.data[row_index, column_index]
+        else:
+            grid = self.data[np.ix_(rows, columns)]
+        if fill_radius:
+            voids = (grid > SRTM_VOID_MAX) | (grid < SRTM_VOID_MIN)
+            if voids.any():
+                void_rows, void_columns = np.nonzero(voids)
+                filled = self.fill_voids(rows[void_rows], columns[void_columns], fill_radius * (self.side - 1))
+                grid = np.array(grid, dtype=np.int16)
+                grid[voids] = np.where(np.isnan(filled), SRTM_VOID, filled)
+        return grid
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of the tile and of the gradient rasters built for it so far
+        """
+        return self.data.nbytes + sum(gradients.nbytes for gradients in list(self.gradients.values()))
+
+
+def as_slice(index):
+    """
+    :return: an equivalent slice for evenly spaced ascending indices, the indices themselves otherwise
+    """
+    if index.size == 1:
+        return slice(int(index[0]), int(index[0]) + 1)
+    steps = np.diff(index)
+    if (steps[0] > 0) and (steps == steps[0]).all():
+        return slice(int(index[0]), int(index[-1]) + 1, int(steps[0]))
+    return index
+
+
+def iter_runs(values):
+    """
+    :return: generator of (slice, value) for each run of equal values in a sorted array
+    """
+    starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+    ends = np.append(starts[1:], values.size)
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield slice(start, end), values[start]
+
+
+class TileCache:
+    """
+    Least-recently-used cache of tiles bounded by a byte budget.
+    Eviction only drops the cache's reference: a request still holding an
+    evicted tile keeps reading it and the mapping is released when it lets go.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes  # None for no limit
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+        self.sizes = {}  # file name -> bytes the tile was counted for
+
+    def get(self, file_name):
+        """
+        :return: the cached tile (marked as most recently used), None on a miss
+        """
+        with self.lock:
+            tile = self.tiles.get(file_name)
+            if tile is None:
+                self.misses += 1
+            else:
+                self.tiles.move_to_end(file_name)
+                self.hits += 1
+            return tile
+
+    def put(self, file_name, tile):
+        """
+        Adds a tile and evicts the least recently used ones until back under budget
+        :return: the cached tile (an existing one wins if another request got there first)
+        """
+        with self.lock:
+            if file_name in self.tiles:
+                return self.tiles[file_name]
+            self.tiles[file_name] = tile
+            self.sizes[file_name] = tile.nbytes
+            self.resident_bytes += self.sizes[file_name]
+            self.evict()
+            return tile
+
+    def resize(self, file_name):
+        """
+        Counts a cached tile again after it grew (e.g. gradient rasters were built for it)
+        and evicts the least recently used tiles until back under budget
+        """
+        with self.lock:
+            tile = self.tiles.get(file_name)
+            if tile is None:
+                return
+            size = tile.nbytes
+            self.resident_bytes += size - self.sizes[file_name]
+            self.sizes[file_name] = size
+            self.evict()
+
+    def evict(self):
+        """
+        Drops least recently used tiles until back under budget, call with the lock held
+        """
+        # Always keep the newest tile, even if it alone is over budget
+        while (self.max_bytes is not None) and (self.resident_bytes > self.max_bytes) and (len(self.tiles) > 1):
+            evicted_name, _ = self.tiles.popitem(last=False)
+            self.resident_bytes -= self.sizes.pop(evicted_name)
+            self.evictions += 1
+            logger.debug("Evicted tile " + evicted_name)
+
+    def stats(self):
+        """
+        :return: (dict) cache counters for monitoring
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident_bytes": self.resident_bytes,
+                "resident_tiles": len(self.tiles),
+                "max_bytes": self.max_bytes
+            }
+
+
+def trace_tile_load(file_name):
+    trace = metrics.current_trace()
+    if trace is not None:
+        trace.tiles_loaded.append(file_name)
+
+
+class HgtTileStore:
+    """
+    Serves SRTM elevations straight from memory-mapped .hgt files in tile_dir.
+    Tiles that aren't on disk yet are downloaded once through srtm.py.
+    Given a tile pack (see tile_pack.py), tiles are read out of the pack first.
+    """
+
+    def __init__(self, tile_dir=None, fetch_missing=True, cache_bytes=None, pack=None):
+        if tile_dir is None:
+            tile_dir = srtm_client.file_handler.local_cache_dir
+        self.tile_dir = tile_dir
+        self.fetch_missing = fetch_missing
+        self.pack = pack
+        self.cache = TileCache(max_bytes=cache_bytes)
+        self.missing_tiles = set()  # file names with no SRTM data
+        self.lock = threading.Lock()  # guards tile_locks
+        self.tile_locks = {}  # file name -> lock serializing loads of that tile only
+
+    @staticmethod
+    def get_file_name(latitude, longitude):
+        """
+        SRTM file name for a coordinate, e.g. N45W102.hgt
+        """
+        tile_lat = int(floor(latitude))
+        tile_lon = int(floor(longitude))
+        return "%s%02d%s%03d.hgt" % ("N" if tile_lat >= 0 else "S", abs(tile_lat),
+                                     "E" if tile_lon >= 0 else "W", abs(tile_lon))
+
+    @staticmethod
+    def parse_file_name(file_name):
+        """
+        South-west corner of an SRTM file, e.g. N45W102.hgt -> (45, -102)
+        """
+        latitude = int(file_name[1:3]) * (1 if file_name[0] == "N" else -1)
+        longitude = int(file_name[4:7]) * (1 if file_name[3] == "E" else -1)
+        return latitude, longitude
+
+    def preload(self):
+        """
+        Maps every tile already in tile_dir (within the cache budget) along with any cached
+        void index. Run it before forking workers so they all share the same mappings.
+        Tiles in a pack are decompressed whole here, so workers share that one copy too.
+        :return: (int) number of tiles mapped
+        """
+        num_tiles = 0
+        file_names = [] if self.pack is None else self.pack.file_names
+        if os.path.isdir(self.tile_dir):
+            file_names += sorted(os.listdir(self.tile_dir))
+        for file_name in file_names:
+            if (not file_name.endswith(".hgt")) or (len(file_name) != 11):
+                continue
+            if (self.cache.max_bytes is not None) and (self.cache.resident_bytes >= self.cache.max_bytes):
+                logger.warning("Tile cache budget reached, not preloading any more tiles")
+                break
+            latitude, longitude = self.parse_file_name(file_name)
+            tile = self.get_tile(latitude, longitude)
+            if tile is None:
+                continue
+            tile.load()
+            if (tile.void_index is None) and ((self.pack is not None) or os.path.exists(tile.path + ".void.npy")):
+                tile.get_void_index()
+            for stride_length in (gradient_strides or ()):
+                tile.get_gradients(stride_length)
+            if gradient_strides:
+                self.cache.resize(file_name)
+            num_tiles += 1
+        logger.info("Preloaded " + str(num_tiles) + " tiles from " + self.tile_dir)
+        return num_tiles
+
+    def fetch_tile(self, file_name, path):
+        """
+        Downloads (or unzips) a tile through srtm.py and writes the raw .hgt into tile_dir
+        :return: (bool) whether the tile is now on disk
+        """
+        if (file_name not in srtm_client.srtm1_files) and (file_name not in srtm_client.srtm3_files):
+            return False  # No SRTM coverage here (e.g. open ocean)
+        data = srtm_client.retrieve_or_load_file_data(file_name)
+        if not data:
+            return False
+        if not os.path.exists(path):
+            temp_path = path + "." + str(os.getpid()) + ".tmp"
+            with open(temp_path, "wb") as tile_file:
+                tile_file.write(data)
+            os.replace(temp_path, path)
+        return True
+
+    def get_tile(self, latitude, longitude):
+        """
+        :return: (HgtTile) the mapped tile covering a coordinate, None if there is no data
+        """
+        file_name = self.get_file_name(latitude, longitude)
+        if file_name in self.missing_tiles:
+            return None
+        tile = self.cache.get(file_name)
+        if tile is not None:
+            return tile
+        # A slow download only holds up threads after the same tile
+        with self.lock:
+            tile_lock = self.tile_locks.setdefault(file_name, threading.Lock())
+        with tile_lock:
+            tile = self.cache.get(file_name)
+            if tile is not None:
+                return tile  # loaded by another thread meanwhile
+            if file_name in self.missing_tiles:
+                return None
+            if self.pack is not None:
+                tile = self.pack.get_tile(file_name)
+                if tile is not None:
+                    logger.debug("Opened tile " + tile.path)
+                    metrics.TILES_LOADED.inc()
+                    trace_tile_load(file_name)
+                    return self.cache.put(file_name, tile)
+            path = os.path.join(self.tile_dir, file_name)
+            if not (os.path.exists(path) or (self.fetch_missing and self.fetch_tile(file_name, path))):
+                self.missing_tiles.add(file_name)
+                return None
+            tile = HgtTile(file_name, floor(latitude), floor(longitude), path)
+            logger.debug("Mapped tile " + path)
+            metrics.TILES_LOADED.inc()
+            trace_tile_load(file_name)
+            return self.cache.put(file_name, tile)
+
+    def get_elevation(self, latitude, longitude):
+        """
+        Drop in replacement for srtm_client.get_elevation
+        :return: (int) elevation in meters, None if there is no data
+        """
+        tile = self.get_tile(latitude, longitude)
+        if tile is None:
+            return None
+        row, column = tile.get_rows_and_columns(latitude, longitude)
+        elevation = int(tile.data[row, column])
+        if (elevation > SRTM_VOID_MAX) or (elevation < SRTM_VOID_MIN):
+            metrics.VOID_HITS.inc()
+            return None
+        return elevation
+
+    def fill_void(self, latitude, longitude, fill_radius):
+        """
+        Elevation of the valid cell nearest to a coordinate in the same tile
+        :param fill_radius: (float) furthest away (in degrees) the valid cell may be
+        :return: (int) elevation in meters, None if there is no valid cell close enough
+        """
+        tile = self.get_tile(latitude, longitude)
+        if tile is None:
+            return None
+        row, column = tile.get_rows_and_columns(latitude, longitude)
+        elevation = tile.fill_voids(row, column, fill_radius * (tile.side - 1))[0]
+        if elevation != elevation:
+            return None
+        return int(elevation)
+
+    def iter_tiles(self, latitudes, longitudes):
+        """
+        Groups points by the tile they fall in
+        :return: generator of (HgtTile, indices of its points), tiles without data are skipped
+        """
+        finite = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        if finite.size == 0:
+            return
+        # One integer code per tile, a single sort then lines up the points of each tile
+        # 361 columns per row, so a longitude of exactly 180 stays in its own row (there is no tile there)
+        tile_codes = (np.floor(latitudes[finite]) + 90) * 361 + (np.floor(longitudes[finite]) + 180)
+        order = np.argsort(tile_codes, kind="mergesort")
+        tile_codes = tile_codes[order]
+        starts = np.flatnonzero(np.concatenate([[True], tile_codes[1:] != tile_codes[:-1]]))
+        ends = np.append(starts[1:], order.size)
+        for start, end in zip(starts, ends):
+            tile_lat, tile_lon = divmod(int(tile_codes[start]), 361)
+            tile = self.get_tile(tile_lat - 90, tile_lon - 180)
+            if tile is not None:
+                trace = metrics.current_trace()
+                if trace is not None:
+                    trace.tiles_touched.add(tile.file_name)
+                yield tile, finite[order[start:end]]
+
+    def get_elevations(self, latitudes, longitudes, fill_radius=None):
+        """
+        Array version of get_elevation, gathers all points of a tile at once
+        :param fill_radius: (float) if given, fill voids from the nearest valid cell within this many degrees
+        :return: (np.ndarray) elevations in meters, NaN where there is no data
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        elevations = np.full(latitudes.shape, np.nan)
+        with metrics.ELEVATION_GATHER_SECONDS.time():
+            for tile, in_tile in self.iter_tiles(latitudes, longitudes):
+                elevations[in_tile] = tile.gather(latitudes[in_tile], longitudes[in_tile], fill_radius=fill_radius)
+        return elevations
+
+    def get_grid(self, row_latitudes, column_longitudes, fill_radius=None):
+        """
+        Elevations on a grid, sliced tile by tile out of the tile arrays rather than gathered
+        point by point. A grid inside one tile that lines up with its cells is a view of the tile.
+        :param row_latitudes: (np.ndarray) latitude of each grid row, north to south
+        :param column_longitudes: (np.ndarray) longitude of each grid column, west to east
+        :param fill_radius: (float) if given, fill voids from the nearest valid cell within this many degrees
+        :return: (np.ndarray) int16 elevations in meters, SRTM_VOID for voids and cells without data
+                 (big-endian like the tiles when it is a view of one, native byte order otherwise)
+        """
+        row_latitudes = np.asarray(row_latitudes, dtype=float)
+        column_longitudes = np.asarray(column_longitudes, dtype=float)
+        blocks = []
+        with metrics.ELEVATION_GATHER_SECONDS.time():
+            # Rows within a tile only depend on latitude and columns on longitude, so tiles are rectangles
+            for grid_rows, tile_lat in iter_runs(np.floor(row_latitudes)):
+                for grid_columns, tile_lon in iter_runs(np.floor(column_longitudes)):
+                    tile = self.get_tile(tile_lat, tile_lon)
+                    if tile is None:
+                        continue
+                    trace = metrics.current_trace()
+                    if trace is not None:
+                        trace.tiles_touched.add(tile.file_name)
+                    rows, columns = tile.get_rows_and_columns(row_latitudes[grid_rows], column_longitudes[grid_columns])
+                    blocks.append((grid_rows, grid_columns, tile.read_grid(rows, columns, fill_radius=fill_radius)))
+            shape = (row_latitudes.size, column_longitudes.size)
+            if (len(blocks) == 1) and (blocks[0][2].shape == shape):
+                return blocks[0][2]
+            grid = np.full(shape, SRTM_VOID, dtype=np.int16)
+            for grid_rows, grid_columns, values in blocks:
+                grid[grid_rows, grid_columns] = values
+        return grid
+
+    def get_gradients(self, latitudes, longitudes, stride_length):
+        """
+        East and north gradients of many points (see build_gradients)
+        :return: (np.ndarray, np.ndarray) gradients, NaN where there are none to use
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        east = np.full(latitudes.shape, np.nan)
+        north = np.full(latitudes.shape, np.nan)
+        for tile, in_tile in self.iter_tiles(latitudes, longitudes):
+            built = stride_length not in tile.gradients
+            east[in_tile], north[in_tile] = tile.gather_gradients(latitudes[in_tile], longitudes[in_tile],
+                                                                  stride_length)
+            if built:
+                self.cache.resize(tile.file_name)  # the new rasters count against the budget too
+        return east, north
+
+
+class SlopeCache:
+    """
+    Least-recently-used cache of slope results for points that come up again and again (e.g. daily routes).
+    Points are keyed on the SRTM cell they fall in, their bearing rounded to bearing_step degrees and
+    their stride, so a hit returns the result of the first nearby point seen rather than an exact one.
+    """
+
+    def __init__(self, max_entries=1000000, cell_size=1.0 / 3600, bearing_step=1.0):
+        """
+        :param max_entries: (int) results kept before the least recently used ones are evicted
+        :param cell_size: (float) degrees, one arc-second matches the finest SRTM grid
+        :param bearing_step: (float) degrees bearings are rounded to
+        """
+        self.max_entries = max_entries
+        self.cell_size = cell_size
+        self.bearing_step = bearing_step
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_keys(self, longitudes, latitudes, bearings, strides):
+        """
+        :return: (list[tuple]) a cache key per point
+        """
+        # Tile rows count down from the north edge, so latitudes round up into their cell
+        rows = np.ceil(np.asarray(latitudes, dtype=float) / self.cell_size).astype(np.int64)
+        columns = np.floor(np.asarray(longitudes, dtype=float) / self.cell_size).astype(np.int64)
+        steps = np.round(np.asarray(bearings, dtype=float) / self.bearing_step).astype(np.int64)
+        steps %= int(round(360.0 / self.bearing_step))
+        strides = np.broadcast_to(np.asarray(strides, dtype=float), rows.shape)
+        return list(zip(rows.tolist(), columns.tolist(), steps.tolist(), strides.tolist()))
+
+    def get_many(self, keys):
+        """
+        :return: (list) cached (elevation, slope) per key, None on a miss
+        """
+        with self.lock:
+            values = [self.results.get(key) for key in keys]
+            for key, value in zip(keys, values):
+                if value is not None:
+                    self.results.move_to_end(key)
+            num_hits = len(values) - values.count(None)
+            self.hits += num_hits
+            self.misses += len(values) - num_hits
+            return values
+
+    def put_many(self, keys, values):
+        """
+        Adds (elevation, slope) results and evicts the least recently used ones until back under the limit
+        """
+        with self.lock:
+            self.results.update(zip(keys, values))
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: (dict) cache counters for monitoring
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else None,
+                "evictions": self.evictions,
+                "entries": len(self.results),
+                "max_entries": self.max_entries
+            }
+
+
+tile_store = HgtTileStore()
+slope_cache = None  # set to a SlopeCache to reuse results, None computes every point exactly
+gradient_strides = None  # strides (meters) to take slopes from precomputed gradient rasters for, None for never
+
 
 def get_command_line():
     """
@@ -106,12 +815,12 @@ def lon_lat_from_distance_bearing(lon, lat, distance, bearing):
 
 def bearing_to_components(bearing):
     """
-    :param bearing: (float) compass bearing (north is 0)
+    :param bearing: (float or np.ndarray) compass bearing (north is 0)
     :return: vector components of bearing
     """
     rad = pi / 180.0
-    x = sin(rad * bearing)
-    y = cos(rad * bearing)
+    x = np.sin(rad * bearing)
+    y = np.cos(rad * bearing)
     return x, y
 
 
@@ -163,31 +872,42 @@ def get_spiral(iterations=100):
     return spiral_list
 
 
-def get_elevation_safe(lon, lat, null_search_size=0.00028, null_search_giveup=1000):
+def get_elevation_safe(lon, lat, null_search_size=0.00028, null_search_giveup=1000, fill_radius=None):
     """
-    Gets an elevation from SRTM, if it returns null do a spiral search out
+    Gets an elevation from SRTM, if it returns null take the nearest valid cell from the
+    tile's void index, and if there is none in the tile do a spiral search out
     :param lon: (float) longitude
     :param lat: (float) latitude
     :param null_search_size: (float) scale to search on
     :param null_search_giveup: (int) give up after this many iterations
+    :param fill_radius: (float) furthest (in degrees) to fill voids from, defaults to the
+                        reach of the spiral search. Set to 0 to only use the spiral search.
     :return:
     """
-    elevation = srtm_client.get_elevation(lat, lon)
+    if fill_radius is None:
+        fill_radius = void_fill_radius(null_search_size, null_search_giveup)
+    elevation = tile_store.get_elevation(lat, lon)
+    if (elevation is None) and fill_radius:
+        elevation = tile_store.fill_void(lat, lon, fill_radius)
     if elevation is None:
         spiral = get_spiral(iterations=null_search_giveup)
-        for search_factor in [1, 10, 50, 100, 200, 500]:
+        search_iterations = 0
+        for search_factor in SPIRAL_SEARCH_FACTORS:
             # Spiral search out
             search_list = []
             for spiral_point in spiral:
                 search_list.append((lon + (spiral_point[0] * (null_search_size * search_factor)),
                                     lat + (spiral_point[1] * (null_search_size * search_factor))))
             for search_point in search_list:
-                elevation = srtm_client.get_elevation(search_point[1], search_point[0])
+                search_iterations += 1
+                elevation = tile_store.get_elevation(search_point[1], search_point[0])
                 if elevation is not None:
                     elevation = elevation
                     break
             if elevation is not None:
                 break
+        metrics.VOID_SEARCHES.inc()
+        metrics.VOID_SEARCH_ITERATIONS.observe(search_iterations)
     return elevation
 
 
@@ -200,7 +920,14 @@ def slope_from_coord_bearing(longitude_origin, latitude_origin, bearing_origin,
     :param stride_length: resolution you want to calculate slope on in meters (larger is smoother)
     :return: terrain elevation (meters) / meter, terrain slope (meters/meter)
     """
-    elevation_origin = srtm_client.get_elevation(latitude_origin, longitude_origin)
+    if (slope_cache is not None) and (bearing_origin is not None):
+        elevations, slopes = slope_from_coord_bearing_batch([longitude_origin], [latitude_origin], [bearing_origin],
+                                                            stride_length=stride_length)
+        if np.isnan(elevations[0]):
+            return None, None
+        return int(elevations[0]), (None if np.isnan(slopes[0]) else float(slopes[0]))
+
+    elevation_origin = tile_store.get_elevation(latitude_origin, longitude_origin)
     logger.debug("Elevation at origin: " + str(elevation_origin))
 
     # Bearing is an optional param
@@ -238,7 +965,7 @@ def slope_from_coords_only(coord_list, stride_length=250.0):
     :param stride_length: resolution you want to calculate slope on in meters (larger is smoother)
     :return:
     """
-    # TODO: put time and space thresholds for sane returns
+    # Dense tracks (points a few meters apart) can be thinned out first, see decimate_track
     elevation_list = []
     slope_list = []
     bearing_list = []
@@ -258,6 +985,646 @@ def slope_from_coords_only(coord_list, stride_length=250.0):
     return elevation_list, slope_list, bearing_list
 
 
+#########################
+#      BATCH ENGINE     #
+#########################
+# Array versions of the functions above. They take numpy arrays (or anything
+# np.asarray understands) and return numpy arrays, with NaN standing in for
+# the None the scalar versions return. Results match the scalar functions.
+
+def calc_earth_radius_batch(latitude):
+    """
+    Array version of calc_earth_radius
+    :param latitude: (np.ndarray) latitudes in degrees
+    :return: (np.ndarray) radius in meters
+    """
+    a = 6378137  # radius at Equator in m
+    b = 6356752  # radius at Pole in m
+    latitude = np.radians(np.asarray(latitude, dtype=float))
+    cos_lat = np.cos(latitude)
+    sin_lat = np.sin(latitude)
+    radius = (((power(power(a, 2) * cos_lat, 2)) + (power(power(b, 2) * sin_lat, 2))) /
+              (power(a * cos_lat, 2) + power(b * sin_lat, 2)))
+    return np.sqrt(radius)
+
+
+def haversine_batch(lat1, lon1, lat2, lon2):
+    """
+    Array version of haversine
+    :return: (np.ndarray) great circle distances in meters
+    """
+    lat1, lon1, lat2, lon2 = [np.asarray(x, dtype=float) for x in [lat1, lon1, lat2, lon2]]
+    radius = (calc_earth_radius_batch(lat1) + calc_earth_radius_batch(lat2)) / 2
+    lat1, lat2, lon1, lon2 = [np.radians(x) for x in [lat1, lat2, lon1, lon2]]
+    a = power(np.sin((lat2 - lat1) / 2), 2) + np.cos(lat1) * np.cos(lat2) * power(np.sin((lon2 - lon1) / 2), 2)
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))) * radius
+
+
+def lon_lat_from_distance_bearing_batch(lon, lat, distance, bearing):
+    """
+    Array version of lon_lat_from_distance_bearing
+    :param lon: (np.ndarray) longitudes
+    :param lat: (np.ndarray) latitudes
+    :param distance: (np.ndarray or float) distances in meters
+    :param bearing: (np.ndarray) compass bearings (north is 0)
+    :return: (np.ndarray, np.ndarray) new longitudes, new latitudes
+    """
+    lat_orig = np.radians(np.asarray(lat, dtype=float))
+    lon_orig = np.radians(np.asarray(lon, dtype=float))
+    bearing_orig = np.radians(np.asarray(bearing, dtype=float))
+    # Same as the scalar version, which hands the radius calculation radians
+    roe = calc_earth_radius_batch(lat_orig)
+    angular_distance = np.asarray(distance, dtype=float) / roe
+    sin_lat_orig = np.sin(lat_orig)
+    cos_lat_orig = np.cos(lat_orig)
+    lat_new = np.arcsin((sin_lat_orig * np.cos(angular_distance)) +
+                        (cos_lat_orig * np.sin(angular_distance) * np.cos(bearing_orig)))
+    lon_new = lon_orig + np.arctan2(np.sin(bearing_orig) * np.sin(angular_distance) * cos_lat_orig,
+                                    np.cos(angular_distance) - sin_lat_orig * np.sin(lat_new))
+    return np.degrees(lon_new), np.degrees(lat_new)
+
+
+def bearing_batch(lon1, lat1, lon2, lat2):
+    """
+    Array version of bearing (initial bearing / forward azimuth)
+    :param lon1: (np.ndarray) longitudes in degrees East of start points
+    :param lat1: (np.ndarray) latitudes in degrees North of start points
+    :param lon2: (np.ndarray) longitudes in degrees East of end points
+    :param lat2: (np.ndarray) latitudes in degrees North of end points
+    :return: (np.ndarray) azimuth degrees (compass heading)
+    """
+    lat1, lat2, lon1, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in [lat1, lat2, lon1, lon2]]
+    delta_lon = lon2 - lon1
+    x = np.cos(lat2) * np.sin(delta_lon)
+    y = (np.cos(lat1) * np.sin(lat2)) - (np.sin(lat1) * np.cos(lat2) * np.cos(delta_lon))
+    bearings = np.arctan2(x, y) * 180.0 / pi
+    # Make always positive
+    return np.where(bearings < 0, bearings + 360.0, bearings)
+
+
+def get_elevation_batch(lon, lat):
+    """
+    Array version of tile_store.get_elevation. Points are grouped by SRTM tile
+    and each tile is read with a single fancy-indexing gather.
+    :param lon: (np.ndarray) longitudes
+    :param lat: (np.ndarray) latitudes
+    :return: (np.ndarray) elevations in meters, NaN where SRTM has no data
+    """
+    return tile_store.get_elevations(lat, lon)
+
+
+def get_elevation_safe_batch(lon, lat, fill_radius=None):
+    """
+    Array version of get_elevation_safe. Voids are filled from the tile void indexes,
+    anything left over falls back to the spiral search.
+    :param lon: (np.ndarray) longitudes
+    :param lat: (np.ndarray) latitudes
+    :param fill_radius: (float) furthest (in degrees) to fill voids from (see get_elevation_safe)
+    :return: (np.ndarray) elevations in meters, NaN where nothing was found
+    """
+    if fill_radius is None:
+        fill_radius = void_fill_radius()
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    elevations = tile_store.get_elevations(lat, lon, fill_radius=fill_radius)
+    # Only whole-tile voids and points off the SRTM grid get here
+    search = np.flatnonzero(np.isnan(elevations) & np.isfinite(lat) & np.isfinite(lon))
+    if search.size:
+        elevations[search] = spiral_search_batch(lon[search], lat[search])
+    return elevations
+
+
+def has_tiles(south, west, north, east):
+    """
+    :return: (bool) whether any tile with data overlaps a bounding box (in degrees)
+    """
+    for latitude in range(int(floor(max(south, -90))), int(floor(min(north, 89))) + 1):
+        for longitude in range(int(floor(max(west, -180))), int(floor(min(east, 179))) + 1):
+            if tile_store.get_tile(latitude, longitude) is not None:
+                return True
+    return False
+
+
+def spiral_search_batch(lon, lat, null_search_size=0.00028, null_search_giveup=1000):
+    """
+    Array version of the spiral search of get_elevation_safe: each point gets the first cell
+    with data along its spiral, trying the same points in the same order. Points are searched
+    tile by tile, skipping the scales at which their spirals would only cross tiles without
+    data (e.g. out at sea), and at most SPIRAL_SEARCH_CANDIDATES spiral points are looked up at once.
+    :param lon: (np.ndarray) longitudes
+    :param lat: (np.ndarray) latitudes
+    :return: (np.ndarray) elevations in meters, NaN where the search gave up
+    """
+    spiral = np.array(get_spiral(iterations=null_search_giveup), dtype=float)
+    reach = np.abs(spiral).max() * null_search_size  # furthest the spiral goes at a scale of 1
+    elevations = np.full(lon.shape, np.nan)
+    iterations = np.zeros(lon.shape, dtype=int)
+    chunk_size = max(1, SPIRAL_SEARCH_CANDIDATES // len(spiral))
+    tile_codes = (np.floor(lat) + 90) * 361 + (np.floor(lon) + 180)
+    for tile_code in np.unique(tile_codes):
+        tile_lat, tile_lon = divmod(int(tile_code), 361)
+        tile_lat, tile_lon = tile_lat - 90, tile_lon - 180
+        points = np.flatnonzero(tile_codes == tile_code)
+        for search_factor in SPIRAL_SEARCH_FACTORS:
+            extent = reach * search_factor
+            if not has_tiles(tile_lat - extent, tile_lon - extent, tile_lat + 1 + extent, tile_lon + 1 + extent):
+                iterations[points] += len(spiral)
+                continue
+            offsets = spiral * (null_search_size * search_factor)
+            for start in range(0, points.size, chunk_size):
+                chunk = points[start:start + chunk_size]
+                candidate_lat = lat[chunk, np.newaxis] + offsets[:, 1]
+                candidate_lon = lon[chunk, np.newaxis] + offsets[:, 0]
+                values = tile_store.get_elevations(candidate_lat.ravel(),
+                                                   candidate_lon.ravel()).reshape(candidate_lat.shape)
+                valid = ~np.isnan(values)
+                found = valid.any(axis=1)
+                first = valid.argmax(axis=1)
+                elevations[chunk[found]] = values[found, first[found]]
+                iterations[chunk] += np.where(found, first + 1, len(spiral))
+            points = points[np.isnan(elevations[points])]
+            if points.size == 0:
+                break
+    metrics.VOID_SEARCHES.inc(lon.size)
+    for search_iterations, count in zip(*np.unique(iterations, return_counts=True)):
+        metrics.VOID_SEARCH_ITERATIONS.observe(int(search_iterations), count=int(count))
+    return elevations
+
+
+def slope_from_coord_bearing_batch(longitude_origin, latitude_origin, bearing_origin, stride_length=250.0):
+    """
+    Array version of slope_from_coord_bearing
+    :param longitude_origin: (np.ndarray) longitudes
+    :param latitude_origin: (np.ndarray) latitudes
+    :param bearing_origin: (np.ndarray) compass bearings (north is 0), NaN if not known
+    :param stride_length: (np.ndarray or float) resolution to calculate slope on in meters
+    :return: (np.ndarray, np.ndarray) terrain elevations (meters), terrain slopes (meters/meter)
+    """
+    longitude_origin = np.asarray(longitude_origin, dtype=float)
+    latitude_origin = np.asarray(latitude_origin, dtype=float)
+    bearing_origin = np.asarray(bearing_origin, dtype=float)
+    stride_length = np.broadcast_to(np.asarray(stride_length, dtype=float), longitude_origin.shape)
+    if slope_cache is not None:
+        return cached_slope_batch(slope_cache, longitude_origin, latitude_origin, bearing_origin, stride_length)
+    return compute_slope_batch(longitude_origin, latitude_origin, bearing_origin, stride_length)
+
+
+def cached_slope_batch(cache, longitude_origin, latitude_origin, bearing_origin, stride_length):
+    """
+    slope_from_coord_bearing_batch through a SlopeCache: only the misses are computed
+    (points without a bearing always are)
+    """
+    elevation_origin = np.full(longitude_origin.shape, np.nan)
+    terrain_slope = np.full(longitude_origin.shape, np.nan)
+    cacheable = np.flatnonzero(np.isfinite(bearing_origin) & np.isfinite(latitude_origin) &
+                               np.isfinite(longitude_origin))
+    keys = cache.make_keys(longitude_origin[cacheable], latitude_origin[cacheable], bearing_origin[cacheable],
+                           stride_length[cacheable])
+    values = cache.get_many(keys)
+    hit = np.array([value is not None for value in values], dtype=bool)
+    if hit.any():
+        elevation_origin[cacheable[hit]], terrain_slope[cacheable[hit]] = \
+            np.array([value for value in values if value is not None], dtype=float).T
+
+    missed = np.ones(longitude_origin.shape, dtype=bool)
+    missed[cacheable[hit]] = False
+    missed = np.flatnonzero(missed)
+    if missed.size:
+        elevation_origin[missed], terrain_slope[missed] = compute_slope_batch(
+            longitude_origin[missed], latitude_origin[missed], bearing_origin[missed], stride_length[missed])
+    missed_keys = [key for key, value in zip(keys, values) if value is None]
+    missed_cacheable = cacheable[~hit]
+    cache.put_many(missed_keys, zip(elevation_origin[missed_cacheable].tolist(),
+                                    terrain_slope[missed_cacheable].tolist()))
+    return elevation_origin, terrain_slope
+
+
+def compute_slope_batch(longitude_origin, latitude_origin, bearing_origin, stride_length):
+    """
+    The batch slope kernel itself, see slope_from_coord_bearing_batch
+    """
+    if gradient_strides:
+        return gradient_slope_batch(longitude_origin, latitude_origin, bearing_origin, stride_length)
+    return exact_slope_batch(longitude_origin, latitude_origin, bearing_origin, stride_length)
+
+
+def gradient_slope_batch(longitude_origin, latitude_origin, bearing_origin, stride_length):
+    """
+    Slopes taken from the gradient rasters: one gather and a dot product with the bearing's
+    components instead of two destination points and two void-safe lookups.
+    Strides without rasters and points without usable gradients go through exact_slope_batch.
+    """
+    elevation_origin = get_elevation_batch(longitude_origin, latitude_origin)
+    terrain_slope = np.full(longitude_origin.shape, np.nan)
+    exact = np.isfinite(bearing_origin)
+    for stride in gradient_strides:
+        on_raster = np.flatnonzero(exact & (stride_length == stride))
+        if on_raster.size == 0:
+            continue
+        east, north = tile_store.get_gradients(latitude_origin[on_raster], longitude_origin[on_raster], stride)
+        bearing_x, bearing_y = bearing_to_components(bearing_origin[on_raster])
+        terrain_slope[on_raster] = east * bearing_x + north * bearing_y
+        exact[on_raster] = np.isnan(terrain_slope[on_raster])
+    terrain_slope[np.isnan(elevation_origin)] = np.nan
+
+    exact = np.flatnonzero(exact | ~np.isfinite(bearing_origin))
+    if exact.size:
+        elevation_origin[exact], terrain_slope[exact] = exact_slope_batch(
+            longitude_origin[exact], latitude_origin[exact], bearing_origin[exact], stride_length[exact])
+    return elevation_origin, terrain_slope
+
+
+def exact_slope_batch(longitude_origin, latitude_origin, bearing_origin, stride_length):
+    """
+    The batch slope kernel taking every slope from the elevations ahead and behind
+    """
+    elevation_origin = get_elevation_batch(longitude_origin, latitude_origin)
+    terrain_slope = np.full(longitude_origin.shape, np.nan)
+
+    # Bearing is optional, points without one only get an elevation
+    has_bearing = np.flatnonzero(np.isfinite(bearing_origin))
+    if has_bearing.size < longitude_origin.size:
+        logger.warning("No bearing given for " + str(longitude_origin.size - has_bearing.size) +
+                       " points. Returning only elevation for those")
+    if has_bearing.size == 0:
+        return elevation_origin, terrain_slope
+
+    longitude = longitude_origin[has_bearing]
+    latitude = latitude_origin[has_bearing]
+    bearing_given = bearing_origin[has_bearing]
+    stride = stride_length[has_bearing]
+    longitude_ahead, latitude_ahead = lon_lat_from_distance_bearing_batch(longitude, latitude,
+                                                                          stride, bearing_given)
+    longitude_behind, latitude_behind = lon_lat_from_distance_bearing_batch(longitude, latitude,
+                                                                            (-1.0 * stride), bearing_given)
+    elevation_ahead = get_elevation_safe_batch(longitude_ahead, latitude_ahead)
+    elevation_behind = get_elevation_safe_batch(longitude_behind, latitude_behind)
+
+    terrain_slope[has_bearing] = (elevation_ahead - elevation_behind) / stride
+    # Like the scalar version, a missing elevation anywhere voids both results
+    incomplete = has_bearing[np.isnan(terrain_slope[has_bearing])]
+    elevation_origin[incomplete] = np.nan
+    terrain_slope[np.isnan(elevation_origin)] = np.nan
+    return elevation_origin, terrain_slope
+
+
+def slope_from_coords_only_batch(longitudes, latitudes, stride_length=250.0):
+    """
+    Array version of slope_from_coords_only
+    :param longitudes: (np.ndarray) longitudes of consecutive points
+    :param latitudes: (np.ndarray) latitudes of consecutive points
+    :param stride_length: (np.ndarray or float) resolution to calculate slope on in meters
+    :return: (np.ndarray, np.ndarray, np.ndarray) elevations, slopes and bearings (NaN for the last point)
+    """
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    stride_length = np.broadcast_to(np.asarray(stride_length, dtype=float), longitudes.shape)
+    elevations = np.full(longitudes.shape, np.nan)
+    slopes = np.full(longitudes.shape, np.nan)
+    bearings = np.full(longitudes.shape, np.nan)
+    if longitudes.size == 0:
+        return elevations, slopes, bearings
+
+    bearings[:-1] = bearing_batch(longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:])
+    elevations[:-1], slopes[:-1] = slope_from_coord_bearing_batch(longitudes[:-1], latitudes[:-1], bearings[:-1],
+                                                                  stride_length=stride_length[:-1])
+    elevations[-1:] = get_elevation_safe_batch(longitudes[-1:], latitudes[-1:])
+    return elevations, slopes, bearings
+
+
+def next_in_track(tracks):
+    """
+    For each point, the index of the next point of the same track (points keep their order within a track)
+    :param tracks: (np.ndarray) integer track codes
+    :return: (np.ndarray) indices of the next points, -1 for the last point of each track
+    """
+    tracks = np.asarray(tracks)
+    next_index = np.full(tracks.shape, -1, dtype=np.intp)
+    order = np.argsort(tracks, kind="mergesort")
+    same_track = tracks[order[:-1]] == tracks[order[1:]]
+    next_index[order[:-1][same_track]] = order[1:][same_track]
+    return next_index
+
+
+def plan_slope_batch(bearings, strides, next_index=None, max_stride_groups=16):
+    """
+    Partitions a batch by bearing availability and stride so each group can run through the
+    batch kernel in one go
+    :param bearings: (np.ndarray) given compass bearings, NaN where not given
+    :param strides: (np.ndarray) stride lengths in meters
+    :param next_index: (np.ndarray) index of each point's successor, -1 if it has none (default: the next point)
+    :param max_stride_groups: (int) with more distinct strides than this, groups are split by kind only
+    :return: (list[(str, float, np.ndarray)]) (kind, stride, indices) groups where kind is
+             "given" (has a bearing), "inferred" (bearing from the next point) or "final" (no bearing, no successor).
+             stride is None when the group mixes strides.
+    """
+    bearings = np.asarray(bearings, dtype=float)
+    strides = np.broadcast_to(np.asarray(strides, dtype=float), bearings.shape)
+    if next_index is None:
+        next_index = np.arange(1, bearings.size + 1)
+        next_index[-1:] = -1
+    kinds = np.where(np.isnan(bearings), np.where(next_index < 0, 2, 1), 0)
+    groups = []
+    for kind, kind_name in enumerate(["given", "inferred", "final"]):
+        in_kind = np.flatnonzero(kinds == kind)
+        if in_kind.size == 0:
+            continue
+        kind_strides, stride_index = np.unique(strides[in_kind], return_inverse=True)
+        if kind_strides.size > max_stride_groups:
+            groups.append((kind_name, None, in_kind))
+            continue
+        for i, stride in enumerate(kind_strides):
+            groups.append((kind_name, float(stride), in_kind[stride_index.reshape(-1) == i]))
+    return groups
+
+
+def slope_from_mixed_batch(longitudes, latitudes, bearings, strides, tracks=None, kernel=None):
+    """
+    Slopes for a batch that mixes given and missing bearings and different strides.
+    Points without a bearing get one inferred from the next point of their track (like
+    slope_from_coords_only), the last point of a track only gets an elevation if it has no bearing.
+    :param longitudes: (np.ndarray) longitudes
+    :param latitudes: (np.ndarray) latitudes
+    :param bearings: (np.ndarray) given compass bearings, NaN where not given
+    :param strides: (np.ndarray or float) stride lengths in meters
+    :param tracks: (np.ndarray) integer track codes, None if the whole batch is one track
+    :param kernel: (function) runs a group, defaults to slope_from_coord_bearing_batch
+    :return: (np.ndarray, np.ndarray, np.ndarray) elevations, slopes and bearings (given or inferred)
+    """
+    if kernel is None:
+        kernel = slope_from_coord_bearing_batch
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    bearings = np.array(bearings, dtype=float)
+    strides = np.broadcast_to(np.asarray(strides, dtype=float), longitudes.shape)
+    elevations = np.full(longitudes.shape, np.nan)
+    slopes = np.full(longitudes.shape, np.nan)
+    next_index = None if tracks is None else next_in_track(tracks)
+    for kind, stride, indices in plan_slope_batch(bearings, strides, next_index=next_index):
+        if kind == "final":
+            elevations[indices] = get_elevation_safe_batch(longitudes[indices], latitudes[indices])
+            continue
+        if kind == "inferred":
+            successors = indices + 1 if next_index is None else next_index[indices]
+            bearings[indices] = bearing_batch(longitudes[indices], latitudes[indices],
+                                              longitudes[successors], latitudes[successors])
+        group_strides = strides[indices] if stride is None else stride
+        elevations[indices], slopes[indices] = kernel(longitudes[indices], latitudes[indices], bearings[indices],
+                                                      group_strides)
+    return elevations, slopes, bearings
+
+
+def grid_coordinates(south, west, north, east, resolution):
+    """
+    Centers of the cells of a grid covering a bounding box. Cells are resolution degrees on a side and
+    line up with whole degrees, and so with the SRTM cells when resolution is a multiple of theirs.
+    :return: (np.ndarray, np.ndarray) latitude of each row (north to south), longitude of each column
+    """
+    # The tolerance keeps a box edge that is on a cell edge from picking up an extra cell
+    north_edge = int(np.ceil(north / resolution - 1e-6))
+    south_edge = min(int(np.floor(south / resolution + 1e-6)), north_edge - 1)
+    west_edge = int(np.floor(west / resolution + 1e-6))
+    east_edge = max(int(np.ceil(east / resolution - 1e-6)), west_edge + 1)
+    latitudes = (north_edge - 0.5 - np.arange(north_edge - south_edge)) * resolution
+    longitudes = (west_edge + 0.5 + np.arange(east_edge - west_edge)) * resolution
+    return latitudes, longitudes
+
+
+def get_native_resolution(latitude, longitude):
+    """
+    :return: (float) size in degrees of the SRTM cells at a coordinate (3 arc-seconds without data)
+    """
+    tile = tile_store.get_tile(latitude, longitude)
+    return 1.0 / (1200 if tile is None else tile.side - 1)
+
+
+def slope_and_aspect_grid(elevations, row_latitudes, resolution):
+    """
+    Steepest slope of every cell of an elevation grid and the compass direction it faces downhill,
+    from central differences with the neighbouring cells
+    :param elevations: (np.ndarray) elevation grid (rows north to south), SRTM_VOID where unknown
+    :param row_latitudes: (np.ndarray) latitude of each row
+    :param resolution: (float) cell size in degrees
+    :return: (np.ndarray, np.ndarray) slopes (meters/meter) and aspects (degrees, north is 0), NaN on the
+             grid's edge, next to unknown cells and (aspects) on flat ground
+    """
+    elevations = np.where(elevations == SRTM_VOID, np.nan, elevations.astype(float))
+    row_length = np.radians(resolution) * calc_earth_radius_batch(row_latitudes)
+    column_lengths = row_length * np.cos(np.radians(row_latitudes))
+    north = np.full(elevations.shape, np.nan)
+    east = np.full(elevations.shape, np.nan)
+    # Rows run north to south
+    north[1:-1] = (elevations[:-2] - elevations[2:]) / (2 * row_length[1:-1, np.newaxis])
+    east[:, 1:-1] = (elevations[:, 2:] - elevations[:, :-2]) / (2 * column_lengths[:, np.newaxis])
+    slopes = np.hypot(east, north)
+    aspects = np.degrees(np.arctan2(-east, -north)) % 360.0
+    aspects[slopes == 0] = np.nan
+    return slopes.astype(np.float32), aspects.astype(np.float32)
+
+
+def get_terrain_grid(south, west, north, east, resolution=None, slope=False, aspect=False, fill_radius=None):
+    """
+    Terrain of a bounding box as grids
+    :param resolution: (float) cell size in degrees, defaults to the SRTM cells at the box's north-west corner
+    :param slope: (bool) add a grid of steepest slopes (see slope_and_aspect_grid)
+    :param aspect: (bool) add a grid of the directions slopes face
+    :param fill_radius: (float) if given, fill voids from the nearest valid cell within this many degrees
+    :return: (dict) "elevation" (int16 meters, SRTM_VOID where unknown), "latitude" and "longitude" of the
+             rows and columns and, if asked for, "slope" and "aspect" (float32, NaN where unknown)
+    """
+    if resolution is None:
+        resolution = get_native_resolution(north - 1e-9, west)
+    latitudes, longitudes = grid_coordinates(south, west, north, east, resolution)
+    grid = {"latitude": latitudes, "longitude": longitudes}
+    if not (slope or aspect):
+        grid["elevation"] = tile_store.get_grid(latitudes, longitudes, fill_radius=fill_radius)
+        return grid
+    # A ring of extra cells gives the differences at the edges something to work with
+    padded_latitudes = np.concatenate([[latitudes[0] + resolution], latitudes, [latitudes[-1] - resolution]])
+    padded_longitudes = np.concatenate([[longitudes[0] - resolution], longitudes, [longitudes[-1] + resolution]])
+    padded = tile_store.get_grid(padded_latitudes, padded_longitudes, fill_radius=fill_radius)
+    grid["elevation"] = padded[1:-1, 1:-1]
+    slopes, aspects = slope_and_aspect_grid(padded, padded_latitudes, resolution)
+    if slope:
+        grid["slope"] = slopes[1:-1, 1:-1]
+    if aspect:
+        grid["aspect"] = aspects[1:-1, 1:-1]
+    return grid
+
+
+def densify_route(longitudes, latitudes, interval):
+    """
+    Samples a polyline every interval meters along it, following the great circle of each segment
+    :param longitudes: (np.ndarray) longitudes of the polyline's vertices
+    :param latitudes: (np.ndarray) latitudes of the polyline's vertices
+    :param interval: (float) meters between samples, the last sample is the polyline's end
+    :return: (np.ndarray, np.ndarray, np.ndarray) longitudes, latitudes and distances along the route of the samples
+    """
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    vertex_distances = np.zeros(longitudes.size)
+    vertex_distances[1:] = np.cumsum(haversine_batch(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]))
+    total = vertex_distances[-1]
+    distances = np.arange(0.0, total, interval)
+    if (distances.size == 0) or (distances[-1] < total):
+        distances = np.append(distances, total)
+    if longitudes.size == 1:
+        return longitudes.copy(), latitudes.copy(), distances
+    # Each sample is walked out from the start of its segment (empty segments never get a sample)
+    segments = np.clip(np.searchsorted(vertex_distances, distances, side="right") - 1, 0, longitudes.size - 2)
+    segment_bearings = bearing_batch(longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:])
+    # The walk uses a different earth radius than haversine, rescale so it covers the same angle
+    start_latitudes = latitudes[segments]
+    radius_ratio = (calc_earth_radius_batch(np.radians(start_latitudes)) /
+                    ((calc_earth_radius_batch(start_latitudes) + calc_earth_radius_batch(latitudes[segments + 1])) / 2))
+    sample_longitudes, sample_latitudes = lon_lat_from_distance_bearing_batch(
+        longitudes[segments], start_latitudes, (distances - vertex_distances[segments]) * radius_ratio,
+        segment_bearings[segments])
+    # Land exactly on the end rather than wherever the walk out ends up
+    sample_longitudes[-1], sample_latitudes[-1] = longitudes[-1], latitudes[-1]
+    sample_longitudes = np.where(sample_longitudes > 180.0, sample_longitudes - 360.0, sample_longitudes)
+    sample_longitudes = np.where(sample_longitudes < -180.0, sample_longitudes + 360.0, sample_longitudes)
+    return sample_longitudes, sample_latitudes, distances
+
+
+def route_profile(longitudes, latitudes, interval, fill_radius=None):
+    """
+    Elevation profile of a route, sampled every interval meters along it (see densify_route)
+    :param fill_radius: (float) furthest (in degrees) to fill voids from (see get_elevation_safe_batch)
+    :return: (dict) per sample "longitude", "latitude", "distance" (meters along the route), "elevation",
+             "grade" (rise over run from the previous sample, NaN for the first one and next to unknown
+             elevations), and "climb"/"descent" (meters gained/lost since the start, unknown elevations add nothing)
+    """
+    sample_longitudes, sample_latitudes, distances = densify_route(longitudes, latitudes, interval)
+    elevations = get_elevation_safe_batch(sample_longitudes, sample_latitudes, fill_radius=fill_radius)
+    rises = np.diff(elevations)
+    runs = np.diff(distances)
+    grades = np.full(distances.size, np.nan)
+    grades[1:] = np.where(runs > 0, rises / np.where(runs > 0, runs, 1.0), np.nan)
+    rises = np.nan_to_num(rises)
+    climbs = np.zeros(distances.size)
+    descents = np.zeros(distances.size)
+    climbs[1:] = np.cumsum(np.maximum(rises, 0.0))
+    descents[1:] = np.cumsum(np.maximum(-rises, 0.0))
+    return {"longitude": sample_longitudes, "latitude": sample_latitudes, "distance": distances,
+            "elevation": elevations, "grade": grades, "climb": climbs, "descent": descents}
+
+
+def decimate_track(longitudes, latitudes, tracks=None, times=None, strides=None, bearings=None, min_distance=0.0,
+                   min_seconds=0.0):
+    """
+    Collapses runs of consecutive track points that fall within the same min_distance meters of track
+    (haversine distance along it) and/or the same min_seconds, so only the first point of each run
+    (its representative) needs a lookup. The last point of a track is always a representative of its own,
+    so bearings can still be inferred all the way to it.
+    :param tracks: (np.ndarray) integer track codes, None if the whole batch is one track. Tracks may be
+                   interleaved, points keep their order within a track (like next_in_track)
+    :param times: (np.ndarray) timestamps in seconds (NaN where unknown), only needed with min_seconds
+    :param strides: (np.ndarray) stride lengths, runs don't mix strides
+    :param bearings: (np.ndarray) given bearings (NaN where not given), points with one start a run of their own
+                     so their slope is measured along their bearing
+    :param min_distance: (float) meters, 0 to not group by distance
+    :param min_seconds: (float) seconds, 0 to not group by time
+    :return: (np.ndarray, np.ndarray, np.ndarray) indices of the representatives (track by track, so the
+             representative after one is the next of its track unless it was the track's last), for every
+             point the position of its representative among them, and every point's distance along its track
+    """
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    size = longitudes.size
+    new_track = np.ones(size, dtype=bool)
+    order = None
+    if tracks is not None:
+        # Line up the points of each track, the runs are found in that order and mapped back at the end
+        order = np.argsort(np.asarray(tracks), kind="mergesort")
+        tracks = np.asarray(tracks)[order]
+        longitudes = longitudes[order]
+        latitudes = latitudes[order]
+        if times is not None:
+            times = np.asarray(times, dtype=float)[order]
+        if strides is not None:
+            strides = np.broadcast_to(np.asarray(strides, dtype=float), (size,))[order]
+        if bearings is not None:
+            bearings = np.asarray(bearings, dtype=float)[order]
+        new_track[1:] = tracks[1:] != tracks[:-1]
+    else:
+        new_track[1:] = False
+    track_start = np.maximum.accumulate(np.where(new_track, np.arange(size), 0))
+
+    steps = np.zeros(size)
+    steps[1:] = haversine_batch(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    steps[new_track] = 0.0
+    along = np.cumsum(steps)
+    along -= along[track_start]
+
+    starts = new_track.copy()
+    starts[:-1] |= new_track[1:]  # the last point of a track
+    starts[-1:] = True
+    if not ((min_distance > 0) or ((min_seconds > 0) and (times is not None))):
+        starts[:] = True  # nothing to group by, every point is looked up
+    if min_distance > 0:
+        stretch = np.floor(along / min_distance)
+        starts[1:] |= stretch[1:] != stretch[:-1]
+    if (min_seconds > 0) and (times is not None):
+        times = np.asarray(times, dtype=float)
+        window = np.floor((times - times[track_start]) / min_seconds)
+        starts[1:] |= ~(window[1:] == window[:-1])  # unknown times are never grouped
+    if strides is not None:
+        strides = np.broadcast_to(np.asarray(strides, dtype=float), (size,))
+        starts[1:] |= strides[1:] != strides[:-1]
+    if bearings is not None:
+        starts |= ~np.isnan(np.asarray(bearings, dtype=float))
+    representatives = np.flatnonzero(starts)
+    group = np.cumsum(starts) - 1
+    if order is None:
+        return representatives, group, along
+    unsorted_group = np.empty_like(group)
+    unsorted_group[order] = group
+    unsorted_along = np.empty_like(along)
+    unsorted_along[order] = along
+    return order[representatives], unsorted_group, unsorted_along
+
+
+def decimated_slope_batch(longitudes, latitudes, bearings, strides, tracks=None, times=None, min_distance=0.0,
+                          min_seconds=0.0, kernel=None):
+    """
+    slope_from_mixed_batch for dense tracks: only the representatives of decimate_track are looked up.
+    Elevations of the other points are interpolated along the track between representatives, slopes and
+    bearings are back-filled from their representative (points with a bearing of their own are representatives).
+    :return: (np.ndarray, np.ndarray, np.ndarray) elevations, slopes and bearings (given or inferred)
+    """
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    bearings = np.asarray(bearings, dtype=float)
+    strides = np.broadcast_to(np.asarray(strides, dtype=float), longitudes.shape)
+    representatives, group, along = decimate_track(longitudes, latitudes, tracks=tracks, times=times,
+                                                   strides=strides, bearings=bearings, min_distance=min_distance,
+                                                   min_seconds=min_seconds)
+    if representatives.size == longitudes.size:
+        return slope_from_mixed_batch(longitudes, latitudes, bearings, strides, tracks=tracks, kernel=kernel)
+    metrics.DECIMATED_POINTS.inc(longitudes.size - representatives.size)
+    rep_elevations, rep_slopes, rep_bearings = slope_from_mixed_batch(
+        longitudes[representatives], latitudes[representatives], bearings[representatives],
+        strides[representatives], tracks=None if tracks is None else np.asarray(tracks)[representatives],
+        kernel=kernel)
+
+    # Interpolate towards the next representative of the same track (the last run of a track just copies)
+    next_group = np.minimum(group + 1, representatives.size - 1)
+    start = representatives[group]
+    end = representatives[next_group]
+    same_track = (next_group > group) & (along[end] > along[start])
+    if tracks is not None:
+        same_track &= np.asarray(tracks)[end] == np.asarray(tracks)[start]
+    # Runs ending on an unknown elevation just copy too, rather than becoming unknown themselves
+    interpolate = same_track & ~np.isnan(rep_elevations[next_group])
+    fraction = np.zeros(longitudes.shape)
+    fraction[interpolate] = ((along - along[start])[interpolate] / (along[end] - along[start])[interpolate])
+    elevations = rep_elevations[group] + fraction * (rep_elevations[next_group] - rep_elevations[group])
+    elevations[~interpolate] = rep_elevations[group][~interpolate]
+    elevations = np.round(elevations)  # whole meters, like the tiles
+    return elevations, rep_slopes[group], rep_bearings[group]
+
+
 def should_be_a_test(args):
     """
     Main code block
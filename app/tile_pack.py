@@ -0,0 +1,274 @@
+"""
+Offline SRTM tile packs.
+
+A pack is one file holding every tile of a set of regions, so groundhog can start
+without srtm.py ever going to the network. Tiles are cut into bands of rows that
+are zlib compressed on their own, and only the bands a request touches get
+decompressed. Void indexes are built ahead of time and packed along with the tiles.
+
+Decompressed bands live on the heap of the process that reads them. With pre-forked
+workers, tiles are decompressed whole before the fork (see HgtTileStore.preload) so
+the workers share one copy; tiles first read after the fork are held once per worker.
+
+Layout:
+    compressed row bands and void indexes, back to back
+    JSON index: {"version", "chunk_rows", "tiles": {file name: {"side", "chunks", "void_index"}}}
+        where chunks are [offset, length] of each band and void_index is [offset, length]
+    footer: index offset (uint64, little endian) + MAGIC
+
+Build a pack (tiles missing from the tile dir are downloaded through srtm.py):
+    python tile_pack.py -o conus.ghpack --region conus --bbox 17.8,-67.3,18.6,-65.2
+"""
+
+import argparse
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from math import floor
+import numpy as np
+import srtm_elevation_and_slope as srtm_methods
+
+logger = logging.getLogger()
+
+MAGIC = b"GHPACK01"
+FOOTER = struct.Struct("<Q8s")
+# Named regions as (south, west, north, east) in degrees
+REGIONS = {
+    "conus": (24.0, -125.0, 50.0, -66.0),
+    "alaska": (51.0, -180.0, 72.0, -129.0),
+    "hawaii": (18.0, -161.0, 23.0, -154.0),
+}
+
+
+class PackedTileData:
+    """
+    Stands in for a tile's memory-mapped array: indexing it decompresses the row bands
+    it touches (once) into a lazily allocated array and reads from there
+    """
+
+    def __init__(self, pack, side, chunks):
+        self.pack = pack
+        self.side = side
+        self.shape = (side, side)
+        self.dtype = np.dtype(">i2")
+        self.chunks = chunks
+        self.chunk_rows = pack.chunk_rows
+        self.array = None  # pages are only committed for the bands actually filled in
+        self.loaded = np.zeros(len(chunks), dtype=bool)
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.side * self.side * self.dtype.itemsize
+
+    def get_touched_chunks(self, rows):
+        """
+        :return: (np.ndarray) the row bands a row index (int, slice or array) reaches into
+        """
+        if isinstance(rows, slice):
+            rows = np.arange(self.side)[rows]
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + self.side, rows)
+        return np.unique(rows // self.chunk_rows)
+
+    def load_chunks(self, chunk_ids):
+        with self.lock:
+            if self.array is None:
+                self.array = np.empty(self.shape, dtype=self.dtype)
+            for chunk_id in chunk_ids:
+                if self.loaded[chunk_id]:
+                    continue
+                offset, length = self.chunks[chunk_id]
+                band = np.frombuffer(zlib.decompress(self.pack.read(offset, length)), dtype=self.dtype)
+                first_row = chunk_id * self.chunk_rows
+                self.array[first_row:first_row + band.size // self.side] = band.reshape(-1, self.side)
+                self.loaded[chunk_id] = True
+
+    def __getitem__(self, key):
+        rows = key[0] if isinstance(key, tuple) else key
+        chunk_ids = self.get_touched_chunks(rows)
+        if (self.array is None) or not self.loaded[chunk_ids].all():
+            self.load_chunks(chunk_ids[~self.loaded[chunk_ids]])
+        return self.array[key]
+
+    def __array__(self, dtype=None, copy=None):
+        """
+        The whole tile (every band gets decompressed), copy follows the NumPy 2 protocol
+        """
+        self.load_chunks(range(len(self.chunks)))
+        if (dtype is None) or (np.dtype(dtype) == self.dtype):
+            return self.array.copy() if copy else self.array
+        if copy is False:
+            raise ValueError("A tile can't be converted to " + str(np.dtype(dtype)) + " without a copy")
+        return self.array.astype(dtype)
+
+
+class PackedHgtTile(srtm_methods.HgtTile):
+    """
+    An SRTM tile read out of a tile pack rather than a .hgt file
+    """
+    __slots__ = ["pack", "void_location"]
+
+    def __init__(self, pack, file_name, entry):
+        latitude, longitude = srtm_methods.HgtTileStore.parse_file_name(file_name)
+        self.pack = pack
+        self.file_name = file_name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.side = entry["side"]
+        self.path = pack.path + ":" + file_name
+        self.data = PackedTileData(pack, entry["side"], entry["chunks"])
+        self.void_location = entry["void_index"]
+        self.void_index = None
+        self.gradients = {}
+
+    def get_gradient_cache_path(self):
+        return None  # packs are read-only, gradients are kept in memory
+
+    def load(self):
+        """
+        Decompresses every band, e.g. before forking so the workers share the array copy-on-write
+        rather than each decompressing (and holding) their own
+        """
+        self.data.load_chunks(range(len(self.data.chunks)))
+
+    def get_void_index(self):
+        if self.void_index is None:
+            with self.index_lock:
+                if self.void_index is None:
+                    offset, length = self.void_location
+                    self.void_index = np.load(io.BytesIO(zlib.decompress(self.pack.read(offset, length))),
+                                              allow_pickle=False)
+        return self.void_index
+
+
+class TilePack:
+    """
+    A read-only tile pack, memory-mapped so processes share its pages
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as pack_file:
+            self.buffer = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, magic = FOOTER.unpack(self.buffer[-FOOTER.size:])
+        if magic != MAGIC:
+            raise ValueError(path + " is not a tile pack")
+        index = json.loads(self.buffer[index_offset:-FOOTER.size].decode("utf-8"))
+        self.chunk_rows = index["chunk_rows"]
+        self.tiles = index["tiles"]
+        logger.info("Opened tile pack " + path + " with " + str(len(self.tiles)) + " tiles")
+
+    @property
+    def file_names(self):
+        return sorted(self.tiles)
+
+    def read(self, offset, length):
+        return self.buffer[offset:offset + length]
+
+    def get_tile(self, file_name):
+        """
+        :return: (PackedHgtTile) the tile, None if it isn't in the pack
+        """
+        entry = self.tiles.get(file_name)
+        if entry is None:
+            return None
+        return PackedHgtTile(self, file_name, entry)
+
+
+def get_tile_corners(bbox):
+    """
+    South-west corners of the tiles overlapping a (south, west, north, east) box
+    """
+    south, west, north, east = bbox
+    return [(latitude, longitude)
+            for latitude in range(int(floor(south)), int(floor(north)) + 1)
+            for longitude in range(int(floor(west)), int(floor(east)) + 1)
+            if (-90 <= latitude < 90) and (-180 <= longitude < 180)]
+
+
+def build_pack(path, bboxes, tile_store, chunk_rows=64, level=6):
+    """
+    Writes a tile pack holding every tile with SRTM data that overlaps the boxes
+    :param bboxes: (list[tuple]) (south, west, north, east) boxes in degrees
+    :param tile_store: (HgtTileStore) where tiles are read from (and downloaded to)
+    :param chunk_rows: (int) rows per compressed band, smaller bands mean less decompression per lookup
+    :param level: (int) zlib compression level
+    :return: (int) number of tiles packed
+    """
+    corners = sorted(set(corner for bbox in bboxes for corner in get_tile_corners(bbox)))
+    logger.info("Packing up to " + str(len(corners)) + " tiles into " + path)
+    tiles = {}
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, "wb") as pack_file:
+        for latitude, longitude in corners:
+            tile = tile_store.get_tile(latitude, longitude)
+            if tile is None:
+                continue
+            data = np.asarray(tile.data)
+            chunks = []
+            for first_row in range(0, tile.side, chunk_rows):
+                band = zlib.compress(data[first_row:first_row + chunk_rows].astype(">i2").tobytes(), level)
+                chunks.append([pack_file.tell(), len(band)])
+                pack_file.write(band)
+            void_buffer = io.BytesIO()
+            np.save(void_buffer, np.asarray(tile.get_void_index()))
+            void_index = zlib.compress(void_buffer.getvalue(), level)
+            tiles[tile.file_name] = {"side": tile.side, "chunks": chunks,
+                                     "void_index": [pack_file.tell(), len(void_index)]}
+            pack_file.write(void_index)
+            logger.info("Packed " + tile.file_name)
+        index_offset = pack_file.tell()
+        pack_file.write(json.dumps({"version": 1, "chunk_rows": chunk_rows, "tiles": tiles}).encode("utf-8"))
+        pack_file.write(FOOTER.pack(index_offset, MAGIC))
+    os.replace(temp_path, path)
+    logger.info("Packed " + str(len(tiles)) + " tiles (" + str(os.path.getsize(path) // 2 ** 20) + " MB)")
+    return len(tiles)
+
+
+def parse_bbox(text):
+    values = [float(value) for value in text.split(",")]
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("A bounding box is south,west,north,east")
+    return tuple(values)
+
+
+def get_command_line():
+    """
+    Get command line arguments
+    """
+    ap = argparse.ArgumentParser(description="Builds an offline SRTM tile pack for groundhog")
+    ap.add_argument("-d", "--debug", dest="debug", action="store_true", help="Switch to activate debug mode.")
+    ap.set_defaults(debug=False)
+    ap.add_argument("-o", "--output", type=str, required=True, help="Path of the pack to write.")
+    ap.add_argument("-r", "--region", dest="regions", action="append", default=[], choices=sorted(REGIONS),
+                    help="Named region to pack (repeatable).", required=False)
+    ap.add_argument("-b", "--bbox", dest="bboxes", action="append", default=[], type=parse_bbox,
+                    help="Bounding box to pack as south,west,north,east in degrees (repeatable).", required=False)
+    ap.add_argument("-t", "--tile-dir", dest="tile_dir", type=str, default=None,
+                    help="Directory of raw SRTM .hgt tiles (defaults to the srtm.py cache).", required=False)
+    ap.add_argument("--offline", action="store_true",
+                    help="Only pack tiles already in the tile dir, don't download any.")
+    ap.add_argument("--chunk-rows", dest="chunk_rows", type=int, default=64,
+                    help="Tile rows per compressed band.", required=False)
+    ap.add_argument("--level", type=int, default=6, help="zlib compression level (1-9).", required=False)
+    command_line_args = ap.parse_args()
+    if not (command_line_args.regions or command_line_args.bboxes):
+        ap.error("Give at least one --region or --bbox")
+    return command_line_args
+
+
+if __name__ == "__main__":
+    args = get_command_line()
+    logging.basicConfig()
+    logger.setLevel("DEBUG" if args.debug else "INFO")
+    store = srtm_methods.HgtTileStore(tile_dir=args.tile_dir, fetch_missing=not args.offline, cache_bytes=2 ** 30)
+    build_pack(args.output, [REGIONS[region] for region in args.regions] + args.bboxes, store,
+               chunk_rows=args.chunk_rows, level=args.level)
@@ -1,85 +1,604 @@
-from requests import post
+from concurrent.futures import ThreadPoolExecutor
+import io
+import multiprocessing as mp
+import os
+import sqlite3
+import sys
+import requests
+import numpy as np
 import pandas as pd
 import json
-from uuid import uuid4
+import time
+
+# Responses worth another try, the server (or a proxy in front of it) is busy or restarting.
+# Not 500: a payload the server chokes on fails the same way every time
+RETRY_STATUSES = (429, 502, 503, 504)
+NPZ_MIMETYPE = 'application/x-npz'
+RESULT_COLUMNS = ['bearing', 'slope', 'elevation']
+DEFAULT_STRIDE = 250.0  # meters, what the service uses when none is given
+CACHE_BLOCK_CELLS = 8192  # cache blocks are this many cells on a side
+SQLITE_MAX_VARIABLES = 900  # older SQLite builds take at most 999 parameters per statement
+
+_engine = None  # srtm_elevation_and_slope, once local mode has imported it
 
 
 class GroundhogClient:
     """
     groundhog client that deals with negotiating withe the
     groundhog API.
+
+    Connections are pooled in a session. Big payloads are split into chunks
+    that are sent concurrently by a few workers, and failed requests are
+    retried with exponential backoff.
+
+    With local=True there is no service: the groundhog engine is imported
+    from engine_dir and run in this process (or across a pool of processes)
+    against the tiles in tile_dir, and queries return the same results as
+    they would from the service.
     """
 
-    def __init__(self, host_name='localhost', port=5005):
+    def __init__(self, host_name='localhost', port=5005, workers=4, chunk_size=50000,
+                 max_retries=3, backoff_factor=0.5, timeout=600,
+                 local=False, tile_dir=None, processes=0, engine_dir=None):
+        """
+        local - run the engine in-process instead of calling the service
+        tile_dir - (local mode, required) directory of SRTM .hgt tiles, only those tiles are used
+                   (nothing is downloaded)
+        processes - (local mode) size of a process pool to run chunks on, 0 runs them in this process
+        engine_dir - (local mode, required) directory holding srtm_elevation_and_slope.py (the app
+                     directory of the groundhog repo), the engine is only ever imported from there
+        """
+        assert workers >= 1
+        assert chunk_size >= 2
+        self.local = local
+        self.pool = None
+        self.session = None
+        self.workers = workers
+        self.chunk_size = chunk_size
+        if local:
+            _load_engine(engine_dir, tile_dir)
+            if processes > 0:
+                self.pool = mp.Pool(processes, initializer=_load_engine, initargs=(engine_dir, tile_dir))
+                self.workers = processes  # one chunk in flight per process
+            return
         assert isinstance(host_name, str)
         assert isinstance(port, int)
         self.host_name = host_name
         self.port = port
         self.url = "http://{}:{}/groundhog".format(self.host_name, self.port)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run_local(self, columns):
+        """
+        Run a columnar query through the local engine (on the pool if there is one).
+        """
+        if self.pool is not None:
+            return(self.pool.apply(_run_engine, (columns,)))
+        return(_run_engine(columns))
+
+    def _post(self, data, headers):
+        """
+        POST to groundhog, retrying connection errors and busy responses
+        with exponential backoff.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, headers=headers, data=data, timeout=self.timeout)
+                if (response.status_code not in RETRY_STATUSES) or (attempt == self.max_retries):
+                    response.raise_for_status()
+                    return(response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            time.sleep(self.backoff_factor * (2 ** attempt))
 
     def get_query(self, payload_json):
         assert isinstance(payload_json, list)
+        if self.local:
+            columns, tracks = _records_to_columns(payload_json)
+            return(_results_to_records(payload_json, columns, tracks, self._run_local(columns)))
         headers = {'Content-Type': 'application/json'}
-        response = post(self.url, headers=headers, data=json.dumps(payload_json))
+        response = self._post(json.dumps(payload_json), headers)
         return(response.json())
 
+    def get_npz_query(self, columns):
+        """
+        Query groundhog with a columnar (.npz) payload.
+        columns is a dictionary of numpy arrays: latitude, longitude and
+        optionally bearing, stride, unique_key and track.
+        Returns a dictionary of elevation, slope and bearing arrays (NaN where unknown).
+        """
+        if self.local:
+            return(self._run_local(columns))
+        buffer = io.BytesIO()
+        np.savez(buffer, **columns)
+        response = self._post(buffer.getvalue(), {'Content-Type': NPZ_MIMETYPE})
+        with np.load(io.BytesIO(response.content), allow_pickle=False) as results:
+            return({name: results[name] for name in results.files})
+
+    def _get_chunks(self, tracks):
+        """
+        Split a payload of len(tracks) points into chunks of at most chunk_size
+        points (plus an overlap).
+        When a chunk ends in the middle of a track, the next point is sent
+        along as well so the server can infer the bearing of the chunk's last
+        point. That overlap point's result is dropped, the next chunk has the
+        real one.
+        Returns a list of (start, end, number of results to keep)
+        """
+        chunks = []
+        for start in range(0, len(tracks), self.chunk_size):
+            end = min(start + self.chunk_size, len(tracks))
+            num_keep = end - start
+            if (end < len(tracks)) and (tracks[end] == tracks[end - 1]):
+                end += 1
+            chunks.append((start, end, num_keep))
+        return(chunks)
+
+    def _map_chunks(self, get_chunk, chunks):
+        """
+        Run get_chunk(start, end, num_keep) for every chunk, concurrently
+        when there is more than one.
+        """
+        if len(chunks) <= 1:
+            return([get_chunk(*chunk) for chunk in chunks])
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return(list(executor.map(lambda chunk: get_chunk(*chunk), chunks)))
+
     def get_df(self, payload_json):
         """
         Get a pandas DataFrame representation of a query result.
+        Payloads bigger than chunk_size are sent as concurrent chunks.
         """
-        response_df = pd.DataFrame.from_records(self.get_query(payload_json))[['bearing', 'slope', 'elevation', 'unique_key']]
+        columns = ['bearing', 'slope', 'elevation', 'unique_key']
+        chunks = self._get_chunks([record.get('track') for record in payload_json])
+
+        def get_chunk(start, end, num_keep):
+            return(self.get_query(payload_json[start:end])[:num_keep])
+        records = [record for chunk_records in self._map_chunks(get_chunk, chunks)
+                   for record in chunk_records]
+        response_df = pd.DataFrame.from_records(records, columns=columns)
         assert response_df.shape[0] == len(payload_json)
         return(response_df)
 
+    def get_arrays(self, columns):
+        """
+        Like get_npz_query, but payloads bigger than chunk_size are sent as
+        concurrent chunks. The results are concatenated back in payload order.
+        """
+        num_points = len(columns['latitude'])
+        tracks = columns.get('track')
+        if tracks is None:
+            tracks = np.zeros(num_points, dtype=np.int8)  # a single track
+        chunks = self._get_chunks(tracks)
+
+        def get_chunk(start, end, num_keep):
+            results = self.get_npz_query({name: values[start:end] for name, values in columns.items()})
+            return({name: results[name][:num_keep] for name in RESULT_COLUMNS})
+        chunk_results = self._map_chunks(get_chunk, chunks)
+        results = {}
+        for name in RESULT_COLUMNS:
+            results[name] = (np.concatenate([chunk[name] for chunk in chunk_results]) if chunk_results
+                             else np.empty(0))
+            assert results[name].shape[0] == num_points
+        return(results)
+
 
-def _get_payload_json(df):
+def _load_engine(engine_dir, tile_dir):
     """
-    Given a pandas DataFrame, create a query body to send
-    to groundhog.
+    Import the groundhog engine (srtm_elevation_and_slope.py) from engine_dir for local mode.
+    The engine reads its tiles from tile_dir and never downloads any.
+    """
+    global _engine
+    if (engine_dir is None) or (tile_dir is None):
+        # The engine isn't part of this package, it lives in the app directory of the groundhog repo
+        raise ValueError('Local mode needs engine_dir=<the app directory of a groundhog checkout> (where '
+                         'srtm_elevation_and_slope.py is) and tile_dir=<a directory of SRTM .hgt tiles>')
+    if engine_dir not in sys.path:
+        sys.path.insert(0, engine_dir)
+    try:
+        import srtm_elevation_and_slope as engine
+    except ImportError as e:
+        raise ImportError('No groundhog engine (srtm_elevation_and_slope.py) in engine_dir ' + engine_dir +
+                          ' (' + str(e) + ')')
+    engine_path = os.path.realpath(engine.__file__)
+    if os.path.dirname(engine_path) != os.path.realpath(engine_dir):
+        raise ImportError('srtm_elevation_and_slope is already imported from ' + engine_path +
+                          ', not from engine_dir ' + engine_dir)
+    if (engine.tile_store.tile_dir != tile_dir) or engine.tile_store.fetch_missing:
+        engine.tile_store = engine.HgtTileStore(tile_dir=tile_dir, fetch_missing=False)
+    _engine = engine
+    return(engine)
+
+
+def _run_engine(columns):
+    """
+    What the service does with a columnar query, done by the local engine.
+    Returns a dictionary of elevation, slope and bearing arrays (NaN where unknown).
+    """
+    latitudes = np.asarray(columns['latitude'], dtype=float)
+    longitudes = np.asarray(columns['longitude'], dtype=float)
+    longitudes = np.where(longitudes > 180.0, longitudes - 360.0, longitudes)
+    if 'bearing' in columns:
+        bearings = np.asarray(columns['bearing'], dtype=float)
+    else:
+        bearings = np.full(latitudes.shape, np.nan)
+    strides = np.asarray(columns['stride'], dtype=float) if 'stride' in columns else DEFAULT_STRIDE
+    tracks = None
+    if 'track' in columns:
+        tracks = np.unique(columns['track'], return_inverse=True)[1].reshape(-1)
+    results = {}
+    if latitudes.size > 0:
+        results['elevation'], results['slope'], results['bearing'] = _engine.slope_from_mixed_batch(
+            longitudes, latitudes, bearings, strides, tracks=tracks)
+    else:
+        results['elevation'] = results['slope'] = results['bearing'] = np.empty(0)
+    if 'unique_key' in columns:
+        results['unique_key'] = columns['unique_key']
+    if 'track' in columns:
+        results['track'] = columns['track']
+    return(results)
+
+
+def _records_to_columns(payload_json):
+    """
+    Columns of a JSON query body for the local engine (tracks are numbered).
+    Returns the columns and the track of each record (None if none names one).
+    """
+    latitudes = []
+    longitudes = []
+    for record in payload_json:
+        if (record.get('latitude') is None) or (record.get('longitude') is None):
+            latitudes.append(record['geo_point']['lat'])
+            longitudes.append(record['geo_point']['lon'])
+        else:
+            latitudes.append(record['latitude'])
+            longitudes.append(record['longitude'])
+    columns = {'latitude': np.asarray(latitudes, dtype=float),
+               'longitude': np.asarray(longitudes, dtype=float),
+               'bearing': np.array([record.get('bearing') for record in payload_json], dtype=float),
+               'stride': np.array([DEFAULT_STRIDE if record.get('stride') is None else record['stride']
+                                   for record in payload_json], dtype=float)}
+    tracks = [record.get('track') for record in payload_json]
+    if all(track is None for track in tracks):
+        return(columns, None)
+    codes = {}
+    columns['track'] = np.array([codes.setdefault(track, len(codes)) for track in tracks], dtype=np.intp)
+    return(columns, tracks)
+
+
+def _results_to_records(payload_json, columns, tracks, results):
+    """
+    The JSON response the service would give for a query body.
+    """
+    def to_list(values):
+        return([None if np.isnan(value) else value for value in values.tolist()])
+    longitudes = columns['longitude']
+    records = [{'bearing': bearing,
+                'stride': stride,
+                'unique_key': record.get('unique_key'),
+                'elevation': None if elevation is None else int(elevation),
+                'slope': slope,
+                'geo_point': {'lat': latitude, 'lon': longitude}}
+               for record, latitude, longitude, bearing, stride, elevation, slope
+               in zip(payload_json, columns['latitude'].tolist(),
+                      np.where(longitudes > 180.0, longitudes - 360.0, longitudes).tolist(),
+                      to_list(results['bearing']), columns['stride'].tolist(), to_list(results['elevation']),
+                      to_list(results['slope']))]
+    if tracks is not None:
+        for record, track in zip(records, tracks):
+            record['track'] = track
+    return(records)
+
+
+class ResultCache:
+    """
+    On-disk (SQLite) cache of groundhog results, so frames that are enriched
+    again and again only go to the service for points it hasn't seen.
+
+    Points are keyed on their latitude and longitude rounded to cell_size
+    degrees, their bearing rounded to bearing_step degrees and their stride
+    rounded to stride_step meters. A hit returns the result of the first
+    nearby point seen rather than an exact one.
+
+    Results are stored in blocks of CACHE_BLOCK_CELLS x CACHE_BLOCK_CELLS
+    cells, each a row of sorted numpy arrays, so a lookup reads a handful of
+    rows and searches them in numpy rather than going through SQLite point
+    by point. Once there are more than max_entries results, the least
+    recently used blocks are evicted.
+    """
+
+    def __init__(self, path, max_entries=10000000, cell_size=1e-5, bearing_step=0.1, stride_step=1.0):
+        """
+        :param path: (str) SQLite file, created if it doesn't exist
+        :param max_entries: (int) results kept before the least recently used blocks are evicted
+        :param cell_size: (float) degrees, 1e-5 is about a meter
+        :param bearing_step: (float) degrees bearings are rounded to
+        :param stride_step: (float) meters strides are rounded to
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.cell_size = cell_size
+        self.bearing_step = bearing_step
+        self.stride_step = stride_step
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # used orders blocks by when they were last looked up (for eviction)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS blocks ('
+                                'block INTEGER PRIMARY KEY, entries INTEGER, used REAL, '
+                                'keys BLOB, elevations BLOB, slopes BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def make_keys(self, longitudes, latitudes, bearings, strides):
+        """
+        Returns the block of every point and its key within the block (int64 arrays).
+        A key packs the point's cell in the block, its bearing step (0 for
+        points without a bearing, they only get an elevation) and its stride.
+        """
+        rows = np.round(np.asarray(latitudes, dtype=float) / self.cell_size).astype(np.int64)
+        columns = np.round(np.asarray(longitudes, dtype=float) / self.cell_size).astype(np.int64)
+        bearings = np.asarray(bearings, dtype=float)
+        steps = np.round(np.nan_to_num(bearings) / self.bearing_step).astype(np.int64)
+        steps %= int(round(360.0 / self.bearing_step))
+        steps = np.where(np.isnan(bearings), 0, steps + 1)
+        strides = np.round(np.broadcast_to(np.asarray(strides, dtype=float), rows.shape) /
+                           self.stride_step).astype(np.int64)
+        if rows.size > 0:
+            assert steps.max() < 2 ** 12, 'bearing_step is too fine'
+            assert (strides.min() >= 0) and (strides.max() < 2 ** 25), 'stride out of range'
+        blocks = (rows // CACHE_BLOCK_CELLS) * 2 ** 32 + (columns // CACHE_BLOCK_CELLS)
+        keys = ((rows % CACHE_BLOCK_CELLS) << 50) | ((columns % CACHE_BLOCK_CELLS) << 37) | (steps << 25) | strides
+        return(blocks, keys)
+
+    def _group(self, blocks):
+        """
+        Returns the distinct blocks and, for each, the positions of its points.
+        """
+        unique_blocks, inverse = np.unique(blocks, return_inverse=True)
+        order = np.argsort(inverse.reshape(-1), kind='mergesort')  # stable
+        bounds = np.searchsorted(inverse.reshape(-1)[order], np.arange(unique_blocks.size + 1))
+        return([(block, order[bounds[i]:bounds[i + 1]]) for i, block in enumerate(unique_blocks.tolist())])
+
+    def _read_blocks(self, blocks):
+        """
+        Returns a dictionary of block -> (keys, elevations, slopes) for the stored ones.
+        """
+        stored = {}
+        for start in range(0, len(blocks), SQLITE_MAX_VARIABLES):
+            batch = blocks[start:start + SQLITE_MAX_VARIABLES]
+            rows = self.connection.execute('SELECT block, keys, elevations, slopes FROM blocks WHERE block IN (' +
+                                           ','.join('?' * len(batch)) + ')', batch)
+            for block, keys, elevations, slopes in rows:
+                stored[block] = (np.frombuffer(keys, dtype=np.int64), np.frombuffer(elevations, dtype=np.float64),
+                                 np.frombuffer(slopes, dtype=np.float64))
+        return(stored)
+
+    def _touch_blocks(self, blocks, now):
+        for start in range(0, len(blocks), SQLITE_MAX_VARIABLES):
+            batch = blocks[start:start + SQLITE_MAX_VARIABLES]
+            self.connection.execute('UPDATE blocks SET used = ? WHERE block IN (' + ','.join('?' * len(batch)) + ')',
+                                    [now] + batch)
+
+    def get_many(self, blocks, keys):
+        """
+        Look up results for the points of make_keys.
+        Returns elevation and slope arrays (NaN where not cached) and a mask of the hits.
+        """
+        elevations = np.full(len(keys), np.nan)
+        slopes = np.full(len(keys), np.nan)
+        found = np.zeros(len(keys), dtype=bool)
+        unique_blocks, block_index = np.unique(blocks, return_inverse=True)
+        block_index = block_index.reshape(-1)
+        with self.connection:
+            stored = self._read_blocks(unique_blocks.tolist())
+            self._touch_blocks(list(stored), time.time())
+        if stored:
+            stored_blocks = np.searchsorted(unique_blocks, np.fromiter(stored, dtype=np.int64, count=len(stored)))
+            stored_keys, stored_elevations, stored_slopes = [np.concatenate(arrays) for arrays in zip(*stored.values())]
+            stored_index = np.repeat(stored_blocks, [len(arrays[0]) for arrays in stored.values()])
+            # Sort stored and looked up (block, key) pairs together, stored ones first among equals,
+            # so a hit comes right after its stored result
+            all_index = np.concatenate([stored_index, block_index])
+            all_keys = np.concatenate([stored_keys, keys])
+            is_lookup = np.concatenate([np.zeros(stored_keys.size, dtype=bool), np.ones(len(keys), dtype=bool)])
+            order = np.lexsort((is_lookup, all_keys, all_index))
+            # For every pair, the last stored one at or before it in that order
+            previous = np.maximum.accumulate(np.where(is_lookup[order], -1, np.arange(order.size)))
+            lookups = np.flatnonzero(is_lookup[order] & (previous >= 0))
+            candidates = order[previous[lookups]]
+            lookups = order[lookups]
+            hit = (all_index[candidates] == all_index[lookups]) & (all_keys[candidates] == all_keys[lookups])
+            positions = lookups[hit] - stored_keys.size
+            elevations[positions] = stored_elevations[candidates[hit]]
+            slopes[positions] = stored_slopes[candidates[hit]]
+            found[positions] = True
+        self.hits += int(found.sum())
+        self.misses += len(keys) - int(found.sum())
+        return(elevations, slopes, found)
+
+    def put_many(self, blocks, keys, elevations, slopes):
+        """
+        Add results and evict the least recently used blocks until back under max_entries.
+        """
+        elevations = np.asarray(elevations, dtype=np.float64)
+        slopes = np.asarray(slopes, dtype=np.float64)
+        groups = self._group(blocks)
+        now = time.time()
+        with self.connection:
+            stored = self._read_blocks([block for block, _ in groups])
+            rows = []
+            for block, positions in groups:
+                new = (keys[positions], elevations[positions], slopes[positions])
+                old = stored.get(block, (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)))
+                # np.unique keeps the first of duplicate keys, the new results
+                block_keys, first = np.unique(np.concatenate([new[0], old[0]]), return_index=True)
+                block_elevations = np.concatenate([new[1], old[1]])[first]
+                block_slopes = np.concatenate([new[2], old[2]])[first]
+                rows.append((block, block_keys.size, now, block_keys.tobytes(), block_elevations.tobytes(),
+                             block_slopes.tobytes()))
+            self.connection.executemany('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._evict()
+
+    def _evict(self):
+        num_entries = self.connection.execute('SELECT COALESCE(SUM(entries), 0) FROM blocks').fetchone()[0]
+        if num_entries <= self.max_entries:
+            return
+        evicted = []
+        for block, entries in self.connection.execute('SELECT block, entries FROM blocks ORDER BY used'):
+            if num_entries <= self.max_entries:
+                break
+            evicted.append((block,))
+            num_entries -= entries
+        self.connection.executemany('DELETE FROM blocks WHERE block = ?', evicted)
+
+    def __len__(self):
+        return(self.connection.execute('SELECT COALESCE(SUM(entries), 0) FROM blocks').fetchone()[0])
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM blocks')
+
+
+def _get_bearings(lon1, lat1, lon2, lat2):
+    """
+    Initial bearings (compass headings) from points 1 to points 2, the way
+    the service infers the bearing of a point from the next one.
+    """
+    lat1, lat2, lon1, lon2 = [np.radians(x) for x in [lat1, lat2, lon1, lon2]]
+    delta_lon = lon2 - lon1
+    x = np.cos(lat2) * np.sin(delta_lon)
+    y = (np.cos(lat1) * np.sin(lat2)) - (np.sin(lat1) * np.cos(lat2) * np.cos(delta_lon))
+    bearings = np.arctan2(x, y) * 180.0 / np.pi
+    return(np.where(bearings < 0, bearings + 360.0, bearings))
+
+
+def _get_cached_arrays(client, columns, cache):
+    """
+    Like client.get_arrays, but only points missing from the cache are sent
+    to the service (and their results cached).
+    Bearings are inferred here, so every point is looked up by the bearing
+    the service would use and misses can be sent on their own.
+    """
+    longitudes = columns['longitude']
+    latitudes = columns['latitude']
+    num_points = len(latitudes)
+    bearings = np.array(columns['bearing'], dtype=float) if 'bearing' in columns else np.full(num_points, np.nan)
+    strides = columns['stride'] if 'stride' in columns else np.full(num_points, DEFAULT_STRIDE)
+    tracks = columns['track'] if 'track' in columns else np.zeros(num_points, dtype=np.int8)
+    inferred = np.flatnonzero(np.isnan(bearings[:-1]) & (tracks[1:] == tracks[:-1]))
+    bearings[inferred] = _get_bearings(longitudes[inferred], latitudes[inferred],
+                                       longitudes[inferred + 1], latitudes[inferred + 1])
+
+    blocks, keys = cache.make_keys(longitudes, latitudes, bearings, strides)
+    elevations, slopes, found = cache.get_many(blocks, keys)
+    missing = np.flatnonzero(~found)
+    if missing.size > 0:
+        # Every miss is a track of its own, so points left without a bearing
+        # (the last of their tracks) don't borrow one from the next miss
+        results = client.get_arrays({'longitude': longitudes[missing],
+                                     'latitude': latitudes[missing],
+                                     'bearing': bearings[missing],
+                                     'stride': strides[missing],
+                                     'track': np.arange(missing.size)})
+        elevations[missing] = results['elevation']
+        slopes[missing] = results['slope']
+        cache.put_many(blocks[missing], keys[missing], results['elevation'], results['slope'])
+    return({'bearing': bearings, 'slope': slopes, 'elevation': elevations})
+
+
+def _get_payload_columns(df):
+    """
+    Given a pandas DataFrame, create a columnar query body to send
+    to groundhog, along with the order it puts the rows in.
+    Each asset is its own track (numbered by a single groupby) and is sorted
+    by dateTime so slope makes sense. unique_key is the row's position in df.
     """
     assert 'latitude' in df.columns
     assert 'longitude' in df.columns
     assert 'dateTime' in df.columns
-    # Sort by date_time so slope makes sense
-    df.sort_values(by='dateTime',
-                   ascending=True,
-                   inplace=False)
+    assert 'assetId' in df.columns
+    tracks = df.groupby('assetId', sort=True).ngroup().values
+    date_times = df['dateTime'].values
+    # Track numbers are small, a stable sort on them is cheap and usually all
+    # that's needed: rows tend to be in time order within each asset already
+    max_track = max(tracks.max(), 0) if tracks.size > 0 else 0
+    order = np.argsort(tracks.astype(np.min_scalar_type(max_track)), kind='mergesort')  # stable
+    sorted_tracks = tracks[order]
+    sorted_times = date_times[order]
+    if not np.all((sorted_times[1:] >= sorted_times[:-1]) | (sorted_tracks[1:] != sorted_tracks[:-1])):
+        order = np.lexsort((date_times, tracks))
+    columns = {'latitude': df['latitude'].values[order].astype(float),
+               'longitude': df['longitude'].values[order].astype(float),
+               'unique_key': order,
+               'track': tracks[order]}
     if 'bearing' in df.columns:
-        out = df[['longitude', 'latitude', 'bearing', 'unique_key']].to_dict(orient='records')
-    else:
-        out = df[['longitude', 'latitude', 'unique_key']].to_dict(orient='records')
-    return(list(out))
+        columns['bearing'] = df['bearing'].values[order].astype(float)  # NaN gets inferred
+    if 'stride' in df.columns:
+        columns['stride'] = df['stride'].values[order].astype(float)
+    return(columns, order)
 
 
-def append_slope_features(df, host_name, port):
+def append_slope_features(df, host_name='localhost', port=5005, workers=4, chunk_size=50000, cache=None,
+                          local=False, tile_dir=None, processes=0, engine_dir=None):
     """
     Append slope features from groundhog to a pandas
     dataframe.
+    cache is an optional ResultCache (or the path of one), only points it
+    doesn't have are sent to the service.
+    With local=True the engine (found in engine_dir) runs in this process
+    (or on a pool of processes) against tile_dir instead of calling the service.
     """
-    # Create a client
-    client = GroundhogClient(host_name=host_name, port=port)
-
-    # Generate a sorted list of unique_key uuids
-    # The sorting guarantees that we can sort the result later and
-    # subset out of it to do an in-place append onto the original df
-    num_rows = df.shape[0]
-    join_keys = list(map(lambda x: str(uuid4()), range(num_rows)))
-    join_keys.sort()
-    df['unique_key'] = join_keys
-
-    # Get API payload for each asset's data
-    payloads = [_get_payload_json(df[df['assetId'] == asset]) for asset in df.assetId.unique()]
-
-    # Loop over payloads and get responses
-    response_df = pd.concat([client.get_df(pl) for pl in payloads],
-                            ignore_index=True)
+    columns, order = _get_payload_columns(df)
 
-    # Sort in ascending order by unique_key
-    response_df.sort_values(by='unique_key',
-                            ascending=True,
-                            inplace=True)
+    # The server keeps each asset's track apart, the client chunks big frames
+    with GroundhogClient(host_name=host_name, port=port, workers=workers, chunk_size=chunk_size,
+                         local=local, tile_dir=tile_dir, processes=processes, engine_dir=engine_dir) as client:
+        if cache is None:
+            results = client.get_arrays(columns)
+        elif isinstance(cache, str):
+            with ResultCache(cache) as path_cache:
+                results = _get_cached_arrays(client, columns, path_cache)
+        else:
+            results = _get_cached_arrays(client, columns, cache)
 
-    # Append columns to original df
+    # Results come back in payload order, scatter them back to the rows they came from
     for col in ['bearing', 'slope', 'elevation']:
         if col not in df.columns:
-            df[col] = response_df[col]
+            values = np.empty_like(results[col])
+            values[order] = results[col]
+            if (col == 'elevation') and not np.isnan(values).any():
+                values = values.astype(int)
+            df[col] = values
@@ -12,6 +12,7 @@ VERSION = ".".join([CURRENT_VERSION, date_tmpl.format(dt=datetime.datetime.now()
 
 # Packages used
 regular_packages = [
+    'numpy',
     'pandas',
     'requests'
 ]
@@ -0,0 +1,288 @@
+"""
+Benchmarks groundhog on synthetic SRTM tiles
+
+Deterministic .hgt tiles (with void regions) are generated in a temporary directory,
+so no server or network is needed. Every case is timed for a range of batch sizes and
+reports throughput and peak (traced) memory. Save a run with --output and pass it to a
+later run with --compare to see regressions.
+
+    python tests/benchmark.py --sizes 1,100,10000 --output before.json
+    python tests/benchmark.py --sizes 1,100,10000 --compare before.json
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import srtm_elevation_and_slope as srtm_methods  # noqa: E402
+import groundhog  # noqa: E402
+
+logger = logging.getLogger()  # Make the logs global
+
+TILE_SOUTH = 41  # synthetic tiles cover TILE_SOUTH..+TILE_ROWS north, TILE_WEST..+TILE_COLUMNS east
+TILE_WEST = -91
+TILE_ROWS = 2
+TILE_COLUMNS = 2
+TILE_SIDE = 1201
+DEFAULT_SIZES = [1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+def make_synthetic_tiles(tile_dir, seed=0):
+    """
+    Writes deterministic SRTM3-sized tiles: rolling hills plus noise, a few void
+    patches and scattered void cells
+    :return: (list[str]) paths of the tiles
+    """
+    rng = np.random.RandomState(seed)
+    rows, columns = np.mgrid[0:TILE_SIDE, 0:TILE_SIDE]
+    paths = []
+    for latitude in range(TILE_SOUTH, TILE_SOUTH + TILE_ROWS):
+        for longitude in range(TILE_WEST, TILE_WEST + TILE_COLUMNS):
+            elevations = (300 + 120 * np.sin(rows / 70.0 + latitude) + 90 * np.cos(columns / 45.0 + longitude) +
+                          rng.normal(0, 3, rows.shape))
+            elevations = elevations.astype(">i2")
+            for _ in range(4):
+                row, column = rng.randint(0, TILE_SIDE - 60, 2)
+                elevations[row:row + rng.randint(5, 60), column:column + rng.randint(5, 60)] = -32768
+            elevations.ravel()[rng.randint(0, elevations.size, 500)] = -32768
+            path = os.path.join(tile_dir, srtm_methods.HgtTileStore.get_file_name(latitude, longitude))
+            elevations.tofile(path)
+            paths.append(path)
+    return paths
+
+
+def make_points(size, seed=1):
+    """
+    Random points inside the synthetic tiles, away from their outer edges
+    :return: (np.ndarray, np.ndarray, np.ndarray) longitudes, latitudes, bearings
+    """
+    rng = np.random.RandomState(seed)
+    longitudes = rng.uniform(TILE_WEST + 0.05, TILE_WEST + TILE_COLUMNS - 0.05, size)
+    latitudes = rng.uniform(TILE_SOUTH + 0.05, TILE_SOUTH + TILE_ROWS - 0.05, size)
+    bearings = rng.uniform(0.0, 360.0, size)
+    return longitudes, latitudes, bearings
+
+
+def make_records(size, seed=1):
+    """
+    A /groundhog JSON payload, every tenth point leaves its bearing to be inferred
+    """
+    longitudes, latitudes, bearings = make_points(size, seed)
+    records = [{"latitude": latitude, "longitude": longitude, "bearing": bearing, "stride": 250.0,
+                "unique_key": i}
+               for i, (longitude, latitude, bearing)
+               in enumerate(zip(longitudes.tolist(), latitudes.tolist(), bearings.tolist()))]
+    for record in records[::10]:
+        del record["bearing"]
+    return records
+
+
+def case_get_elevation_safe(size):
+    longitudes, latitudes, _ = make_points(size)
+    return lambda: [srtm_methods.get_elevation_safe(lon, lat) for lon, lat in zip(longitudes, latitudes)]
+
+
+def case_get_elevation_safe_batch(size):
+    longitudes, latitudes, _ = make_points(size)
+    return lambda: srtm_methods.get_elevation_safe_batch(longitudes, latitudes)
+
+
+def make_off_tile_points(size, seed=1):
+    """
+    Random points out at sea, off the synthetic tiles and far from any of them
+    :return: (np.ndarray, np.ndarray) longitudes, latitudes
+    """
+    rng = np.random.RandomState(seed)
+    return rng.uniform(-150.0, -140.0, size), rng.uniform(-10.0, 10.0, size)
+
+
+def case_get_elevation_safe_off_tile(size):
+    longitudes, latitudes = make_off_tile_points(size)
+    return lambda: [srtm_methods.get_elevation_safe(lon, lat) for lon, lat in zip(longitudes, latitudes)]
+
+
+def case_get_elevation_safe_batch_off_tile(size):
+    longitudes, latitudes = make_off_tile_points(size)
+    return lambda: srtm_methods.get_elevation_safe_batch(longitudes, latitudes)
+
+
+def case_slope_from_coord_bearing(size):
+    longitudes, latitudes, bearings = make_points(size)
+    return lambda: [srtm_methods.slope_from_coord_bearing(lon, lat, bearing)
+                    for lon, lat, bearing in zip(longitudes, latitudes, bearings)]
+
+
+def case_slope_from_coord_bearing_batch(size):
+    longitudes, latitudes, bearings = make_points(size)
+    return lambda: srtm_methods.slope_from_coord_bearing_batch(longitudes, latitudes, bearings)
+
+
+def case_slope_from_coords_only(size):
+    longitudes, latitudes, _ = make_points(size)
+    coords = list(zip(longitudes.tolist(), latitudes.tolist()))
+    return lambda: srtm_methods.slope_from_coords_only(coords)
+
+
+def case_slope_from_coords_only_batch(size):
+    longitudes, latitudes, _ = make_points(size)
+    return lambda: srtm_methods.slope_from_coords_only_batch(longitudes, latitudes)
+
+
+def case_json_to_headings(size):
+    records = make_records(size)
+    return lambda: groundhog.json_to_headings(records)
+
+
+def case_make_json_response(size):
+    batch = groundhog.from_heading_batch(groundhog.json_to_headings(make_records(size)))
+    return lambda: groundhog.make_json_response(batch)
+
+
+def case_groundhog_track(size):
+    client = groundhog.flask_app.test_client()
+    payload = json.dumps(make_records(size))
+
+    def post():
+        response = client.post("/groundhog", data=payload, content_type="application/json")
+        assert response.status_code == 200, response.status_code
+        return response.data
+    return post
+
+
+# name -> (case, whether it is a per-point python loop that is too slow for the biggest sizes)
+CASES = {
+    "get_elevation_safe": (case_get_elevation_safe, True),
+    "get_elevation_safe_batch": (case_get_elevation_safe_batch, False),
+    "get_elevation_safe_off_tile": (case_get_elevation_safe_off_tile, True),
+    "get_elevation_safe_batch_off_tile": (case_get_elevation_safe_batch_off_tile, False),
+    "slope_from_coord_bearing": (case_slope_from_coord_bearing, True),
+    "slope_from_coord_bearing_batch": (case_slope_from_coord_bearing_batch, False),
+    "slope_from_coords_only": (case_slope_from_coords_only, True),
+    "slope_from_coords_only_batch": (case_slope_from_coords_only_batch, False),
+    "json_to_headings": (case_json_to_headings, False),
+    "make_json_response": (case_make_json_response, False),
+    "groundhog_track": (case_groundhog_track, False),
+}
+
+
+def run_case(name, size, repeat=3, measure_memory=True):
+    """
+    Times one case at one batch size (best of repeat runs) and traces its peak memory in an extra run
+    :return: (dict) result row
+    """
+    run = CASES[name][0](size)
+    run()  # warm up: maps tiles, builds void indexes
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+
+    peak_bytes = None
+    if measure_memory:
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"case": name,
+            "size": size,
+            "seconds": seconds,
+            "points_per_second": size / seconds if seconds > 0 else None,
+            "peak_bytes": peak_bytes}
+
+
+def compare(results, baseline, threshold):
+    """
+    Lists the cases that got slower than the baseline by more than threshold (a fraction)
+    """
+    previous = {(row["case"], row["size"]): row for row in baseline["results"]}
+    regressions = []
+    for row in results:
+        before = previous.get((row["case"], row["size"]))
+        if (before is None) or (not before["seconds"]):
+            continue
+        change = row["seconds"] / before["seconds"] - 1.0
+        if change > threshold:
+            regressions.append((row["case"], row["size"], change))
+    return regressions
+
+
+def get_command_line():
+    """
+    Get command line arguments
+    """
+    ap = argparse.ArgumentParser(description="Benchmarks groundhog on synthetic SRTM tiles")
+    ap.add_argument("-s", "--sizes", type=str, default=",".join(str(size) for size in DEFAULT_SIZES),
+                    help="Comma separated batch sizes.", required=False)
+    ap.add_argument("-c", "--cases", type=str, default=",".join(CASES),
+                    help="Comma separated cases to run (default: all).", required=False)
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="Timed runs per case, the best one counts.",
+                    required=False)
+    ap.add_argument("--max-loop-size", dest="max_loop_size", type=int, default=10000,
+                    help="Biggest batch the per-point (scalar) cases are run at.", required=False)
+    ap.add_argument("--no-memory", dest="measure_memory", action="store_false",
+                    help="Skip the traced run that measures peak memory.")
+    ap.add_argument("-o", "--output", type=str, default=None, help="Write the results to this JSON file.",
+                    required=False)
+    ap.add_argument("--compare", type=str, default=None, help="Results JSON of an earlier run to compare to.",
+                    required=False)
+    ap.add_argument("--threshold", type=float, default=0.2,
+                    help="Slowdown (fraction) over the earlier run reported as a regression.", required=False)
+    command_line_args = ap.parse_args()
+    return command_line_args
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel("WARNING")
+    args = get_command_line()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = args.cases.split(",")
+
+    tile_dir = tempfile.mkdtemp(prefix="groundhog_benchmark_")
+    try:
+        make_synthetic_tiles(tile_dir)
+        srtm_methods.tile_store = srtm_methods.HgtTileStore(tile_dir=tile_dir, fetch_missing=False)
+        results = []
+        print("%-32s %9s %12s %14s %12s" % ("case", "size", "seconds", "points/s", "peak MB"))
+        for name in names:
+            for size in sizes:
+                if CASES[name][1] and (size > args.max_loop_size):
+                    continue
+                row = run_case(name, size, repeat=args.repeat, measure_memory=args.measure_memory)
+                results.append(row)
+                print("%-32s %9d %12.6f %14.0f %12s" % (
+                    name, size, row["seconds"], row["points_per_second"] or 0,
+                    "-" if row["peak_bytes"] is None else "%.1f" % (row["peak_bytes"] / 2.0 ** 20)))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+
+    report = {"version": groundhog.VERSION,
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "machine": platform.machine(),
+              "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for name, size, change in regressions:
+            print("REGRESSION: " + name + " at " + str(size) + " points is " + str(round(change * 100)) + "% slower")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,38 @@
+"""
+Shared test fixtures
+
+The engine is pointed at the deterministic synthetic SRTM tiles of benchmark.py
+(with void patches and scattered void cells), so the tests need no network.
+"""
+
+import os
+import sys
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "app"))
+sys.path.insert(0, TESTS_DIR)
+import benchmark  # noqa: E402
+import srtm_elevation_and_slope as srtm_methods  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def tile_dir(tmp_path_factory):
+    """
+    Directory holding the synthetic tiles (void indexes get cached next to them)
+    """
+    path = str(tmp_path_factory.mktemp("tiles"))
+    benchmark.make_synthetic_tiles(path)
+    return path
+
+
+@pytest.fixture
+def tile_store(tile_dir, monkeypatch):
+    """
+    Serves the synthetic tiles to the engine, without any slope cache or gradient rasters
+    """
+    store = srtm_methods.HgtTileStore(tile_dir=tile_dir, fetch_missing=False)
+    monkeypatch.setattr(srtm_methods, "tile_store", store)
+    monkeypatch.setattr(srtm_methods, "slope_cache", None)
+    monkeypatch.setattr(srtm_methods, "gradient_strides", None)
+    return store
@@ -0,0 +1,178 @@
+"""
+The Python client's on-disk result cache, and the client in local mode against the synthetic tiles
+"""
+
+import importlib.util
+import os
+import sys
+import types
+import numpy as np
+import pandas as pd
+import pytest
+import benchmark
+
+# The client package is called groundhog too, so load its module straight from the file
+CLIENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clients", "py-client", "groundhog",
+                           "client.py")
+spec = importlib.util.spec_from_file_location("groundhog_client", CLIENT_PATH)
+client = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(client)
+
+BLOCK_DEGREES = client.CACHE_BLOCK_CELLS * 1e-5  # with the default cell_size
+ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with client.ResultCache(str(tmp_path / "cache.sqlite")) as result_cache:
+        yield result_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Ticks once per call, so blocks looked up one after the other are never used at the same time
+    """
+    ticks = iter(range(1, 1000000))
+    monkeypatch.setattr(client, "time", types.SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def make_points(size, block_row=0, seed=0):
+    """
+    Points inside one cache block (in the block_row-th row of blocks north of 42 degrees)
+    :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray) longitudes, latitudes, bearings, strides
+    """
+    rng = np.random.RandomState(seed)
+    south = (np.ceil(42.0 / BLOCK_DEGREES) + block_row) * BLOCK_DEGREES
+    west = np.ceil(-90.0 / BLOCK_DEGREES) * BLOCK_DEGREES
+    longitudes = west + rng.uniform(0.1, 0.9, size) * BLOCK_DEGREES
+    latitudes = south + rng.uniform(0.1, 0.9, size) * BLOCK_DEGREES
+    bearings = rng.uniform(0.0, 360.0, size)
+    bearings[::5] = np.nan
+    return longitudes, latitudes, bearings, np.full(size, 250.0)
+
+
+def put_points(cache, points, values):
+    blocks, keys = cache.make_keys(*points)
+    cache.put_many(blocks, keys, values, values / 1000.0)
+
+
+def get_points(cache, points):
+    return cache.get_many(*cache.make_keys(*points))
+
+
+def test_hits_and_misses(cache):
+    points = make_points(100)
+    values = np.arange(100.0)
+    values[3] = np.nan  # unknown results are cached too
+    put_points(cache, [column[:60] for column in points], values[:60])
+
+    elevations, slopes, found = get_points(cache, points)
+    assert found[:60].all() and not found[60:].any()
+    np.testing.assert_array_equal(elevations[:60], values[:60])
+    np.testing.assert_array_equal(slopes[:60], values[:60] / 1000.0)
+    assert np.isnan(elevations[60:]).all()
+    assert (cache.hits, cache.misses) == (60, 40)
+    assert len(cache) == 60
+
+
+def test_keys_round_points(cache):
+    longitudes, latitudes, bearings, strides = make_points(1)
+    bearings[0] = 90.0
+    put_points(cache, (longitudes, latitudes, bearings, strides), np.array([7.0]))
+    nearby = (longitudes + 2e-6, latitudes - 2e-6, bearings + 0.02, strides + 0.3)
+    assert get_points(cache, nearby)[2].all()
+    for other in [(longitudes + 2e-5, latitudes, bearings, strides),
+                  (longitudes, latitudes, bearings + 0.2, strides),
+                  (longitudes, latitudes, np.array([np.nan]), strides),
+                  (longitudes, latitudes, bearings, strides * 2)]:
+        assert not get_points(cache, other)[2].any()
+
+
+def test_put_replaces(cache):
+    points = make_points(10)
+    put_points(cache, points, np.arange(10.0))
+    put_points(cache, [column[:5] for column in points], np.arange(10.0, 15.0))
+    np.testing.assert_array_equal(get_points(cache, points)[0], np.r_[np.arange(10.0, 15.0), np.arange(5.0, 10.0)])
+    assert len(cache) == 10
+
+
+def test_evicts_least_recently_used_blocks(tmp_path, clock):
+    block_points = [make_points(4, block_row=i, seed=i) for i in range(3)]
+    with client.ResultCache(str(tmp_path / "cache.sqlite"), max_entries=10) as cache:
+        put_points(cache, block_points[0], np.ones(4))
+        put_points(cache, block_points[1], np.ones(4))
+        assert get_points(cache, block_points[0])[2].all()  # the first block is now the more recently used
+        put_points(cache, block_points[2], np.ones(4))
+        assert len(cache) == 8
+        assert get_points(cache, block_points[0])[2].all()
+        assert not get_points(cache, block_points[1])[2].any()
+        assert get_points(cache, block_points[2])[2].all()
+
+
+def test_persists(tmp_path):
+    points = make_points(20)
+    with client.ResultCache(str(tmp_path / "cache.sqlite")) as cache:
+        put_points(cache, points, np.arange(20.0))
+    with client.ResultCache(str(tmp_path / "cache.sqlite")) as cache:
+        np.testing.assert_array_equal(get_points(cache, points)[0], np.arange(20.0))
+        cache.clear()
+        assert len(cache) == 0
+
+
+def make_frame(size=200):
+    longitudes, latitudes, _ = benchmark.make_points(size)
+    return pd.DataFrame({"assetId": np.arange(size) % 3,
+                         "dateTime": pd.date_range("2026-01-01", periods=size, freq="s"),
+                         "latitude": latitudes, "longitude": longitudes})
+
+
+def test_local_results_through_cache(tile_store, tile_dir, cache):
+    expected, cached, again = make_frame(), make_frame(), make_frame()
+    client.append_slope_features(expected, local=True, tile_dir=tile_dir, engine_dir=ENGINE_DIR)
+    client.append_slope_features(cached, local=True, tile_dir=tile_dir, engine_dir=ENGINE_DIR, cache=cache)
+    pd.testing.assert_frame_equal(cached, expected)
+    assert cache.hits == 0
+    # Every point is cached now, so there is no need for a service (or engine)
+    client.append_slope_features(again, host_name="nowhere.invalid", cache=cache)
+    pd.testing.assert_frame_equal(again, expected)
+    assert cache.hits == 200
+
+
+@pytest.mark.parametrize("status, attempts", [(500, 1), (400, 1), (503, 3)])
+def test_retries_only_busy_responses(monkeypatch, status, attempts):
+    groundhog_client = client.GroundhogClient(max_retries=2, backoff_factor=0.0)
+    calls = []
+
+    def post(url, **kwargs):
+        calls.append(url)
+        response = client.requests.Response()
+        response.status_code = status
+        return response
+    monkeypatch.setattr(groundhog_client.session, "post", post)
+    with pytest.raises(client.requests.exceptions.HTTPError):
+        groundhog_client.get_query([])
+    assert len(calls) == attempts
+
+
+def test_local_engine_stays_offline(tile_dir, monkeypatch):
+    import srtm_elevation_and_slope as srtm_methods
+    monkeypatch.setattr(srtm_methods, "tile_store", srtm_methods.HgtTileStore(tile_dir=tile_dir))
+    monkeypatch.setattr(client, "_engine", None)
+    engine = client._load_engine(ENGINE_DIR, tile_dir)
+    assert engine is srtm_methods
+    assert engine.tile_store.tile_dir == tile_dir
+    assert not engine.tile_store.fetch_missing
+
+
+@pytest.mark.parametrize("engine_dir, tile_dir", [(None, "tiles"), (ENGINE_DIR, None)])
+def test_local_engine_needs_both_dirs(engine_dir, tile_dir):
+    with pytest.raises(ValueError, match="engine_dir.*tile_dir"):
+        client.GroundhogClient(local=True, engine_dir=engine_dir, tile_dir=tile_dir)
+
+
+def test_local_engine_comes_from_engine_dir(tmp_path, tile_dir, monkeypatch):
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    # An importable engine elsewhere isn't picked up silently
+    with pytest.raises(ImportError, match="already imported"):
+        client.GroundhogClient(local=True, engine_dir=str(tmp_path), tile_dir=tile_dir)
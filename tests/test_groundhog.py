@@ -0,0 +1,247 @@
+"""
+The /groundhog routes through the Flask test client, on the synthetic tiles
+"""
+
+import io
+import json
+import numpy as np
+import pytest
+import benchmark
+import groundhog
+import srtm_elevation_and_slope as srtm_methods
+
+SOUTH, WEST = benchmark.TILE_SOUTH, benchmark.TILE_WEST
+
+
+@pytest.fixture
+def client(tile_store):
+    return groundhog.flask_app.test_client()
+
+
+def make_track_records(size=40):
+    """
+    Three tracks one after the other, a third of the points leave their bearing to be inferred
+    """
+    records = benchmark.make_records(size)
+    for i, record in enumerate(records):
+        record["track"] = "a" if i < 15 else ("b" if i < 27 else "c")
+        if i % 3 == 0:
+            record.pop("bearing", None)
+    return records
+
+
+def post_json(client, records):
+    response = client.post("/groundhog", data=json.dumps(records), content_type="application/json")
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+
+@pytest.mark.parametrize("window_size", [1, 4, 7, 100])
+def test_ndjson_stream_matches_json(client, monkeypatch, window_size):
+    monkeypatch.setitem(groundhog.flask_app.config, "NDJSON_WINDOW_SIZE", window_size)
+    records = make_track_records()
+    response = client.post("/groundhog", data="".join(json.dumps(record) + "\n" for record in records),
+                           content_type=groundhog.NDJSON_MIMETYPE)
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.data.decode("utf-8").splitlines()] == post_json(client, records)
+
+
+def test_ndjson_rejects_split_tracks(tile_store):
+    records = make_track_records()
+    records[30]["track"] = "a"  # back to a track that was done with
+    with pytest.raises(ValueError, match="track a"):
+        list(groundhog.iter_result_batches(groundhog.iter_windows(records, 4)))
+
+
+def get_raster(client, bbox, **params):
+    query = "&".join(["bbox=" + ",".join(str(value) for value in bbox)] +
+                     [key + "=" + str(value) for key, value in params.items()])
+    response = client.get("/groundhog/raster?" + query)
+    assert response.status_code == 200
+    with np.load(io.BytesIO(response.data), allow_pickle=False) as grid:
+        return {name: grid[name] for name in grid.files}
+
+
+@pytest.mark.parametrize("bbox", [(SOUTH + 0.2, WEST + 0.3, SOUTH + 0.25, WEST + 0.33),
+                                  (SOUTH + 0.97, WEST + 0.98, SOUTH + 1.03, WEST + 1.02)])  # across four tiles
+def test_raster_matches_point_engine(client, bbox):
+    grid = get_raster(client, bbox, layers="elevation,slope,aspect")
+    latitudes, longitudes = grid["latitude"], grid["longitude"]
+    assert grid["elevation"].dtype == np.dtype("<i2")
+    assert (latitudes[0] > bbox[2] - 1 / 1200.0) and (latitudes[-1] < bbox[0] + 1 / 1200.0)
+    center_longitudes, center_latitudes = np.meshgrid(longitudes, latitudes)
+    elevations = srtm_methods.get_elevation_safe_batch(center_longitudes.ravel(), center_latitudes.ravel())
+    np.testing.assert_array_equal(grid["elevation"].ravel(), np.where(np.isnan(elevations), -32768, elevations))
+
+    # The point engine's slope is the rise from a stride behind to a stride ahead over one stride, the
+    # raster's is the rise from the cell behind to the cell ahead over two cells: with a stride of one
+    # cell, both see the same rise
+    flat = np.isnan(grid["aspect"]) & (grid["slope"] == 0)
+    aspects = np.radians(np.where(flat, 0.0, grid["aspect"]))
+    row_lengths = np.radians(1 / 1200.0) * srtm_methods.calc_earth_radius_batch(latitudes)[:, np.newaxis]
+    column_lengths = row_lengths * np.cos(np.radians(latitudes))[:, np.newaxis]
+    for bearing, gradients, cell_lengths in [(0.0, -grid["slope"] * np.cos(aspects), row_lengths),
+                                             (90.0, -grid["slope"] * np.sin(aspects), column_lengths)]:
+        strides = np.broadcast_to(cell_lengths, gradients.shape).ravel()
+        _, slopes = srtm_methods.slope_from_coord_bearing_batch(center_longitudes.ravel(), center_latitudes.ravel(),
+                                                                np.full(strides.size, bearing), stride_length=strides)
+        rises = gradients.ravel() * 2 * strides
+        known = np.isfinite(slopes) & np.isfinite(rises)
+        assert known.mean() > 0.9
+        np.testing.assert_allclose((slopes * strides)[known], rises[known], rtol=0, atol=1e-3)
+
+
+def test_raster_rejects_bad_requests(client, monkeypatch):
+    monkeypatch.setitem(groundhog.flask_app.config, "RASTER_MAX_CELLS", 1000)
+    for query in ["", "bbox=1,2,3", "bbox=42,-90,41,-89", "bbox=41,-90,41.1,-89.9&resolution=-3",
+                  "bbox=41,-90,41.1,-89.9&layers=elevation,snow", "bbox=41,-90,42,-89"]:
+        assert client.get("/groundhog/raster?" + query).status_code == 400
+
+
+ROUTE_LONGITUDES = np.array([WEST + 0.3, WEST + 0.32, WEST + 0.32, WEST + 0.35, WEST + 0.31])
+ROUTE_LATITUDES = np.array([SOUTH + 0.4, SOUTH + 0.41, SOUTH + 0.41, SOUTH + 0.38, SOUTH + 0.37])
+
+
+def test_densify_route_spacing_and_length():
+    longitudes, latitudes, distances = srtm_methods.densify_route(ROUTE_LONGITUDES, ROUTE_LATITUDES, 100.0)
+    legs = srtm_methods.haversine_batch(ROUTE_LATITUDES[:-1], ROUTE_LONGITUDES[:-1], ROUTE_LATITUDES[1:],
+                                        ROUTE_LONGITUDES[1:])
+    assert legs[1] == 0  # a zero-length segment
+    assert distances[-1] == pytest.approx(legs.sum(), rel=1e-12)
+    np.testing.assert_array_equal(distances[:-1], np.arange(distances.size - 1) * 100.0)
+    assert 0 < distances[-1] - distances[-2] <= 100.0
+    assert (longitudes[[0, -1]], latitudes[[0, -1]]) == (pytest.approx(ROUTE_LONGITUDES[[0, -1]]),
+                                                         pytest.approx(ROUTE_LATITUDES[[0, -1]]))
+    assert np.isfinite(longitudes).all() and np.isfinite(latitudes).all()
+    # Samples that don't straddle a vertex are interval meters apart along the great circle
+    steps = srtm_methods.haversine_batch(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    vertices = np.cumsum(legs)
+    straight = np.searchsorted(vertices, distances[:-1], side="right") == np.searchsorted(vertices, distances[1:])
+    straight[-1] = False  # the last step just reaches the end
+    assert straight.sum() > 0.9 * steps.size
+    np.testing.assert_allclose(steps[straight], 100.0, rtol=1e-5)
+    # Sampling is the same with the zero-length segment left out
+    without = srtm_methods.densify_route(np.delete(ROUTE_LONGITUDES, 2), np.delete(ROUTE_LATITUDES, 2), 100.0)
+    for values, without_values in zip((longitudes, latitudes, distances), without):
+        np.testing.assert_allclose(values, without_values, rtol=0, atol=1e-9)
+
+
+def test_route_of_one_point(client):
+    response = client.post("/groundhog/route", data=json.dumps([{"latitude": SOUTH + 0.4, "longitude": WEST + 0.3}]),
+                           content_type="application/json")
+    assert response.status_code == 200
+    profile = json.loads(response.data)
+    assert profile["distance"] == [0.0]
+    assert profile["elevation"] == [int(srtm_methods.get_elevation_safe(WEST + 0.3, SOUTH + 0.4))]
+    assert (profile["grade"], profile["climb"], profile["descent"]) == ([None], [0.0], [0.0])
+
+
+def test_route_grade_and_climb(monkeypatch):
+    # Due north, sampled at both ends and three points evenly spaced between them
+    length = srtm_methods.haversine(SOUTH + 0.4, WEST + 0.3, SOUTH + 0.5, WEST + 0.3)
+    interval = length / 4
+    monkeypatch.setattr(srtm_methods, "get_elevation_safe_batch",
+                        lambda longitudes, latitudes, fill_radius=None: np.array([100.0, 110.0, 105.0, np.nan, 120.0]))
+    profile = srtm_methods.route_profile([WEST + 0.3, WEST + 0.3], [SOUTH + 0.4, SOUTH + 0.5], interval)
+    np.testing.assert_allclose(profile["distance"], np.arange(5) * interval)
+    np.testing.assert_allclose(profile["grade"], [np.nan, 10 / interval, -5 / interval, np.nan, np.nan])
+    np.testing.assert_array_equal(profile["climb"], [0.0, 10.0, 10.0, 10.0, 10.0])
+    np.testing.assert_array_equal(profile["descent"], [0.0, 0.0, 5.0, 5.0, 5.0])
+
+
+def test_route_endpoint_matches_profile(client):
+    records = [{"latitude": latitude, "longitude": longitude}
+               for latitude, longitude in zip(ROUTE_LATITUDES.tolist(), ROUTE_LONGITUDES.tolist())]
+    response = client.post("/groundhog/route?interval=50", data=json.dumps(records), content_type="application/json")
+    assert response.status_code == 200
+    profile = json.loads(response.data)
+    expected = srtm_methods.route_profile(ROUTE_LONGITUDES, ROUTE_LATITUDES, 50.0,
+                                          fill_radius=srtm_methods.void_fill_radius())
+    for column in groundhog.ROUTE_COLUMNS:
+        values = np.array([np.nan if value is None else value for value in profile[column]])
+        np.testing.assert_array_equal(values, expected[column])
+    for query, payload in [("?interval=0", records), ("?interval=x", records), ("", []), ("", [{"latitude": 1}])]:
+        assert client.post("/groundhog/route" + query, data=json.dumps(payload),
+                           content_type="application/json").status_code == 400
+
+
+def test_npz_round_trip_matches_json(client):
+    records = make_track_records()
+    records[5]["time"] = 12.5
+    columns = {"latitude": np.array([record["latitude"] for record in records]),
+               "longitude": np.array([record["longitude"] for record in records]),
+               "bearing": np.array([record.get("bearing", np.nan) for record in records]),
+               "stride": np.array([record["stride"] for record in records]),
+               "unique_key": np.array([record["unique_key"] for record in records]),
+               "track": np.array([record["track"] for record in records]),
+               "time": np.array([record.get("time", np.nan) for record in records])}
+    npz_buffer = io.BytesIO()
+    np.savez(npz_buffer, **columns)
+    response = client.post("/groundhog", data=npz_buffer.getvalue(), content_type=groundhog.NPZ_MIMETYPE)
+    assert response.status_code == 200
+    assert response.mimetype == groundhog.NPZ_MIMETYPE
+    with np.load(io.BytesIO(response.data), allow_pickle=False) as results:
+        results = {name: results[name] for name in results.files}
+
+    expected = post_json(client, records)
+    assert sorted(results) == ["bearing", "elevation", "slope", "track", "unique_key"]
+    for column in ["elevation", "slope", "bearing"]:
+        np.testing.assert_array_equal(results[column], [np.nan if result[column] is None else result[column]
+                                                        for result in expected])
+    assert results["unique_key"].tolist() == [result["unique_key"] for result in expected]
+    assert results["track"].tolist() == [result["track"] for result in expected]
+
+
+@pytest.mark.parametrize("break_records", [lambda lines: lines.__setitem__(30, lines[3]),  # back to track a
+                                           lambda lines: lines.__setitem__(30, '{"latitude": 41.5,')])
+def test_ndjson_failures_end_the_stream_with_an_error(client, monkeypatch, break_records):
+    monkeypatch.setitem(groundhog.flask_app.config, "NDJSON_WINDOW_SIZE", 4)
+    lines = [json.dumps(record) for record in make_track_records()]
+    break_records(lines)
+    response = client.post("/groundhog", data="\n".join(lines) + "\n", content_type=groundhog.NDJSON_MIMETYPE)
+    assert response.status_code == 200  # sent before the failure
+    results = [json.loads(line) for line in response.data.decode("utf-8").splitlines()]
+    assert set(results[-1]) == {"error", "points_done"}
+    assert results[-1]["points_done"] == len(results) - 1 <= 30
+    assert all("error" not in result for result in results[:-1])
+
+
+def npz_bytes(**columns):
+    npz_buffer = io.BytesIO()
+    np.savez(npz_buffer, **columns)
+    return npz_buffer.getvalue()
+
+
+def npy_bytes(array):
+    npy_buffer = io.BytesIO()
+    np.save(npy_buffer, array)
+    return npy_buffer.getvalue()
+
+
+@pytest.mark.parametrize("payload", [b"", b"not an npz", b"PK\x03\x04 not a zip either", npy_bytes(np.zeros(3)),
+                                     npz_bytes(latitude=np.array([SOUTH + 0.5])),
+                                     npz_bytes(latitude=np.array([SOUTH + 0.5, SOUTH + 0.6]),
+                                               longitude=np.array([WEST + 0.5])),
+                                     npz_bytes(latitude=np.array([SOUTH + 0.5]), longitude=np.array([WEST + 0.5]),
+                                               bearing=np.array([1.0, 2.0])),
+                                     npz_bytes(latitude=np.array(["north"]), longitude=np.array([WEST + 0.5]))])
+def test_bad_npz_is_a_bad_request(client, payload):
+    for route in ["/groundhog", "/groundhog/route"]:
+        response = client.post(route, data=payload, content_type=groundhog.NPZ_MIMETYPE)
+        assert response.status_code == 400
+        assert json.loads(response.data)["error"]
+
+
+def test_single_point_gets_the_raw_elevation(client, tile_store):
+    tile = tile_store.get_tile(SOUTH, WEST)
+    rows, columns = np.nonzero(np.asarray(tile.data) == srtm_methods.SRTM_VOID)
+    void_lat = float(SOUTH + 1 - (rows[0] + 0.5) / (tile.side - 1))
+    void_lon = float(WEST + (columns[0] + 0.5) / (tile.side - 1))
+    assert srtm_methods.get_elevation_safe(void_lon, void_lat) is not None  # a batch would fill it in
+    for lat, lon in [(void_lat, void_lon), (SOUTH + 0.5, WEST + 0.5)]:
+        expected = tile_store.get_elevation(lat, lon)
+        result, = json.loads(client.get("/groundhog?lat=" + repr(lat) + "&lon=" + repr(lon)).data)
+        assert (result["elevation"], result["slope"], result["bearing"]) == (expected, None, None)
+        assert post_json(client, [{"latitude": lat, "longitude": lon}]) == [result]
+    result, = json.loads(client.get("/groundhog?lat=41.5&lon=-90.5&bearing=30&stride=90").data)
+    assert (result["elevation"], result["slope"]) == srtm_methods.slope_from_coord_bearing(-90.5, 41.5, 30.0, 90.0)
@@ -0,0 +1,229 @@
+"""
+Background jobs through the /groundhog/jobs routes, with the runner driven by hand
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import benchmark
+import groundhog
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def client(tile_store, tmp_path, monkeypatch):
+    monkeypatch.setitem(groundhog.flask_app.config, "NDJSON_WINDOW_SIZE", 7)  # results in several pieces
+    monkeypatch.setitem(groundhog.flask_app.config, "job_queue",
+                        JobQueue(str(tmp_path / "jobs"), groundhog.process_job_input))
+    return groundhog.flask_app.test_client()
+
+
+def submit(client, records):
+    response = client.post("/groundhog/jobs", data=json.dumps(records), content_type="application/json")
+    assert response.status_code == 202
+    return json.loads(response.data)
+
+
+def get_results(client, job_id, query=""):
+    response = client.get("/groundhog/jobs/" + job_id + "/result" + query)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.data.decode("utf-8").splitlines()]
+
+
+def test_job_lifecycle(client):
+    records = benchmark.make_records(30)
+    expected = json.loads(client.post("/groundhog", data=json.dumps(records), content_type="application/json").data)
+
+    job_id = submit(client, records)["job_id"]
+    status = json.loads(client.get("/groundhog/jobs/" + job_id).data)
+    assert (status["status"], status["points_done"]) == ("queued", 0)
+    assert client.get("/groundhog/jobs/" + job_id + "/result").status_code == 409
+
+    assert groundhog.flask_app.config["job_queue"].run_pending()
+    status = json.loads(client.get("/groundhog/jobs/" + job_id).data)
+    assert (status["status"], status["points_done"]) == ("done", 30)
+    assert "windows" not in status
+
+    assert get_results(client, job_id) == expected
+    assert get_results(client, job_id, "?offset=5&limit=10") == expected[5:15]
+    assert get_results(client, job_id, "?offset=14") == expected[14:]
+    assert get_results(client, job_id, "?offset=40") == []
+
+    assert client.delete("/groundhog/jobs/" + job_id).status_code == 200
+    assert client.get("/groundhog/jobs/" + job_id).status_code == 404
+    assert client.delete("/groundhog/jobs/" + job_id).status_code == 404
+    assert not groundhog.flask_app.config["job_queue"].run_pending()
+
+
+@pytest.mark.parametrize("query", ["?offset=abc", "?limit=x", "?offset=-1", "?limit=-5"])
+def test_bad_result_range(client, query):
+    job_id = submit(client, benchmark.make_records(3))["job_id"]
+    groundhog.flask_app.config["job_queue"].run_pending()
+    assert client.get("/groundhog/jobs/" + job_id + "/result" + query).status_code == 400
+
+
+def test_failed_job(client):
+    job_id = submit(client, [{"latitude": "north"}])["job_id"]
+    groundhog.flask_app.config["job_queue"].run_pending()
+    status = json.loads(client.get("/groundhog/jobs/" + job_id).data)
+    assert status["status"] == "failed"
+    assert status["error"]
+
+
+def test_job_deleted_while_running(tmp_path):
+    started = threading.Event()
+
+    def process(input_file, mimetype):
+        for _ in range(20):
+            started.set()
+            time.sleep(0.02)
+            yield "{}\n", 1
+
+    queue = JobQueue(str(tmp_path), process)
+    job_id = queue.submit(io.BytesIO(b"[]"), "application/json")["job_id"]
+    errors = []
+
+    def run():
+        try:
+            queue.run_pending()
+        except Exception as e:
+            errors.append(e)
+
+    runner = threading.Thread(target=run)
+    runner.start()
+    started.wait(5)
+    assert queue.delete(job_id)
+    runner.join(5)
+    assert not runner.is_alive()
+    assert errors == []
+    assert queue.read_status(job_id) is None
+    # The runner is still good for the next job
+    next_id = queue.submit(io.BytesIO(b"[]"), "application/json")["job_id"]
+    assert queue.run_pending()
+    assert queue.read_status(next_id)["status"] == "done"
+
+
+def test_runner_survives_errors(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path))
+    calls = []
+
+    def run_pending():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise RuntimeError("disk trouble")
+        raise KeyboardInterrupt  # stops the loop
+
+    monkeypatch.setattr(queue, "run_pending", run_pending)
+    with pytest.raises(KeyboardInterrupt):
+        queue.run_forever(poll_interval=0.0)
+    assert len(calls) == 2
+
+
+def test_jobs_need_a_queue(tile_store, monkeypatch):
+    monkeypatch.setitem(groundhog.flask_app.config, "job_queue", None)
+    client = groundhog.flask_app.test_client()
+    job_id = "0" * 32
+    assert client.post("/groundhog/jobs", data="[]", content_type="application/json").status_code == 503
+    assert client.get("/groundhog/jobs/" + job_id).status_code == 503
+    assert client.delete("/groundhog/jobs/" + job_id).status_code == 503
+    assert client.get("/groundhog/jobs/" + job_id + "/result").status_code == 503
+
+
+@pytest.mark.parametrize("content_type", ["application/x-npz", "text/plain", ""])
+def test_jobs_need_json_or_ndjson(client, content_type):
+    response = client.post("/groundhog/jobs", data="[]", content_type=content_type)
+    assert response.status_code == 400
+    assert not groundhog.flask_app.config["job_queue"].run_pending()
+
+
+def abandon(queue, job_id, pid):
+    """
+    Makes a job look like a runner with the given pid claimed it and got part of the way
+    """
+    os.rename(queue.get_path(job_id, "queued"), queue.get_path(job_id, "claimed"))
+    with open(queue.get_path(job_id, "claimed"), "w") as claim_file:
+        claim_file.write(str(pid))
+    status = queue.read_status(job_id)
+    status.update({"status": "running", "started": time.time(), "points_done": 7, "windows": [[0, 0]]})
+    queue.write_status(status)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_requeue_abandoned(tmp_path):
+    queue = JobQueue(str(tmp_path), lambda input_file, mimetype: iter([("{}\n", 1)]))
+    abandoned = queue.submit(io.BytesIO(b"[]"), "application/json")["job_id"]
+    running = queue.submit(io.BytesIO(b"[]"), "application/json")["job_id"]
+    abandon(queue, abandoned, dead_pid())
+    abandon(queue, running, os.getpid())
+    queue.requeue_abandoned()
+    assert queue.read_status(abandoned)["status"] == "queued"
+    assert queue.read_status(abandoned)["points_done"] == 0
+    assert queue.read_status(running)["status"] == "running"
+    assert queue.run_pending()
+    assert queue.read_status(abandoned)["status"] == "done"
+    assert not queue.run_pending()
+
+
+def test_requeue_survives_races(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path))
+    job_id = queue.submit(io.BytesIO(b"[]"), "application/json")["job_id"]
+    abandon(queue, job_id, dead_pid())
+
+    def gone(path, *args):
+        raise FileNotFoundError(path)  # another runner requeued the job, or it was deleted, first
+    monkeypatch.setattr(os, "rename", gone)
+    queue.requeue_abandoned()
+    monkeypatch.undo()
+    monkeypatch.setattr(queue, "read_status", gone)
+    queue.requeue_abandoned()
+
+
+def test_runner_requeues_periodically(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path))
+    requeues = []
+    runs = []
+    monkeypatch.setattr(queue, "requeue_abandoned", lambda: requeues.append(len(runs)))
+
+    def run_pending():
+        runs.append(len(runs))
+        if len(runs) == 4:
+            raise KeyboardInterrupt  # stops the loop
+        return False
+    monkeypatch.setattr(queue, "run_pending", run_pending)
+    with pytest.raises(KeyboardInterrupt):
+        queue.run_forever(poll_interval=0.0, requeue_interval=0.0)
+    assert requeues == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("read_size", [1, 3, 64, 2 ** 20])
+def test_json_list_parsed_incrementally(read_size):
+    records = benchmark.make_records(20)
+    records[3]["unique_key"] = "café à la crème"  # multi-byte characters split across reads
+    payload = json.dumps(records, indent=2).encode("utf-8")
+    assert list(groundhog.iter_json_list_records(io.BytesIO(payload), read_size)) == records
+    assert list(groundhog.iter_json_list_records(io.BytesIO(b" [ ] \n"), read_size)) == []
+
+
+@pytest.mark.parametrize("payload", [b"", b'{"latitude": 1}', b'[{"latitude": 1}', b'[{"latitude": 1},]',
+                                     b'[{"latitude": 1} {"latitude": 2}]', b'[{"latitude": 1}] []', b"[,]"])
+def test_json_list_errors(payload):
+    with pytest.raises(ValueError):
+        list(groundhog.iter_json_list_records(io.BytesIO(payload), 4))
+
+
+def test_malformed_json_list_stops_reading():
+    # A record that never decodes fails without the rest of the upload being read in
+    upload = io.BytesIO(b'[{"latitude": 1, ' + b" " * (2 * groundhog.JOB_MAX_RECORD_CHARS) + b"x" * 10 ** 7)
+    with pytest.raises(ValueError):
+        list(groundhog.iter_json_list_records(upload, 1024))
+    assert upload.tell() < 3 * groundhog.JOB_MAX_RECORD_CHARS
@@ -0,0 +1,56 @@
+"""
+Metrics shared by forked processes
+"""
+
+import multiprocessing as mp
+import os
+import signal
+import pytest
+import metrics
+
+fork = mp.get_context("fork")
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry(max_processes=4)
+
+
+def run_in_child(target):
+    process = fork.Process(target=target)
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+
+
+def test_forked_processes_add_up(registry):
+    counter = metrics.Counter("test_total", "Test counter.", registry=registry)
+    histogram = metrics.Histogram("test_seconds", "Test histogram.", buckets=(1, 10), registry=registry)
+    counter.inc(2)
+
+    def update():
+        counter.inc(3)
+        histogram.observe(5, count=2)
+    for _ in range(6):  # more processes than rows, exited ones hand theirs on
+        run_in_child(update)
+    assert counter.get() == 20
+    assert 'test_seconds_bucket{le="10"} 12.0' in registry.render()
+    assert "test_seconds_sum 60.0" in registry.render()
+
+
+def test_killed_claimer_holds_nothing_up(registry, monkeypatch):
+    monkeypatch.setattr(metrics, "CLAIM_TIMEOUT", 0.1)
+    counter = metrics.Counter("test_total", "Test counter.", registry=registry)
+    claimed = fork.Event()
+
+    def die_claiming():
+        registry.claim_lock.acquire()
+        claimed.set()
+        os.kill(os.getpid(), signal.SIGKILL)
+    process = fork.Process(target=die_claiming)
+    process.start()
+    assert claimed.wait(10)
+    process.join(10)
+    run_in_child(lambda: counter.inc())  # claims a row without the lock
+    counter.inc()
+    assert counter.get() == 2
@@ -0,0 +1,283 @@
+"""
+The batch engine against the scalar functions it replaces, on the synthetic tiles
+"""
+
+import os
+import numpy as np
+import pytest
+import benchmark
+import srtm_elevation_and_slope as srtm_methods
+
+SOUTH, WEST = benchmark.TILE_SOUTH, benchmark.TILE_WEST
+NORTH, EAST = SOUTH + benchmark.TILE_ROWS, WEST + benchmark.TILE_COLUMNS
+
+
+def as_float(values):
+    """
+    Scalar results as an array, None becomes NaN like in the batch engine
+    """
+    return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+
+def void_points(tile_store, per_tile=20, seed=0):
+    """
+    Centers of void cells (scattered ones and ones inside void patches) of every synthetic tile
+    :return: (np.ndarray, np.ndarray) longitudes, latitudes
+    """
+    rng = np.random.RandomState(seed)
+    longitudes, latitudes = [], []
+    for latitude in range(SOUTH, NORTH):
+        for longitude in range(WEST, EAST):
+            tile = tile_store.get_tile(latitude, longitude)
+            rows, columns = np.nonzero(np.asarray(tile.data) == srtm_methods.SRTM_VOID)
+            picks = rng.choice(rows.size, per_tile, replace=False)
+            latitudes.extend(latitude + 1 - (rows[picks] + 0.5) / (tile.side - 1))
+            longitudes.extend(longitude + (columns[picks] + 0.5) / (tile.side - 1))
+    return np.array(longitudes), np.array(latitudes)
+
+
+def edge_points():
+    """
+    Points on and either side of the tile edges, plus a few just outside the synthetic tiles
+    :return: (np.ndarray, np.ndarray) longitudes, latitudes
+    """
+    offsets = [-1e-9, 0.0, 1e-9]
+    inner_latitude, inner_longitude = SOUTH + 1, WEST + 1
+    latitudes = [inner_latitude + offset for offset in offsets] * 2 + [SOUTH + 0.5] * 3 + [NORTH - 1e-9, SOUTH - 0.001]
+    longitudes = [WEST + 0.5] * 3 + [inner_longitude - 0.3] * 3 + [inner_longitude + offset for offset in offsets]
+    longitudes += [EAST - 1e-9, WEST + 0.5]
+    corners_lon, corners_lat = np.meshgrid([inner_longitude - 1e-9, inner_longitude], [inner_latitude - 1e-9,
+                                                                                      inner_latitude])
+    return (np.concatenate([longitudes, corners_lon.ravel()]),
+            np.concatenate([latitudes, corners_lat.ravel()]))
+
+
+@pytest.fixture
+def points(tile_store):
+    """
+    Random points, void cells and tile edges, with bearings
+    """
+    longitudes, latitudes, _ = benchmark.make_points(300)
+    void_longitudes, void_latitudes = void_points(tile_store)
+    edge_longitudes, edge_latitudes = edge_points()
+    longitudes = np.concatenate([longitudes, void_longitudes, edge_longitudes])
+    latitudes = np.concatenate([latitudes, void_latitudes, edge_latitudes])
+    bearings = np.random.RandomState(2).uniform(0.0, 360.0, longitudes.size)
+    return longitudes, latitudes, bearings
+
+
+def test_points_hit_voids(tile_store, points):
+    longitudes, latitudes, _ = points
+    assert np.isnan(tile_store.get_elevations(latitudes, longitudes)).sum() >= 80
+
+
+def test_elevation_batch_matches_scalar(points):
+    longitudes, latitudes, _ = points
+    expected = as_float(srtm_methods.get_elevation_safe(lon, lat) for lon, lat in zip(longitudes, latitudes))
+    np.testing.assert_array_equal(srtm_methods.get_elevation_safe_batch(longitudes, latitudes), expected)
+
+
+@pytest.mark.parametrize("stride", [90.0, 250.0])
+def test_slope_batch_matches_scalar(points, stride):
+    longitudes, latitudes, bearings = points
+    expected = [srtm_methods.slope_from_coord_bearing(lon, lat, bearing, stride_length=stride)
+                for lon, lat, bearing in zip(longitudes, latitudes, bearings)]
+    elevations, slopes = srtm_methods.slope_from_coord_bearing_batch(longitudes, latitudes, bearings,
+                                                                     stride_length=stride)
+    np.testing.assert_array_equal(elevations, as_float(elevation for elevation, _ in expected))
+    np.testing.assert_array_equal(slopes, as_float(slope for _, slope in expected))
+
+
+def test_slope_batch_without_bearing_matches_scalar(points):
+    longitudes, latitudes, _ = points
+    expected = [srtm_methods.slope_from_coord_bearing(lon, lat, None) for lon, lat in zip(longitudes, latitudes)]
+    elevations, slopes = srtm_methods.slope_from_coord_bearing_batch(longitudes, latitudes,
+                                                                     np.full(longitudes.size, np.nan))
+    np.testing.assert_array_equal(elevations, as_float(elevation for elevation, _ in expected))
+    assert np.isnan(slopes).all()
+
+
+def test_coords_only_batch_matches_scalar(tile_store):
+    longitudes = np.linspace(WEST + 0.7, WEST + 1.3, 60)
+    latitudes = SOUTH + 0.9 + 0.2 * np.sin(np.linspace(0.0, 6.0, 60))
+    elevations, slopes, bearings = srtm_methods.slope_from_coords_only(list(zip(longitudes, latitudes)))
+    batch = srtm_methods.slope_from_coords_only_batch(longitudes, latitudes)
+    np.testing.assert_array_equal(batch[0], as_float(elevations))
+    np.testing.assert_array_equal(batch[1], as_float(slopes))
+    np.testing.assert_allclose(batch[2], as_float(bearings), rtol=0, atol=1e-9)
+
+
+def test_batch_handles_nan_input(tile_store):
+    longitudes = np.array([np.nan, WEST + 0.5, WEST + 0.5, np.nan])
+    latitudes = np.array([SOUTH + 0.5, np.nan, SOUTH + 0.5, np.nan])
+    bearings = np.array([10.0, 10.0, np.nan, np.nan])
+    elevations = srtm_methods.get_elevation_safe_batch(longitudes, latitudes)
+    assert np.isnan(elevations[[0, 1, 3]]).all()
+    assert elevations[2] == srtm_methods.get_elevation_safe(WEST + 0.5, SOUTH + 0.5)
+    elevations, slopes = srtm_methods.slope_from_coord_bearing_batch(longitudes, latitudes, bearings)
+    assert np.isnan(elevations[[0, 1, 3]]).all()
+    assert elevations[2] == srtm_methods.slope_from_coord_bearing(WEST + 0.5, SOUTH + 0.5, None)[0]
+    assert np.isnan(slopes).all()
+
+
+@pytest.fixture
+def dense_tracks(tile_store):
+    """
+    Two wiggly tracks of GPS fixes a second (and about a meter) apart, every hundredth with a bearing of its own
+    """
+    steps = np.arange(3000)
+    longitudes = WEST + 0.5 + steps * 1.2e-5 + 2e-4 * np.sin(steps / 300.0)
+    latitudes = SOUTH + 0.6 + steps * 0.8e-5
+    tracks = (steps >= 1500).astype(int)
+    bearings = np.full(steps.size, np.nan)
+    bearings[::100] = 45.0
+    return longitudes, latitudes, bearings, np.full(steps.size, 250.0), tracks, steps.astype(float)
+
+
+def test_decimate_track_keeps_track_ends_and_stride_changes(dense_tracks):
+    longitudes, latitudes, _, strides, tracks, _ = dense_tracks
+    strides = strides.copy()
+    strides[2000:] = 500.0
+    representatives, group, along = srtm_methods.decimate_track(longitudes, latitudes, tracks=tracks,
+                                                                strides=strides, min_distance=30.0)
+    assert {0, 1499, 1500, 2000, 2999} <= set(representatives.tolist())
+    np.testing.assert_array_equal(representatives[group[representatives]], representatives)
+    assert (along[[0, 1500]] == 0).all()
+    assert np.all(np.diff(along[representatives[(representatives > 0) & (representatives < 1499)]]) <= 60.0)
+
+
+def test_decimation_off_matches_full(dense_tracks):
+    longitudes, latitudes, bearings, strides, tracks, _ = dense_tracks
+    full = srtm_methods.slope_from_mixed_batch(longitudes, latitudes, bearings, strides, tracks=tracks)
+    decimated = srtm_methods.decimated_slope_batch(longitudes, latitudes, bearings, strides, tracks=tracks)
+    for full_values, decimated_values in zip(full, decimated):
+        np.testing.assert_array_equal(decimated_values, full_values)
+
+
+@pytest.mark.parametrize("decimation", [{"min_distance": 10.0}, {"min_distance": 60.0}, {"min_seconds": 10.0}])
+def test_decimated_results_match_full(dense_tracks, decimation):
+    longitudes, latitudes, bearings, strides, tracks, times = dense_tracks
+    full_elevations, full_slopes, full_bearings = srtm_methods.slope_from_mixed_batch(longitudes, latitudes,
+                                                                                      bearings, strides, tracks=tracks)
+    elevations, slopes, inferred_bearings = srtm_methods.decimated_slope_batch(
+        longitudes, latitudes, bearings, strides, tracks=tracks, times=times, **decimation)
+    representatives = srtm_methods.decimate_track(longitudes, latitudes, tracks=tracks, times=times, strides=strides,
+                                                  **decimation)[0]
+    assert representatives.size < longitudes.size / 5
+
+    # Looked up points are exact (voids ahead of them included), the rest are close
+    np.testing.assert_array_equal(elevations[representatives], full_elevations[representatives])
+    assert np.nanmean(np.abs(elevations - full_elevations)) < 1.5
+    assert np.nanmax(np.abs(elevations - full_elevations)) <= 15.0
+    assert np.nanmean(np.abs(slopes - full_slopes)) < 0.015
+    np.testing.assert_array_equal(inferred_bearings[::100], bearings[::100])
+    assert np.nanmean(np.abs((inferred_bearings - full_bearings + 180.0) % 360.0 - 180.0)) < 1.0
+
+
+@pytest.mark.parametrize("decimation", [{"min_distance": 60.0}, {"min_seconds": 10.0}])
+def test_decimation_keeps_given_bearings_exact(dense_tracks, decimation):
+    longitudes, latitudes, bearings, strides, tracks, times = dense_tracks
+    bearings = bearings.copy()
+    bearings[5::100] = 300.0  # across the track, in the middle of runs
+    full_elevations, full_slopes, _ = srtm_methods.slope_from_mixed_batch(longitudes, latitudes, bearings, strides,
+                                                                          tracks=tracks)
+    elevations, slopes, inferred_bearings = srtm_methods.decimated_slope_batch(
+        longitudes, latitudes, bearings, strides, tracks=tracks, times=times, **decimation)
+    given = np.flatnonzero(np.isfinite(bearings))
+    np.testing.assert_array_equal(elevations[given], full_elevations[given])
+    np.testing.assert_array_equal(slopes[given], full_slopes[given])
+    np.testing.assert_array_equal(inferred_bearings[given], bearings[given])
+    # Every point pairs the bearing and slope of its representative
+    representatives, group, _ = srtm_methods.decimate_track(longitudes, latitudes, tracks=tracks, times=times,
+                                                            strides=strides, bearings=bearings, **decimation)
+    assert set(given.tolist()) <= set(representatives.tolist())
+    np.testing.assert_array_equal(inferred_bearings, inferred_bearings[representatives][group])
+    np.testing.assert_array_equal(slopes, slopes[representatives][group])
+
+
+@pytest.mark.parametrize("decimation", [{"min_distance": 30.0}, {"min_seconds": 10.0}])
+def test_decimation_of_interleaved_tracks(dense_tracks, decimation):
+    longitudes, latitudes, bearings, strides, tracks, times = dense_tracks
+    contiguous = srtm_methods.decimated_slope_batch(longitudes, latitudes, bearings, strides, tracks=tracks,
+                                                    times=times, **decimation)
+    # The two tracks' fixes alternate, like two assets reporting side by side
+    interleaved = np.ravel(np.column_stack([np.arange(1500), np.arange(1500, 3000)]))
+    columns = [column[interleaved] for column in dense_tracks]
+    representatives, _, along = srtm_methods.decimate_track(*columns[:2], tracks=columns[4], times=columns[5],
+                                                            strides=columns[3], **decimation)
+    assert representatives.size < longitudes.size / 5
+    np.testing.assert_array_equal(along, srtm_methods.decimate_track(
+        longitudes, latitudes, tracks=tracks, times=times, strides=strides, **decimation)[2][interleaved])
+    results = srtm_methods.decimated_slope_batch(*columns[:4], tracks=columns[4], times=columns[5], **decimation)
+    for values, contiguous_values in zip(results, contiguous):
+        np.testing.assert_array_equal(values, contiguous_values[interleaved])
+
+
+def test_gradient_rasters_are_mapped_and_counted(tile_dir, tile_store):
+    latitudes, longitudes = np.array([SOUTH + 0.5]), np.array([WEST + 0.5])
+    tile = tile_store.get_tile(SOUTH + 0.5, WEST + 0.5)
+    tile_bytes = tile.data.nbytes
+    assert tile_store.cache.resident_bytes == tile_bytes
+    for stride in [250.0, 250.4]:
+        tile_store.get_gradients(latitudes, longitudes, stride)
+        assert isinstance(tile.gradients[stride], np.memmap)
+        assert os.path.exists(tile.path + ".grad" + repr(stride) + ".npy")
+    # Each stride has an east and a north raster the size of the tile
+    assert tile_store.cache.resident_bytes == 5 * tile_bytes
+
+    # Tiles with rasters are evicted once the rasters push the cache over budget
+    store = srtm_methods.HgtTileStore(tile_dir=tile_dir, fetch_missing=False, cache_bytes=3 * tile_bytes + 1)
+    store.get_gradients(latitudes, longitudes, 250.0)
+    store.get_tile(SOUTH + 1.5, WEST + 0.5)
+    assert store.cache.stats()["resident_tiles"] == 1
+    assert store.cache.resident_bytes == tile_bytes
+
+
+def test_spiral_search_off_the_tiles(tile_store, monkeypatch):
+    # Just outside the synthetic tiles (found at a bigger search scale), and far out at sea
+    longitudes = np.array([WEST + 0.5, EAST + 0.3, WEST + 0.5, -150.0, -150.0])
+    latitudes = np.array([SOUTH - 0.001, SOUTH + 0.5, NORTH + 0.3, 0.5, 0.7])
+    expected = as_float(srtm_methods.get_elevation_safe(lon, lat) for lon, lat in zip(longitudes, latitudes))
+    assert np.isfinite(expected[:3]).all() and np.isnan(expected[3:]).all()
+    lookups = []
+    get_elevations = tile_store.get_elevations
+
+    def counted_get_elevations(latitudes, longitudes, **kwargs):
+        lookups.append(latitudes.size)
+        return get_elevations(latitudes, longitudes, **kwargs)
+    monkeypatch.setattr(tile_store, "get_elevations", counted_get_elevations)
+    np.testing.assert_array_equal(srtm_methods.get_elevation_safe_batch(longitudes, latitudes), expected)
+    # Points at sea give up without looking up a single spiral point, the others at one batch per scale
+    np.testing.assert_array_equal(srtm_methods.spiral_search_batch(longitudes[3:], latitudes[3:]), [np.nan] * 2)
+    assert len(lookups) <= 1 + 3 * len(srtm_methods.SPIRAL_SEARCH_FACTORS)
+
+
+@pytest.mark.parametrize("stride", [250.4, 400.0])
+def test_gradient_slopes_match_exact(tile_dir, tmp_path, monkeypatch, stride):
+    # A 3000 m cliff across one tile, far too steep for the int16 rasters
+    file_name = srtm_methods.HgtTileStore.get_file_name(SOUTH, WEST)
+    data = np.fromfile(os.path.join(tile_dir, file_name), dtype=">i2").reshape(benchmark.TILE_SIDE, -1)
+    data[:, 600:] = np.where(data[:, 600:] == srtm_methods.SRTM_VOID, data[:, 600:], data[:, 600:] + 3000)
+    data.tofile(str(tmp_path / file_name))
+    store = srtm_methods.HgtTileStore(tile_dir=str(tmp_path), fetch_missing=False)
+    monkeypatch.setattr(srtm_methods, "tile_store", store)
+    monkeypatch.setattr(srtm_methods, "slope_cache", None)
+    monkeypatch.setattr(srtm_methods, "gradient_strides", (stride,))
+
+    # Cell centers along the four cardinal bearings, where both take the same cells ahead and behind
+    rng = np.random.RandomState(3)
+    rows = rng.randint(20, benchmark.TILE_SIDE - 20, 2000)
+    columns = np.concatenate([rng.randint(20, benchmark.TILE_SIDE - 20, 1000), rng.randint(590, 610, 1000)])
+    latitudes = SOUTH + 1 - (rows + 0.5) / (benchmark.TILE_SIDE - 1)
+    longitudes = WEST + (columns + 0.5) / (benchmark.TILE_SIDE - 1)
+    bearings = np.tile([0.0, 90.0, 180.0, 270.0], 500)
+    strides = np.full(rows.size, stride)
+    gradients = store.get_tile(SOUTH, WEST).get_gradients(stride)
+    steep = gradients[0][rows, columns] == srtm_methods.GRADIENT_VOID
+    assert steep[1000:].sum() > 100  # the cliff
+
+    elevations, slopes = srtm_methods.gradient_slope_batch(longitudes, latitudes, bearings, strides)
+    exact_elevations, exact_slopes = srtm_methods.exact_slope_batch(longitudes, latitudes, bearings, strides)
+    np.testing.assert_array_equal(elevations, exact_elevations)
+    assert np.nanmax(np.abs(exact_slopes)) > -srtm_methods.GRADIENT_VOID / srtm_methods.GRADIENT_SCALE
+    np.testing.assert_allclose(slopes, exact_slopes, rtol=0, atol=1e-4)
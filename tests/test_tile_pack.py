@@ -0,0 +1,63 @@
+"""
+Tile packs built from the synthetic tiles against the tiles themselves
+"""
+
+import numpy as np
+import pytest
+import benchmark
+import srtm_elevation_and_slope as srtm_methods
+import tile_pack
+
+SOUTH, WEST = benchmark.TILE_SOUTH, benchmark.TILE_WEST
+NORTH, EAST = SOUTH + benchmark.TILE_ROWS, WEST + benchmark.TILE_COLUMNS
+
+
+@pytest.fixture(scope="module")
+def pack_path(tile_dir, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("pack") / "synthetic.ghpack")
+    store = srtm_methods.HgtTileStore(tile_dir=tile_dir, fetch_missing=False)
+    assert tile_pack.build_pack(path, [(SOUTH, WEST, NORTH - 0.5, EAST - 0.5)], store, chunk_rows=100) == 4
+    return path
+
+
+@pytest.fixture
+def pack_store(pack_path, tmp_path, monkeypatch):
+    """
+    Serves tiles out of the pack only (the tile dir is empty)
+    """
+    store = srtm_methods.HgtTileStore(tile_dir=str(tmp_path), fetch_missing=False, pack=tile_pack.TilePack(pack_path))
+    monkeypatch.setattr(srtm_methods, "tile_store", store)
+    monkeypatch.setattr(srtm_methods, "slope_cache", None)
+    monkeypatch.setattr(srtm_methods, "gradient_strides", None)
+    return store
+
+
+def test_preload_decompresses_whole_tiles(pack_store):
+    assert pack_store.preload() == 4
+    for file_name in pack_store.pack.file_names:
+        data = pack_store.cache.get(file_name).data
+        assert data.loaded.all()
+        assert data.array is not None
+
+
+def test_packed_tiles_match_hgt_files(pack_store, tile_dir):
+    hgt_store = srtm_methods.HgtTileStore(tile_dir=tile_dir, fetch_missing=False)
+    for file_name in pack_store.pack.file_names:
+        packed, hgt = pack_store.pack.get_tile(file_name), hgt_store.get_tile(*hgt_store.parse_file_name(file_name))
+        np.testing.assert_array_equal(np.asarray(packed.data), hgt.data)
+        np.testing.assert_array_equal(packed.get_void_index(), hgt.get_void_index())
+        # Points at every void cell and as many others, read band by band through the store
+        voids = (hgt.data > srtm_methods.SRTM_VOID_MAX) | (hgt.data < srtm_methods.SRTM_VOID_MIN)
+        voids = voids[:-1, :-1]  # the last row and column are read from the neighbouring tiles
+        assert voids.any()
+        rows, columns = np.nonzero(voids)
+        rng = np.random.RandomState(len(rows))
+        rows = np.concatenate([rows, rng.randint(0, hgt.side - 1, rows.size)])
+        columns = np.concatenate([columns, rng.randint(0, hgt.side - 1, columns.size)])
+        latitudes = hgt.latitude + 1 - (rows + 0.5) / (hgt.side - 1)
+        longitudes = hgt.longitude + (columns + 0.5) / (hgt.side - 1)
+        elevations = pack_store.get_elevations(latitudes, longitudes)
+        np.testing.assert_array_equal(elevations, hgt_store.get_elevations(latitudes, longitudes))
+        filled = pack_store.get_elevations(latitudes, longitudes, fill_radius=0.05)
+        np.testing.assert_array_equal(filled, hgt_store.get_elevations(latitudes, longitudes, fill_radius=0.05))
+        assert np.isnan(elevations[:voids.sum()]).all() and (np.isnan(filled).sum() < np.isnan(elevations).sum())